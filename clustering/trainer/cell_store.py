@@ -0,0 +1,137 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Read a memory-mapped, compressed sparse row cell store.
+
+Cell stores are written by the data loaders, see data_loading/cell_store.py
+for a description of the format. The arrays are opened with numpy.memmap so
+that ranges of cells and subsets of genes are read without parsing or copying
+the whole matrix.
+"""
+
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp_sparse
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+INDPTR_FILE = 'indptr.bin'
+INDICES_FILE = 'indices.bin'
+DATA_FILE = 'data.bin'
+GENES_FILE = 'genes.txt'
+BARCODES_FILE = 'barcodes.txt'
+
+
+def read_lines(filename):
+  with open(filename, 'r') as f:
+    return [line.rstrip('\n') for line in f]
+
+
+def is_cell_store(path):
+  """Whether the path is a cell store directory."""
+  return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+class CellStore(object):
+  """A read-only view of the cells by genes matrix in a cell store."""
+
+  def __init__(self, path):
+    """Open the cell store.
+
+    Args:
+      path: Path of the cell store directory.
+    """
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+      self.manifest = json.load(f)
+    if self.manifest['format_version'] != FORMAT_VERSION:
+      raise ValueError('Unsupported cell store format version %s in %s.'
+                       % (self.manifest['format_version'], path))
+    self.num_cells = self.manifest['num_cells']
+    self.num_genes = self.manifest['num_genes']
+    self.genes = read_lines(os.path.join(path, GENES_FILE))
+    self.barcodes = read_lines(os.path.join(path, BARCODES_FILE))
+    self.indptr = np.memmap(os.path.join(path, INDPTR_FILE), mode='r',
+                            dtype=self.manifest['indptr_dtype'],
+                            shape=(self.num_cells + 1,))
+    if self.manifest['nnz']:
+      self.indices = np.memmap(os.path.join(path, INDICES_FILE), mode='r',
+                               dtype=self.manifest['indices_dtype'],
+                               shape=(self.manifest['nnz'],))
+      self.data = np.memmap(os.path.join(path, DATA_FILE), mode='r',
+                            dtype=self.manifest['data_dtype'],
+                            shape=(self.manifest['nnz'],))
+    else:
+      self.indices = np.zeros(0, dtype=self.manifest['indices_dtype'])
+      self.data = np.zeros(0, dtype=self.manifest['data_dtype'])
+
+  def cells(self, begin_idx, end_idx):
+    """Get a range of cells.
+
+    Args:
+      begin_idx: Index of the first cell (inclusive).
+      end_idx: Index at which to stop (exclusive).
+
+    Returns:
+      A CSR matrix of the cells by all genes, backed by the memory map.
+    """
+    first, last = self.indptr[begin_idx], self.indptr[end_idx]
+    return sp_sparse.csr_matrix(
+        (self.data[first:last], self.indices[first:last],
+         np.asarray(self.indptr[begin_idx:end_idx + 1]) - first),
+        shape=(end_idx - begin_idx, self.num_genes))
+
+  def take(self, cell_idx):
+    """Get arbitrary cells, such as a random batch.
+
+    Args:
+      cell_idx: array of the indices of the cells
+
+    Returns:
+      A CSR matrix of the cells by all genes.
+    """
+    cell_idx = np.asarray(cell_idx)
+    firsts = np.asarray(self.indptr[cell_idx])
+    lasts = np.asarray(self.indptr[cell_idx + 1])
+    indptr = np.concatenate([[0], np.cumsum(lasts - firsts)])
+    slices = [slice(first, last) for first, last in zip(firsts, lasts)]
+    if not slices:
+      return sp_sparse.csr_matrix((0, self.num_genes), dtype=self.data.dtype)
+    return sp_sparse.csr_matrix(
+        (np.concatenate([self.data[s] for s in slices]),
+         np.concatenate([self.indices[s] for s in slices]), indptr),
+        shape=(len(cell_idx), self.num_genes))
+
+  def gene_columns(self, measurements):
+    """Map the genes of the store to positions in a list of measurements.
+
+    Args:
+      measurements: list of measurement names, such as a vocabulary
+
+    Returns:
+      An array holding, for each gene of the store, its index in
+      measurements or -1 if it is absent.
+    """
+    positions = dict((name, i) for i, name in enumerate(measurements))
+    return np.array([positions.get(gene, -1) for gene in self.genes],
+                    dtype=np.int64)
+
+  def select_genes(self, matrix, columns, num_columns):
+    """Restrict cells to a subset of genes, reordering the columns.
+
+    Args:
+      matrix: CSR matrix of cells by all genes of the store
+      columns: array from gene_columns
+      num_columns: the number of measurements passed to gene_columns
+
+    Returns:
+      A CSR matrix of the cells by the measurements.
+    """
+    coo = matrix.tocoo()
+    mapped = columns[coo.col]
+    keep = mapped >= 0
+    return sp_sparse.csr_matrix(
+        (coo.data[keep], (coo.row[keep], mapped[keep])),
+        shape=(matrix.shape[0], num_columns))
@@ -0,0 +1,69 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test reading of memory-mapped cell stores."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from trainer import cell_store
+
+# Test data, a matrix of three cells by three genes.
+GENES = ['Glul', 'Prkca', 'Rho']
+BARCODES = ['cell1', 'cell2', 'cell3']
+DENSE = np.array([[8, 35, 0],
+                  [0, 0, 0],
+                  [1, 0, 2]], dtype=np.float32)
+
+
+class CellStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    nonzero = DENSE.nonzero()
+    np.array([0, 2, 2, 4], dtype=np.int64).tofile(
+        os.path.join(self.path, cell_store.INDPTR_FILE))
+    nonzero[1].astype(np.int32).tofile(
+        os.path.join(self.path, cell_store.INDICES_FILE))
+    DENSE[nonzero].tofile(os.path.join(self.path, cell_store.DATA_FILE))
+    for filename, lines in [(cell_store.GENES_FILE, GENES),
+                            (cell_store.BARCODES_FILE, BARCODES)]:
+      with open(os.path.join(self.path, filename), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.join(self.path, cell_store.MANIFEST_FILE), 'w') as f:
+      json.dump({'format_version': cell_store.FORMAT_VERSION,
+                 'num_cells': 3, 'num_genes': 3, 'nnz': 4,
+                 'indptr_dtype': 'int64', 'indices_dtype': 'int32',
+                 'data_dtype': 'float32'}, f)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_cells(self):
+    store = cell_store.CellStore(self.path)
+    self.assertTrue(cell_store.is_cell_store(self.path))
+    self.assertEqual(BARCODES, store.barcodes)
+    np.testing.assert_array_equal(DENSE[1:3], store.cells(1, 3).toarray())
+
+  def test_take(self):
+    store = cell_store.CellStore(self.path)
+    np.testing.assert_array_equal(DENSE[[2, 0, 2]],
+                                  store.take([2, 0, 2]).toarray())
+
+  def test_select_genes(self):
+    store = cell_store.CellStore(self.path)
+    vocabulary = ['Rho', 'Missing', 'Glul']
+    columns = store.gene_columns(vocabulary)
+    np.testing.assert_array_equal([2, -1, 0], columns)
+    np.testing.assert_array_equal(
+        [[0, 0, 8], [0, 0, 0], [2, 0, 1]],
+        store.select_genes(store.cells(0, 3), columns, 3).toarray())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,7 +8,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-
+import contextlib
+import functools
+import io
+from multiprocessing.pool import ThreadPool
+import os
+
+import numpy as np
+import scipy.sparse as sp_sparse
 import tensorflow as tf
 
 from tensorflow.contrib.learn.python.learn import learn_runner as learn_runner
@@ -16,36 +23,112 @@ from tensorflow.contrib.learn.python.learn.estimators import kmeans as kmeans_li
 from tensorflow.contrib.learn.python.learn.utils import input_fn_utils
 from tensorflow.contrib.learn.python.learn.utils import saved_model_export_utils
 from tensorflow.python import debug as tf_debug
-from tensorflow.python.lib.io.tf_record import TFRecordCompressionType
 
+from trainer import cell_store
+from trainer import example_shards
+from trainer import local_kmeans
+from trainer import sparse_kmeans
+from trainer import sparse_pca
 from trainer.shared_constants import *
 
 # Keys for the serving input function.
 EXAMPLE_KEY = "input_feature"
 DENSE_KEY = "dense"
+SPARSE_KEY = "sparse"
+
+# The clusters chosen by k-means||, reused when training is restarted.
+INITIAL_CLUSTERS_FILE = "initial_clusters.npz"
+
+# The summary of the models trained by a sweep of the number of clusters.
+SWEEP_FILE = "sweep.csv"
 
-# Constant for use with read_batch_features
-# https://www.tensorflow.org/api_docs/python/tf/contrib/learn/read_batch_features
-QUEUE_CAPACITY_MULTIPLIER = 3
+# The number of samples in each batch read outside of the TensorFlow graph.
+READ_BATCH_SIZE = 10000
 
+tf.flags.DEFINE_enum("engine", "tensorflow", ["tensorflow", "local"],
+                     "Train with a TensorFlow experiment, or with mini-batch "
+                     "k-means of a SciPy sparse matrix of all the samples in "
+                     "the memory of this machine.")
+tf.flags.DEFINE_integer("num_threads", 0,
+                        "The number of threads of the local engine. If 0, "
+                        "the number of cores.")
 tf.flags.DEFINE_bool("use_cosine_distance", False,
                      "Override the default of euclidean distance to instead "
                      "use cosine distance.")
 tf.flags.DEFINE_bool("use_kmeans_plus_plus", False,
                      "Override the default of random initialization to "
                      "instead use kmeans++ initialization.")
+tf.flags.DEFINE_bool("use_kmeans_parallel", False,
+                     "Override the default of random initialization to "
+                     "instead use k-means|| initialization over all the "
+                     "samples, in a few passes before training. The number "
+                     "of clusters may then exceed the batch size.")
 tf.flags.DEFINE_float("relative_tolerance", None,
                       "Threshold at which to stop training when the change "
                       "in loss goes below this tolerance.")
+tf.flags.DEFINE_bool("use_sparse_kmeans", False,
+                     "Keep the batches of measurements sparse and cluster "
+                     "them with sparse-dense matrix multiplications, instead "
+                     "of densifying them for KMeansClustering. Uses random "
+                     "initialization.")
+tf.flags.DEFINE_integer("num_pca_components", 0,
+                        "If nonzero, cluster the projections of the samples on "
+                        "this many principal components, such as 50, instead "
+                        "of the samples.")
+tf.flags.DEFINE_integer("pca_num_samples", 100000,
+                        "The number of samples from which the principal "
+                        "components are computed.")
 tf.flags.DEFINE_string("vocabulary_file", None,
                        "Newline-separated file of the names of the subset of "
                        "measurements, or all possible measurements, in the "
                        "tf.Example protos to be used for clustering.")
+tf.flags.DEFINE_bool("use_measurement_indices", False,
+                     "Whether the tf.Example protos hold the vocabulary "
+                     "indices written by preprocessing with a vocabulary "
+                     "file, instead of measurement names. The vocabulary "
+                     "file must be the one used during preprocessing.")
 tf.flags.DEFINE_integer("num_clusters", None,
                         "The number of clusters to learn from the data.")
+tf.flags.DEFINE_list("num_clusters_sweep", None,
+                     "Comma-separated numbers of clusters, such as 10,20,40, "
+                     "of models trained on the same batches by the local "
+                     "engine, instead of --num_clusters. The clusters of each "
+                     "model are written to a k_<number of clusters> "
+                     "subdirectory of the output path. Only the local engine, "
+                     "which reads all the samples into memory, supports a "
+                     "sweep.")
+tf.flags.DEFINE_integer("num_initializations", 1,
+                        "The number of initializations of each model trained "
+                        "by the local engine, on the same batches. The model "
+                        "of lowest inertia is kept. Only the local engine, "
+                        "which reads all the samples into memory, supports "
+                        "several initializations.")
 tf.flags.DEFINE_integer("batch_size", 50,
                         "The size of the training input batches.")
 tf.flags.DEFINE_string("input_file_pattern", None, "Path to the input files.")
+tf.flags.DEFINE_integer("num_parallel_reads", 16,
+                        "The number of input files read in parallel.")
+tf.flags.DEFINE_integer("num_parallel_calls", 16,
+                        "The number of batches of examples parsed in "
+                        "parallel.")
+tf.flags.DEFINE_integer("shuffle_buffer_size", 10000,
+                        "The number of examples from which each training "
+                        "example is drawn at random. If 0, examples are not "
+                        "shuffled beyond the interleaving of the files.")
+tf.flags.DEFINE_integer("prefetch_buffer_size", 4,
+                        "The number of parsed batches prepared ahead of "
+                        "training.")
+tf.flags.DEFINE_bool("cache_training_data", False,
+                     "Cache the parsed batches of the first pass over the "
+                     "input files, and train on shuffled batches of the "
+                     "cache afterwards instead of reading, decompressing and "
+                     "parsing the files again.")
+tf.flags.DEFINE_string("cache_path", "",
+                       "Local file prefix of the cache of the parsed batches. "
+                       "If empty, the cache is held in memory.")
+tf.flags.DEFINE_string("input_cell_store", None,
+                       "Path to a local cell store directory to train on "
+                       "instead of the input files.")
 tf.flags.DEFINE_string("output_path", None,
                        "Output directory used by the local and cloud jobs.")
 tf.flags.DEFINE_integer("num_train_steps", 100,
@@ -69,21 +152,33 @@ def _get_feature_columns():
   Returns:
     Dictionary of `FeatureColumn` objects.
   """
-  return {
+  feature_columns = {
       SAMPLE_NAME_FEATURE: tf.FixedLenFeature(shape=[], dtype=tf.string),
-      MEASUREMENTS_FEATURE: tf.VarLenFeature(dtype=tf.string),
       VALUES_FEATURE: tf.VarLenFeature(dtype=tf.float32)
   }
+  if FLAGS.use_measurement_indices:
+    feature_columns[MEASUREMENT_INDICES_FEATURE] = tf.VarLenFeature(
+        dtype=tf.int64)
+  else:
+    feature_columns[MEASUREMENTS_FEATURE] = tf.VarLenFeature(dtype=tf.string)
+  return feature_columns
 
 
-def _raw_features_to_dense_tensor(raw_features):
-  """Convert the raw features expressing a sparse vector to a dense tensor.
+def _raw_features_to_sparse_tensor(raw_features):
+  """Convert the raw features expressing a sparse vector to a sparse tensor.
 
   Args:
     raw_features: Parsed features in sparse matrix format.
   Returns:
-    A dense tensor populated with the raw features.
+    A sparse tensor of shape [batch size, vocabulary size].
   """
+  if FLAGS.use_measurement_indices:
+    # The indices are already sorted, so no lookup table is needed.
+    return tf.sparse_merge(
+        raw_features[MEASUREMENT_INDICES_FEATURE],
+        raw_features[VALUES_FEATURE],
+        vocab_size=len(_read_vocabulary()))
+
   # Load the vocabulary here as each batch of examples is parsed to ensure that
   # the examples and the mapping table are located in the same TensorFlow graph.
   measurement_table = tf.contrib.lookup.index_table_from_file(
@@ -93,16 +188,274 @@ def _raw_features_to_dense_tensor(raw_features):
 
   indices = measurement_table.lookup(raw_features[MEASUREMENTS_FEATURE])
 
-  merged = tf.sparse_merge(
+  return tf.sparse_merge(
       indices,
       raw_features[VALUES_FEATURE],
       vocab_size=measurement_table.size())
-  return tf.sparse_tensor_to_dense(merged)
 
 
-def _input_fn():
+def _raw_features_to_dense_tensor(raw_features):
+  """Convert the raw features expressing a sparse vector to a dense tensor.
+
+  Args:
+    raw_features: Parsed features in sparse matrix format.
+  Returns:
+    A dense tensor populated with the raw features.
+  """
+  return tf.sparse_tensor_to_dense(_raw_features_to_sparse_tensor(raw_features))
+
+
+def _raw_features_to_model_input(raw_features):
+  """Convert the raw features to the batch of measurements of the model.
+
+  Args:
+    raw_features: Parsed features in sparse matrix format.
+  Returns:
+    A dense tensor of the projections on the principal components if
+    clustering them, a sparse tensor if clustering with sparse k-means, or
+    else a dense tensor.
+  """
+  if FLAGS.num_pca_components:
+    return _project(_raw_features_to_sparse_tensor(raw_features))
+  if FLAGS.use_sparse_kmeans:
+    return _raw_features_to_sparse_tensor(raw_features)
+  return _raw_features_to_dense_tensor(raw_features)
+
+
+def _read_vocabulary():
+  """Reads the measurement names from the vocabulary file.
+
+  Returns:
+    The list of measurement names, in the order used by the lookup table.
+  """
+  with tf.gfile.Open(FLAGS.vocabulary_file, "r") as f:
+    return [line.rstrip("\n") for line in f]
+
+
+def _pca_file():
+  return os.path.join(FLAGS.output_path, sparse_pca.PCA_FILE)
+
+
+def _read_pca():
+  with tf.gfile.Open(_pca_file(), "rb") as f:
+    return sparse_pca.load_pca(f)
+
+
+def _project(measurements):
+  """Project a batch of measurements on the principal components.
+
+  The projection is part of the graph, so the exported model applies it too.
+
+  Args:
+    measurements: sparse tensor of shape [batch size, vocabulary size]
+  Returns:
+    A dense tensor of shape [batch size, number of components].
+  """
+  pca = _read_pca()
+  components = tf.constant(pca.components.T)
+  offset = tf.constant(pca.mean.dot(pca.components.T))
+  return tf.sparse_tensor_dense_matmul(measurements, components) - offset
+
+
+def _read_batches_fn(vocabulary, num_samples=None):
+  """Create a function reading batches of the input outside of the graph.
+
+  Args:
+    vocabulary: list of the measurement names of the columns
+    num_samples: if set, the number of samples to read, chosen at random
+      among all the input files or cells of the cell store
+  Returns:
+    A function returning an iterable of CSR matrices of samples by the
+    vocabulary, the same ones each time it is called.
+  """
+  if FLAGS.input_cell_store:
+    store = cell_store.CellStore(FLAGS.input_cell_store)
+    columns = store.gene_columns(vocabulary)
+    cells = np.arange(store.num_cells)
+    if num_samples is not None:
+      cells = np.sort(np.random.RandomState(0).choice(
+          store.num_cells, min(num_samples, store.num_cells), replace=False))
+
+    def read_batches():
+      for begin in range(0, len(cells), READ_BATCH_SIZE):
+        yield store.select_genes(
+            store.take(cells[begin:begin + READ_BATCH_SIZE]), columns,
+            len(vocabulary))
+  elif num_samples is not None:
+    input_files, _, num_records = example_shards.list_examples_files(
+        FLAGS.input_file_pattern)
+    sample = example_shards.sample_examples(
+        input_files, vocabulary, num_samples, np.random.RandomState(0),
+        FLAGS.use_measurement_indices, num_records)
+
+    def read_batches():
+      for begin in range(0, sample.shape[0], READ_BATCH_SIZE):
+        yield sample[begin:begin + READ_BATCH_SIZE]
+  else:
+    input_files, _, _ = example_shards.list_examples_files(
+        FLAGS.input_file_pattern)
+
+    def read_batches():
+      for _, batch in example_shards.read_example_batches(
+          input_files, vocabulary, READ_BATCH_SIZE,
+          FLAGS.use_measurement_indices):
+        yield batch
+
+  return read_batches
+
+
+def _fit_pca():
+  """Compute the principal components of the input and save them.
+
+  The components are computed from --pca_num_samples samples chosen at random
+  among all the input files or cells of the cell store.
+  """
+  vocabulary = _read_vocabulary()
+  read_batches = _read_batches_fn(vocabulary, FLAGS.pca_num_samples)
+  tf.logging.info("Computing %d principal components of %d samples",
+                  FLAGS.num_pca_components, FLAGS.pca_num_samples)
+  pca = sparse_pca.fit_pca(read_batches, FLAGS.num_pca_components,
+                           len(vocabulary))
+  tf.logging.info("Variance along the principal components: %s",
+                  pca.explained_variance)
+  tf.gfile.MakeDirs(FLAGS.output_path)
+  with tf.gfile.Open(_pca_file(), "wb") as f:
+    sparse_pca.save_pca(f, pca)
+  # Initial clusters chosen among projections on other components are stale.
+  if tf.gfile.Exists(_initial_clusters_file()):
+    tf.gfile.Remove(_initial_clusters_file())
+
+
+def _fit_pca_unless_saved():
+  """Compute the principal components unless saved ones match the flags.
+
+  The saved components are reused only if there are --num_pca_components of
+  them, of the size of the vocabulary.
+  """
+  if tf.gfile.Exists(_pca_file()):
+    shape = _read_pca().components.shape
+    if shape == (FLAGS.num_pca_components, len(_read_vocabulary())):
+      return
+    tf.logging.warning("Computing the principal components again, since %s "
+                       "holds %d components of dimension %d.", _pca_file(),
+                       shape[0], shape[1])
+  _fit_pca()
+
+
+def _initial_clusters_file():
+  return os.path.join(FLAGS.output_path, INITIAL_CLUSTERS_FILE)
+
+
+def _kmeans_parallel_clusters():
+  """Choose the initial clusters among all the input with k-means||.
+
+  The clusters are saved with the distance they were chosen for, and reused
+  when training is restarted with the same number of clusters, dimension and
+  distance.
+
+  Returns:
+    An array of the initial clusters, of the projections on the principal
+    components if clustering them.
+  """
+  vocabulary = _read_vocabulary()
+  shape = (FLAGS.num_clusters, FLAGS.num_pca_components or len(vocabulary))
+  clusters_file = _initial_clusters_file()
+  if tf.gfile.Exists(clusters_file):
+    with tf.gfile.Open(clusters_file, "rb") as f:
+      saved = np.load(io.BytesIO(f.read()))
+    if (saved["clusters"].shape == shape and
+        bool(saved["use_cosine_distance"]) == FLAGS.use_cosine_distance):
+      return saved["clusters"]
+    tf.logging.warning("Ignoring the initial clusters in %s, which were "
+                       "chosen for another number of clusters, dimension or "
+                       "distance.", clusters_file)
+
+  read_input_batches = _read_batches_fn(vocabulary)
+  read_batches = read_input_batches
+  if FLAGS.num_pca_components:
+    pca = _read_pca()
+
+    def read_batches():
+      for batch in read_input_batches():
+        yield sparse_pca.transform(pca, batch)
+
+  tf.logging.info("Choosing %d initial clusters with k-means||",
+                  FLAGS.num_clusters)
+  with contextlib.closing(ThreadPool(FLAGS.num_threads or None)) as pool:
+    clusters = local_kmeans.kmeans_parallel(
+        read_batches, FLAGS.num_clusters, np.random.RandomState(0),
+        FLAGS.use_cosine_distance, pool).astype(np.float32)
+  tf.gfile.MakeDirs(FLAGS.output_path)
+  buf = io.BytesIO()
+  np.savez(buf, clusters=clusters,
+           use_cosine_distance=FLAGS.use_cosine_distance)
+  with tf.gfile.Open(clusters_file, "wb") as f:
+    f.write(buf.getvalue())
+  return clusters
+
+
+def _cell_store_input_fn():
+  """Supplies random batches of cells from a cell store to the model.
+
+  The batches are read directly from the memory-mapped store, so there is no
+  decompression or parsing.
+
+  Returns:
+    A tuple consisting of 1) a dense tensor of measurements, and 2) a tensor
+    of target labels which for clustering must be 'None'.
+  """
+  store = cell_store.CellStore(FLAGS.input_cell_store)
+  vocabulary = _read_vocabulary()
+  columns = store.gene_columns(vocabulary)
+  tf.logging.info("Reading %d cells from %s", store.num_cells,
+                  FLAGS.input_cell_store)
+
+  pca = _read_pca() if FLAGS.num_pca_components else None
+
+  def sample_batch():
+    cells = store.take(np.random.randint(0, store.num_cells,
+                                         size=FLAGS.batch_size))
+    batch = store.select_genes(cells, columns, len(vocabulary))
+    if pca is not None:
+      return sparse_pca.transform(pca, batch)
+    return batch.toarray().astype(np.float32)
+
+  dense = tf.py_func(sample_batch, [], tf.float32, stateful=True)
+  dense.set_shape([FLAGS.batch_size,
+                   FLAGS.num_pca_components or len(vocabulary)])
+
+  return dense, None
+
+
+def _parse_batch(serialized):
+  """Parse a batch of serialized tf.Example protos.
+
+  Args:
+    serialized: string tensor of a batch of serialized tf.Example protos
+  Returns:
+    The batch of measurements of the model if they are stored as indices, or
+    else the parsed features in sparse matrix format.
+  """
+  raw_features = tf.parse_example(serialized, _get_feature_columns())
+  if FLAGS.use_measurement_indices:
+    return _raw_features_to_model_input(raw_features)
+  # The lookup table of measurement names cannot be used by the parallel
+  # calls of the input pipeline, so the names are looked up afterwards.
+  return raw_features
+
+
+def _input_fn(use_cache=False):
   """Supplies the training input to the model.
 
+  The files are read in parallel and shuffled, and each batch of examples is
+  parsed at once, in parallel with the parsing of other batches and with
+  training.
+
+  Args:
+    use_cache: whether to cache the parsed batches of the first pass over the
+      files and to repeat shuffled batches of the cache, instead of repeating
+      the files.
+
   Returns:
     A tuple consisting of 1) a dictionary of tensors whose keys are
     the feature names, and 2) a tensor of target labels which for
@@ -110,24 +463,48 @@ def _input_fn():
   """
 
   tf.logging.info("Reading files from %s", FLAGS.input_file_pattern)
-  input_files = sorted(list(tf.gfile.Glob(FLAGS.input_file_pattern)))
+  # Uncompressed shards may be written by preprocess_measurements, along with
+  # shards.json describing them.
+  input_files, compression_type, num_records = (
+      example_shards.list_examples_files(FLAGS.input_file_pattern))
   tf.logging.info("Reading files %s", input_files)
-
-  def gzip_reader():
-    return tf.TFRecordReader(options=tf.python_io.TFRecordOptions(
-        compression_type=TFRecordCompressionType.GZIP))
-
-  raw_features = tf.contrib.learn.io.read_batch_features(
-      file_pattern=input_files,
-      batch_size=FLAGS.batch_size,
-      queue_capacity = QUEUE_CAPACITY_MULTIPLIER * FLAGS.batch_size,
-      randomize_input=True,
-      reader=gzip_reader,
-      features=_get_feature_columns())
-
-  dense = _raw_features_to_dense_tensor(raw_features)
-
-  return dense, None
+  if num_records is not None:
+    tf.logging.info("Each epoch holds %d examples, %d batches", num_records,
+                    -(-num_records // FLAGS.batch_size))
+
+  dataset = tf.data.Dataset.from_tensor_slices(input_files).shuffle(
+      len(input_files))
+  if not use_cache:
+    dataset = dataset.repeat()
+  dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+      lambda input_file: tf.data.TFRecordDataset(
+          input_file, compression_type=compression_type),
+      cycle_length=min(FLAGS.num_parallel_reads, len(input_files)),
+      sloppy=True))
+  if FLAGS.shuffle_buffer_size:
+    dataset = dataset.shuffle(FLAGS.shuffle_buffer_size)
+  dataset = dataset.batch(FLAGS.batch_size)
+  dataset = dataset.map(_parse_batch,
+                        num_parallel_calls=FLAGS.num_parallel_calls)
+  if use_cache:
+    tf.logging.info("Caching parsed batches in %s",
+                    FLAGS.cache_path or "memory")
+    dataset = dataset.cache(FLAGS.cache_path)
+    # The examples of each batch are fixed by the first pass, so the batches
+    # are shuffled instead.
+    if FLAGS.shuffle_buffer_size:
+      dataset = dataset.shuffle(
+          max(1, FLAGS.shuffle_buffer_size // FLAGS.batch_size))
+    dataset = dataset.repeat()
+  dataset = dataset.prefetch(FLAGS.prefetch_buffer_size)
+
+  features = dataset.make_one_shot_iterator().get_next()
+  if FLAGS.use_measurement_indices:
+    measurements = features
+  else:
+    measurements = _raw_features_to_model_input(features)
+
+  return measurements, None
 
 
 def _predict_input_fn():
@@ -144,14 +521,111 @@ def _predict_input_fn():
 
   raw_features = tf.parse_example(examples, _get_feature_columns())
 
-  dense = _raw_features_to_dense_tensor(raw_features)
+  measurements = _raw_features_to_model_input(raw_features)
+  if isinstance(measurements, tf.SparseTensor):
+    features = {SPARSE_KEY: measurements}
+  else:
+    features = {DENSE_KEY: measurements}
 
   return input_fn_utils.InputFnOps(
-      features={DENSE_KEY: dense},
+      features=features,
       labels=None,
       default_inputs={EXAMPLE_KEY: examples})
 
 
+def _read_local_matrix(vocabulary):
+  """Read all the samples into memory.
+
+  Args:
+    vocabulary: list of the measurement names of the columns
+  Returns:
+    A CSR matrix of the samples by the vocabulary.
+  """
+  if FLAGS.input_cell_store:
+    store = cell_store.CellStore(FLAGS.input_cell_store)
+    return store.select_genes(store.cells(0, store.num_cells),
+                              store.gene_columns(vocabulary), len(vocabulary))
+  input_files, _, _ = example_shards.list_examples_files(
+      FLAGS.input_file_pattern)
+  return sp_sparse.vstack([
+      batch for _, batch in example_shards.read_example_batches(
+          input_files, vocabulary, READ_BATCH_SIZE,
+          FLAGS.use_measurement_indices)
+  ]).tocsr()
+
+
+def _train_local():
+  """Train with the local engine and save the clusters to the output path."""
+  vocabulary = _read_vocabulary()
+  matrix = _read_local_matrix(vocabulary)
+  tf.logging.info("Read %d samples with %d nonzero values", matrix.shape[0],
+                  matrix.nnz)
+  pca = None
+  if FLAGS.num_pca_components:
+    _fit_pca_unless_saved()
+    pca = _read_pca()
+    matrix = sparse_pca.transform(pca, matrix)
+
+  models = [
+      local_kmeans.MiniBatchKMeans(
+          num_clusters,
+          use_cosine_distance=FLAGS.use_cosine_distance,
+          use_kmeans_plus_plus=FLAGS.use_kmeans_plus_plus,
+          relative_tolerance=FLAGS.relative_tolerance,
+          batch_size=FLAGS.batch_size,
+          seed=seed)
+      for num_clusters in _num_clusters_list()
+      for seed in range(FLAGS.num_initializations)
+  ]
+  if FLAGS.use_kmeans_parallel:
+    # The passes over the samples are shared by all the models: candidates
+    # sampled for the largest number of clusters are reduced for each model.
+    with contextlib.closing(ThreadPool(FLAGS.num_threads or None)) as pool:
+      candidates, weights = local_kmeans.kmeans_parallel_candidates(
+          lambda: [matrix[begin:begin + READ_BATCH_SIZE]
+                   for begin in range(0, matrix.shape[0], READ_BATCH_SIZE)],
+          max(_num_clusters_list()), np.random.RandomState(0),
+          FLAGS.use_cosine_distance, pool)
+    for kmeans in models:
+      kmeans.initialize_from_candidates(candidates, weights)
+  local_kmeans.fit_models(models, matrix, FLAGS.num_train_steps,
+                          FLAGS.num_threads or None)
+  best_models = local_kmeans.select_best_models(models, matrix,
+                                                FLAGS.num_threads or None)
+
+  if not FLAGS.num_clusters_sweep:
+    kmeans, _ = best_models[0]
+    _save_centroids(FLAGS.output_path, kmeans, vocabulary, pca)
+    return
+
+  summary = ["num_clusters,inertia,num_steps,converged\n"]
+  for kmeans, inertia in best_models:
+    summary.append("%d,%r,%d,%s\n" % (kmeans.num_clusters, inertia,
+                                       kmeans.num_steps, kmeans.converged))
+    _save_centroids(os.path.join(FLAGS.output_path,
+                                 "k_%d" % kmeans.num_clusters),
+                    kmeans, vocabulary, pca)
+  with tf.gfile.Open(os.path.join(FLAGS.output_path, SWEEP_FILE), "w") as f:
+    f.write("".join(summary))
+
+
+def _num_clusters_list():
+  if FLAGS.num_clusters_sweep:
+    return [int(num_clusters) for num_clusters in FLAGS.num_clusters_sweep]
+  return [FLAGS.num_clusters]
+
+
+def _save_centroids(output_dir, kmeans, vocabulary, pca):
+  """Save the clusters of a local model for predict_clusters."""
+  centroids_file = os.path.join(output_dir, local_kmeans.CENTROIDS_FILE)
+  tf.logging.info("Writing the clusters to %s", centroids_file)
+  tf.gfile.MakeDirs(output_dir)
+  with tf.gfile.Open(centroids_file, "wb") as f:
+    local_kmeans.save_centroids(f, local_kmeans.Centroids(
+        kmeans.clusters, FLAGS.use_cosine_distance, vocabulary,
+        FLAGS.use_measurement_indices, pca))
+
+
 def create_experiment_fn(output_dir=None):
   """Experiment function."""
   distance_metric = (tf.contrib.factorization.COSINE_DISTANCE
@@ -161,16 +635,42 @@ def create_experiment_fn(output_dir=None):
                       if FLAGS.use_kmeans_plus_plus
                       else tf.contrib.factorization.RANDOM_INIT)
 
+  if FLAGS.num_pca_components:
+    _fit_pca_unless_saved()
+
+  if FLAGS.use_kmeans_parallel:
+    initial_clusters = _kmeans_parallel_clusters()
+
+  config = tf.contrib.learn.RunConfig(
+      save_checkpoints_secs=FLAGS.save_checkpoints_secs)
+
   # Create estimator
-  kmeans = kmeans_lib.KMeansClustering(
-      FLAGS.num_clusters,
-      model_dir=output_dir,
-      initial_clusters=initial_clusters,
-      distance_metric=distance_metric,
-      use_mini_batch=True,
-      relative_tolerance=FLAGS.relative_tolerance,
-      config=tf.contrib.learn.RunConfig(
-          save_checkpoints_secs=FLAGS.save_checkpoints_secs))
+  if FLAGS.use_sparse_kmeans:
+    kmeans = sparse_kmeans.SparseKMeansClustering(
+        FLAGS.num_clusters,
+        FLAGS.num_pca_components or len(_read_vocabulary()),
+        model_dir=output_dir,
+        use_cosine_distance=FLAGS.use_cosine_distance,
+        relative_tolerance=FLAGS.relative_tolerance,
+        initial_clusters=(initial_clusters if FLAGS.use_kmeans_parallel
+                          else None),
+        config=config)
+  else:
+    kmeans = kmeans_lib.KMeansClustering(
+        FLAGS.num_clusters,
+        model_dir=output_dir,
+        initial_clusters=initial_clusters,
+        distance_metric=distance_metric,
+        use_mini_batch=True,
+        relative_tolerance=FLAGS.relative_tolerance,
+        config=config)
+
+  eval_input_fn = (_cell_store_input_fn if FLAGS.input_cell_store
+                   else _input_fn)
+  # Evaluation reads the files rather than a cache that may be incomplete.
+  train_input_fn = eval_input_fn
+  if FLAGS.cache_training_data and not FLAGS.input_cell_store:
+    train_input_fn = functools.partial(_input_fn, use_cache=True)
 
   train_monitors = []
   if FLAGS.debug:
@@ -180,8 +680,8 @@ def create_experiment_fn(output_dir=None):
       estimator=kmeans,
       train_steps=FLAGS.num_train_steps,
       eval_steps=1,
-      eval_input_fn=_input_fn,
-      train_input_fn=_input_fn,
+      eval_input_fn=eval_input_fn,
+      train_input_fn=train_input_fn,
       train_monitors=train_monitors,
       export_strategies=[saved_model_export_utils.make_export_strategy(
           _predict_input_fn,
@@ -190,8 +690,8 @@ def create_experiment_fn(output_dir=None):
 
 
 def main(unused_argv):
-  if not FLAGS.input_file_pattern:
-    raise ValueError("Input file pattern should be specified.")
+  if not FLAGS.input_file_pattern and not FLAGS.input_cell_store:
+    raise ValueError("Input file pattern or cell store should be specified.")
 
   if not FLAGS.vocabulary_file:
     raise ValueError("Vocabulary file should be specified.")
@@ -199,15 +699,35 @@ def main(unused_argv):
   if not FLAGS.output_path:
     raise ValueError("Output path should be specified.")
 
-  if not FLAGS.num_clusters:
+  if not FLAGS.num_clusters and not FLAGS.num_clusters_sweep:
     raise ValueError("Number of classes should be specified.")
 
-  if FLAGS.num_clusters > FLAGS.batch_size:
+  if FLAGS.num_clusters_sweep and FLAGS.engine != "local":
+    raise ValueError("A sweep of the number of classes requires the local "
+                     "engine.")
+
+  if FLAGS.num_initializations > 1 and FLAGS.engine != "local":
+    raise ValueError("Multiple initializations require the local engine.")
+
+  if FLAGS.use_sparse_kmeans and FLAGS.use_kmeans_plus_plus:
+    raise ValueError("Sparse k-means does not support kmeans++ "
+                     "initialization.")
+
+  if FLAGS.use_kmeans_plus_plus and FLAGS.use_kmeans_parallel:
+    raise ValueError("Only one of kmeans++ and k-means|| initialization "
+                     "should be specified.")
+
+  # Without k-means||, the initial clusters are chosen among the first batch.
+  if (not FLAGS.use_kmeans_parallel and
+      max(_num_clusters_list()) > FLAGS.batch_size):
     raise ValueError("Number of classes should be less than "
                      "or equal to the batch size.")
 
-  learn_runner.run(experiment_fn=create_experiment_fn,
-                   output_dir=FLAGS.output_path)
+  if FLAGS.engine == "local":
+    _train_local()
+  else:
+    learn_runner.run(experiment_fn=create_experiment_fn,
+                     output_dir=FLAGS.output_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test the input and the initialization of the clustering trainer."""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from trainer import cluster_measurements
+from trainer import example_shards
+from trainer.shared_constants import MEASUREMENTS_FEATURE
+from trainer.shared_constants import SAMPLE_NAME_FEATURE
+from trainer.shared_constants import VALUES_FEATURE
+
+FLAGS = cluster_measurements.FLAGS
+
+VOCABULARY = ['Glul', 'Prkca', 'Rho']
+NUM_SHARDS = 2
+NUM_SAMPLES = 20
+
+
+def sample_values(i):
+  """The measurements of the i-th test sample, by the vocabulary."""
+  return [i + 1.0, i % 3 + 1.0, float(i % 5)]
+
+
+def make_example(sample, values):
+  example = tf.train.Example()
+  feature = example.features.feature
+  feature[SAMPLE_NAME_FEATURE].bytes_list.value.append(sample.encode())
+  for name, value in zip(VOCABULARY, values):
+    if value:
+      feature[MEASUREMENTS_FEATURE].bytes_list.value.append(name.encode())
+      feature[VALUES_FEATURE].float_list.value.append(value)
+  return example.SerializeToString()
+
+
+def sorted_rows(batches):
+  return sorted(row.tolist() for batch in batches for row in batch)
+
+
+class ClusterMeasurementsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    vocabulary_file = os.path.join(self.path, 'vocabulary.txt')
+    with open(vocabulary_file, 'w') as f:
+      f.write('\n'.join(VOCABULARY) + '\n')
+    for shard in range(NUM_SHARDS):
+      shard_file = os.path.join(self.path, example_shards.shard_file_name(
+          shard, NUM_SHARDS, compressed=False))
+      with tf.python_io.TFRecordWriter(shard_file) as writer:
+        for i in range(shard, NUM_SAMPLES, NUM_SHARDS):
+          writer.write(make_example('cell%d' % i, sample_values(i)))
+
+    FLAGS(['cluster_measurements_test'])
+    FLAGS.vocabulary_file = vocabulary_file
+    FLAGS.input_file_pattern = os.path.join(self.path, 'examples*')
+    FLAGS.output_path = os.path.join(self.path, 'output')
+
+  def tearDown(self):
+    FLAGS.unparse_flags()
+    shutil.rmtree(self.path)
+
+  def read_input_batches(self, num_batches, use_cache=False):
+    with tf.Graph().as_default():
+      measurements, _ = cluster_measurements._input_fn(use_cache=use_cache)
+      with tf.Session() as session:
+        session.run(tf.tables_initializer())
+        return [session.run(measurements) for _ in range(num_batches)]
+
+  def read_input_epochs(self, use_cache=False):
+    """Read two epochs of the shards, one at a time without shuffling."""
+    FLAGS.batch_size = 5
+    FLAGS.shuffle_buffer_size = 0
+    FLAGS.num_parallel_reads = 1
+    batches = self.read_input_batches(8, use_cache)
+    self.assertEqual([(5, len(VOCABULARY))] * 8,
+                     [batch.shape for batch in batches])
+    return batches[:4], batches[4:]
+
+  def test_input_fn(self):
+    expected = sorted(sample_values(i) for i in range(NUM_SAMPLES))
+    for epoch in self.read_input_epochs():
+      self.assertEqual(expected, sorted_rows(epoch))
+
+  def test_input_fn_cache(self):
+    uncached = self.read_input_epochs()
+    for cache_path in ['', os.path.join(self.path, 'cache')]:
+      FLAGS.cache_path = cache_path
+      first, second = self.read_input_epochs(use_cache=True)
+      self.assertEqual(sorted_rows(uncached[0]), sorted_rows(first))
+      # The cached batches of the first epoch are repeated.
+      for batch, repeated in zip(first, second):
+        np.testing.assert_array_equal(batch, repeated)
+
+  def test_kmeans_parallel_clusters(self):
+    FLAGS.num_clusters = 2
+    clusters = cluster_measurements._kmeans_parallel_clusters()
+    self.assertEqual((2, len(VOCABULARY)), clusters.shape)
+
+    # Saved clusters chosen for the same flags are reused.
+    clusters_file = os.path.join(FLAGS.output_path,
+                                 cluster_measurements.INITIAL_CLUSTERS_FILE)
+    saved = np.ones((2, len(VOCABULARY)), dtype=np.float32)
+    with open(clusters_file, 'wb') as f:
+      np.savez(f, clusters=saved, use_cosine_distance=False)
+    np.testing.assert_array_equal(
+        saved, cluster_measurements._kmeans_parallel_clusters())
+
+    # They are chosen again for another number of clusters or distance.
+    FLAGS.num_clusters = 3
+    self.assertEqual((3, len(VOCABULARY)),
+                     cluster_measurements._kmeans_parallel_clusters().shape)
+    FLAGS.use_cosine_distance = True
+    cluster_measurements._kmeans_parallel_clusters()
+    with open(clusters_file, 'rb') as f:
+      self.assertTrue(np.load(io.BytesIO(f.read()))['use_cosine_distance'])
+
+  def test_pca_samples_all_files(self):
+    read_batches = cluster_measurements._read_batches_fn(VOCABULARY, 6)
+    sample = np.vstack([batch.toarray() for batch in read_batches()])
+    self.assertEqual((6, len(VOCABULARY)), sample.shape)
+    np.testing.assert_array_equal(
+        sample, np.vstack([batch.toarray() for batch in read_batches()]))
+    # Samples are drawn from both shards, which hold odd and even samples.
+    self.assertEqual(set([0, 1]), set(int(row[0] - 1) % 2 for row in sample))
+
+  def test_fit_pca_unless_saved(self):
+    FLAGS.num_pca_components = 2
+    FLAGS.pca_num_samples = NUM_SAMPLES
+    cluster_measurements._fit_pca_unless_saved()
+    self.assertEqual((2, len(VOCABULARY)),
+                     cluster_measurements._read_pca().components.shape)
+    FLAGS.num_pca_components = 1
+    cluster_measurements._fit_pca_unless_saved()
+    self.assertEqual((1, len(VOCABULARY)),
+                     cluster_measurements._read_pca().components.shape)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,288 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Describe and read balanced shards of tf.Example protos.
+
+When preprocess_measurements is given a number of shards or a target shard
+size, it writes alongside the examples:
+
+* for each shard, a tab-separated index file holding, for each record, the
+  sample name, the offset of the record in the uncompressed TFRecord stream,
+  the length of the serialized example, its number of nonzero measurements
+  and the sum of its values
+* shards.json, holding the compression type, the total number of records and
+  values, and the file names, record counts, value counts and uncompressed
+  sizes of the shards
+
+Readers can use these to balance shards over parallel readers, count the
+records of an epoch exactly, and read the example of a single sample from an
+uncompressed shard without scanning it.
+
+Any examples files can also be read outside of a TensorFlow graph as batches
+of sparse rows, for fitting models with NumPy and SciPy.
+"""
+
+import collections
+import fnmatch
+import itertools
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp_sparse
+import tensorflow as tf
+
+from trainer.shared_constants import MEASUREMENT_INDICES_FEATURE
+from trainer.shared_constants import MEASUREMENTS_FEATURE
+from trainer.shared_constants import SAMPLE_NAME_FEATURE
+from trainer.shared_constants import VALUES_FEATURE
+
+SHARDS_FILE = 'shards.json'
+INDEX_COLUMNS = ['sample', 'offset', 'length', 'nnz', 'total']
+
+# Each TFRecord is framed by its length, a checksum of the length and a
+# checksum of the data.
+RECORD_HEADER_BYTES = 12
+RECORD_OVERHEAD_BYTES = 16
+
+# The number of examples parsed at a time by sample_examples.
+PARSE_BATCH_SIZE = 1000
+
+IndexEntry = collections.namedtuple('IndexEntry', INDEX_COLUMNS)
+
+
+def shard_file_name(shard, num_shards, compressed=True):
+  """The file name of a shard of examples."""
+  return 'examples-%05d-of-%05d%s' % (
+      shard, num_shards, '.tfrecord.gz' if compressed else '.tfrecord')
+
+
+def index_file_name(shard, num_shards):
+  """The file name of the index of a shard of examples.
+
+  Index files do not start with 'examples', so that they are not matched by
+  the file patterns of the examples.
+  """
+  return 'index-%05d-of-%05d.tsv' % (shard, num_shards)
+
+
+def format_index_entry(entry):
+  """Format an IndexEntry as a line of a shard index file."""
+  return '%s\t%d\t%d\t%d\t%r\n' % entry
+
+
+def read_shards_manifest(examples_dir):
+  """Read the description of the shards in a directory of examples.
+
+  Args:
+    examples_dir: the directory holding the examples and shards.json
+
+  Returns:
+    The dictionary in shards.json, or None if there is none.
+  """
+  path = os.path.join(examples_dir, SHARDS_FILE)
+  if not tf.gfile.Exists(path):
+    return None
+  with tf.gfile.Open(path, 'r') as f:
+    return json.load(f)
+
+
+def list_examples_files(file_pattern):
+  """List the examples files matching a pattern, checked against shards.json.
+
+  When the directory of the pattern holds shards.json, only the shards it
+  describes are listed, so that files left by an earlier run with another
+  number of shards are not read, and a missing shard is an error.
+
+  Args:
+    file_pattern: file pattern of the examples
+
+  Returns:
+    A tuple of the sorted list of paths of the files, the compression type of
+    the files for tf.data, "GZIP" or "", and the number of records in the files
+    or None if there is no shards.json.
+
+  Raises:
+    ValueError: if a shard described in shards.json is missing.
+  """
+  input_files = sorted(tf.gfile.Glob(file_pattern))
+  examples_dir = os.path.dirname(file_pattern)
+  manifest = None
+  if not any(c in examples_dir for c in '*?['):
+    manifest = read_shards_manifest(examples_dir)
+  if manifest is None:
+    compressed = input_files and all(input_file.endswith('.gz')
+                                     for input_file in input_files)
+    return input_files, 'GZIP' if compressed else '', None
+
+  shards = [shard for shard in manifest['shards']
+            if fnmatch.fnmatch(os.path.join(examples_dir, shard['file']),
+                               file_pattern)]
+  shard_files = [os.path.join(examples_dir, shard['file']) for shard in shards]
+  missing = sorted(set(shard_files) - set(input_files))
+  if missing:
+    raise ValueError('Shards described in %s are missing: %s' % (
+        os.path.join(examples_dir, SHARDS_FILE), ', '.join(missing)))
+  ignored = sorted(set(input_files) - set(shard_files))
+  if ignored:
+    tf.logging.warning('Ignoring files not described in %s: %s',
+                       SHARDS_FILE, ', '.join(ignored))
+  compression_type = 'GZIP' if manifest['compression'] == 'GZIP' else ''
+  return (shard_files, compression_type,
+          sum(shard['num_records'] for shard in shards))
+
+
+def read_shard_index(index_file):
+  """Read the index of a shard.
+
+  Args:
+    index_file: path of the tab-separated index file of the shard
+
+  Returns:
+    A list of IndexEntry, in the order of the records in the shard.
+  """
+  with tf.gfile.Open(index_file, 'r') as f:
+    f.readline()
+    entries = []
+    for line in f:
+      sample, offset, length, nnz, total = line.rstrip('\n').split('\t')
+      entries.append(IndexEntry(sample, int(offset), int(length), int(nnz),
+                                float(total)))
+  return entries
+
+
+def read_record(shard_file, entry):
+  """Read a single serialized example from an uncompressed shard.
+
+  Args:
+    shard_file: path of the uncompressed TFRecord file
+    entry: IndexEntry of the record
+
+  Returns:
+    The serialized tf.Example proto.
+  """
+  with tf.gfile.Open(shard_file, 'rb') as f:
+    f.seek(entry.offset + RECORD_HEADER_BYTES)
+    return f.read(entry.length)
+
+
+def read_records(input_files):
+  """Read the serialized examples of gzipped or uncompressed TFRecord files."""
+  for input_file in input_files:
+    options = None
+    if input_file.endswith('.gz'):
+      options = tf.python_io.TFRecordOptions(
+          tf.python_io.TFRecordCompressionType.GZIP)
+    for record in tf.python_io.tf_record_iterator(input_file, options=options):
+      yield record
+
+
+def example_to_row(record, positions, use_measurement_indices=False):
+  """Parse a serialized example into a sparse row.
+
+  Args:
+    record: serialized tf.Example proto
+    positions: dictionary of the column of each measurement name, used unless
+      use_measurement_indices
+    use_measurement_indices: whether the example holds vocabulary indices
+      instead of measurement names
+
+  Returns:
+    A tuple of the sample name, and arrays of the columns and the values of
+    the measurements. Measurements absent from positions are dropped.
+  """
+  feature = tf.train.Example.FromString(record).features.feature
+  values = np.array(feature[VALUES_FEATURE].float_list.value, dtype=np.float32)
+  if use_measurement_indices:
+    columns = np.array(feature[MEASUREMENT_INDICES_FEATURE].int64_list.value,
+                       dtype=np.int64)
+  else:
+    columns = np.array([positions.get(name, -1) for name
+                        in feature[MEASUREMENTS_FEATURE].bytes_list.value],
+                       dtype=np.int64)
+  keep = columns >= 0
+  return (feature[SAMPLE_NAME_FEATURE].bytes_list.value[0], columns[keep],
+          values[keep])
+
+
+def _record_batches(records, vocabulary, batch_size,
+                    use_measurement_indices=False):
+  """Parse serialized examples into batches of sparse rows.
+
+  See read_example_batches.
+  """
+  positions = dict((name, i) for i, name in enumerate(vocabulary))
+  records = iter(records)
+  while True:
+    samples, indices, values, indptr = [], [], [], [0]
+    for record in itertools.islice(records, batch_size):
+      sample, row_indices, row_values = example_to_row(
+          record, positions, use_measurement_indices)
+      samples.append(sample)
+      indices.append(row_indices)
+      values.append(row_values)
+      indptr.append(indptr[-1] + len(row_indices))
+    if not samples:
+      return
+    yield samples, sp_sparse.csr_matrix(
+        (np.concatenate(values), np.concatenate(indices), indptr),
+        shape=(len(samples), len(vocabulary)))
+
+
+def read_example_batches(input_files, vocabulary, batch_size,
+                         use_measurement_indices=False, max_examples=None):
+  """Read examples as batches of sparse rows.
+
+  Args:
+    input_files: list of paths of TFRecord files of tf.Example protos
+    vocabulary: list of the measurement names of the columns
+    batch_size: the number of examples in each batch
+    use_measurement_indices: whether the examples hold vocabulary indices
+      instead of measurement names
+    max_examples: if set, the number of examples to read
+
+  Returns:
+    An iterator of tuples of the list of sample names and a CSR matrix of the
+    batch of examples by the vocabulary. Measurements absent from the
+    vocabulary are dropped.
+  """
+  return _record_batches(
+      itertools.islice(read_records(input_files), max_examples), vocabulary,
+      batch_size, use_measurement_indices)
+
+
+def sample_examples(input_files, vocabulary, num_examples, random,
+                    use_measurement_indices=False, num_records=None):
+  """Read a uniform random sample of the examples of all the files.
+
+  Files are often written in the order of the samples of their source, so the
+  first examples of the files are not a representative sample. Only the
+  chosen examples are parsed.
+
+  Args:
+    input_files: list of paths of TFRecord files of tf.Example protos
+    vocabulary: list of the measurement names of the columns
+    num_examples: the number of examples to sample, or all of them if there
+      are fewer
+    random: numpy RandomState
+    use_measurement_indices: whether the examples hold vocabulary indices
+      instead of measurement names
+    num_records: the number of records in the files, such as from
+      shards.json, or None to count them in an additional pass
+
+  Returns:
+    A CSR matrix of the sampled examples by the vocabulary, in the order of
+    the files.
+  """
+  if num_records is None:
+    num_records = sum(1 for _ in read_records(input_files))
+  chosen = np.zeros(num_records, dtype=bool)
+  chosen[random.choice(num_records, min(num_examples, num_records),
+                       replace=False)] = True
+  batches = [batch for _, batch in _record_batches(
+      itertools.compress(read_records(input_files), chosen.tolist()),
+      vocabulary, PARSE_BATCH_SIZE, use_measurement_indices)]
+  if not batches:
+    return sp_sparse.csr_matrix((0, len(vocabulary)), dtype=np.float32)
+  return sp_sparse.vstack(batches).tocsr()
@@ -0,0 +1,80 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test reading of shard index files and single records."""
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from trainer import example_shards
+
+# Test data, serialized examples of two samples.
+RECORDS = [('cell1', b'first example'), ('cell2', b'second, longer example')]
+
+
+class ExampleShardsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.shard_file = os.path.join(
+        self.path, example_shards.shard_file_name(0, 1, compressed=False))
+    offset = 0
+    entries = []
+    with open(self.shard_file, 'wb') as f:
+      for sample, record in RECORDS:
+        # The checksums are not verified when reading single records.
+        f.write(struct.pack('<QI', len(record), 0) + record +
+                struct.pack('<I', 0))
+        entries.append(example_shards.IndexEntry(sample, offset, len(record),
+                                                 1, 2.0))
+        offset += len(record) + example_shards.RECORD_OVERHEAD_BYTES
+    self.index_file = os.path.join(self.path,
+                                   example_shards.index_file_name(0, 1))
+    with open(self.index_file, 'w') as f:
+      f.write('\t'.join(example_shards.INDEX_COLUMNS) + '\n')
+      for entry in entries:
+        f.write(example_shards.format_index_entry(entry))
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_read_shard_index(self):
+    entries = example_shards.read_shard_index(self.index_file)
+    self.assertEqual(['cell1', 'cell2'], [entry.sample for entry in entries])
+    self.assertEqual([0, len(RECORDS[0][1]) + 16],
+                     [entry.offset for entry in entries])
+
+  def test_read_record(self):
+    entries = example_shards.read_shard_index(self.index_file)
+    self.assertEqual(RECORDS[1][1],
+                     example_shards.read_record(self.shard_file, entries[1]))
+    self.assertIsNone(example_shards.read_shards_manifest(self.path))
+
+  def test_list_examples_files(self):
+    pattern = os.path.join(self.path, 'examples*')
+    self.assertEqual(([self.shard_file], '', None),
+                     example_shards.list_examples_files(pattern))
+
+    # A shard of an earlier run with another number of shards is ignored.
+    stale_file = os.path.join(self.path,
+                              example_shards.shard_file_name(0, 2))
+    open(stale_file, 'w').close()
+    with open(os.path.join(self.path, example_shards.SHARDS_FILE), 'w') as f:
+      json.dump({'compression': 'NONE', 'num_records': 2, 'num_values': 2,
+                 'shards': [{'file': os.path.basename(self.shard_file),
+                             'num_records': 2}]}, f)
+    self.assertEqual(([self.shard_file], '', 2),
+                     example_shards.list_examples_files(pattern))
+
+    os.remove(self.shard_file)
+    with self.assertRaises(ValueError):
+      example_shards.list_examples_files(pattern)
+
+
+if __name__ == '__main__':
+  unittest.main()
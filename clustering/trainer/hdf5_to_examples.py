@@ -0,0 +1,258 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Convert a 10X HDF5 matrix directly to sharded tf.Example protos.
+
+The matrix is already grouped by cell in CSC form, so each cell's column slice
+is written as a tf.train.Example without first loading the data into BigQuery
+and grouping it in a Beam pipeline. As with the query used by
+preprocess_measurements, the counts of gene ids sharing a gene name are summed.
+
+read_indptr and compute_shard_boundaries follow data_loading/hdf5_to_sparse.py,
+which is a standalone script rather than part of the trainer package installed
+on Cloud ML Engine workers, so they are repeated here instead of imported.
+"""
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import scipy.sparse as sp_sparse
+import tables
+import tensorflow as tf
+
+from trainer.preprocess_measurements import read_vocabulary
+from trainer.preprocess_measurements import sparse_measurements_to_example
+from trainer.preprocess_measurements import VOCABULARY_FILE
+
+
+def read_lines(filename):
+  """Read a newline-separated file of names, such as a vocabulary file."""
+  with tf.gfile.Open(filename, 'r') as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def read_indptr(input_file, genome):
+  """Load the column pointers of the matrix from the HDF5 file.
+
+  Args:
+    input_file: HDF5 filename
+    genome: Genome of data in the file.
+
+  Returns:
+    The indptr array, with one more entry than there are cells.
+  """
+  with tables.open_file(input_file, 'r') as f:
+    try:
+      return f.get_node('/' + genome, 'indptr').read()
+    except tables.NoSuchNodeError:
+      raise Exception('Genome %s does not exist in %s or is missing indptr.'
+                      % (genome, input_file))
+
+
+def compute_shard_boundaries(indptr, begin_idx, end_idx, num_shards):
+  """Split a range of cells into shards with balanced numbers of nonzeros.
+
+  Args:
+    indptr: the column pointers of the whole matrix
+    begin_idx: Index of the first cell to shard (inclusive).
+    end_idx: Index at which to stop sharding cells (exclusive).
+    num_shards: The desired number of shards.
+
+  Returns:
+    A list of (begin_idx, end_idx) tuples.
+  """
+  end_idx = min(end_idx, len(indptr) - 1)
+  cell_indptr = indptr[begin_idx:end_idx + 1]
+  targets = np.linspace(cell_indptr[0], cell_indptr[-1], num_shards + 1)
+  boundaries = np.searchsorted(cell_indptr, targets[1:-1]) + begin_idx
+  boundaries = np.unique(
+      np.concatenate([[begin_idx], boundaries, [end_idx]])).tolist()
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def cell_block_to_examples(barcodes, matrix, measurements, cells=None,
+                           vocabulary=None):
+  """Convert a block of cells to TensorFlow Example protos.
+
+  Args:
+    barcodes: array of the identifiers of the cells in the block
+    matrix: CSC matrix of measurements by cells, with sorted, unique indices
+    measurements: array of the names of the rows of the matrix
+    cells: optional set of the identifiers of the cells to convert
+    vocabulary: optional dictionary from read_vocabulary. If set, the
+      measurements are stored as sorted vocabulary indices instead of names.
+
+  Yields:
+    A TensorFlow Example proto for each cell having nonzero measurements.
+  """
+  for cell, barcode in enumerate(barcodes.tolist()):
+    first, last = matrix.indptr[cell], matrix.indptr[cell + 1]
+    if first == last or (cells is not None and barcode not in cells):
+      continue
+    yield sparse_measurements_to_example(
+        barcode,
+        measurements[matrix.indices[first:last]].tolist(),
+        matrix.data[first:last].tolist(), vocabulary)
+
+
+def convert_shard(input_file, genome, begin_idx, end_idx, output_file,
+                  chunk_size, genes=None, cells=None, vocabulary=None):
+  """Convert a range of cells to a gzip-compressed TFRecord file.
+
+  Args:
+    input_file: HDF5 filename
+    genome: Genome of data in the file.
+    begin_idx: Index of the first cell to convert (inclusive).
+    end_idx: Index at which to stop converting cells (exclusive).
+    output_file: Path of the TFRecord file to write.
+    chunk_size: Number of cells to read from the input file at a time.
+    genes: optional list of the gene names to keep
+    cells: optional list of the identifiers of the cells to keep
+    vocabulary: optional dictionary from read_vocabulary
+
+  Returns:
+    The number of examples written.
+  """
+  cells = set(cells) if cells is not None else None
+  num_examples = 0
+  options = tf.python_io.TFRecordOptions(
+      tf.python_io.TFRecordCompressionType.GZIP)
+  with tables.open_file(input_file, 'r') as f, tf.python_io.TFRecordWriter(
+      output_file, options=options) as writer:
+    group = f.get_node('/' + genome)
+    measurements, measurement_idx = np.unique(
+        group.gene_names.read().astype(str), return_inverse=True)
+    measurement_idx = measurement_idx.ravel()
+    if genes is not None:
+      keep = np.flatnonzero(np.isin(measurements, genes))
+    indptr = group.indptr[begin_idx:end_idx + 1]
+
+    for block_begin in range(begin_idx, end_idx, chunk_size):
+      block_end = min(block_begin + chunk_size, end_idx)
+      block_indptr = indptr[block_begin - begin_idx:block_end - begin_idx + 1]
+      first, last = block_indptr[0], block_indptr[-1]
+      # Summing duplicates collapses the gene ids sharing a gene name.
+      matrix = sp_sparse.csc_matrix(
+          (group.data[first:last].astype(np.float32),
+           measurement_idx[group.indices[first:last]],
+           block_indptr - first),
+          shape=(len(measurements), block_end - block_begin))
+      matrix.sum_duplicates()
+      block_measurements = measurements
+      if genes is not None:
+        matrix = matrix[keep, :]
+        matrix.sort_indices()
+        block_measurements = measurements[keep]
+      barcodes = group.barcodes[block_begin:block_end].astype(str)
+      for example in cell_block_to_examples(barcodes, matrix,
+                                            block_measurements, cells,
+                                            vocabulary):
+        writer.write(example.SerializeToString())
+        num_examples += 1
+
+  logging.info('Wrote %d examples for cells [%d,%d) to %s', num_examples,
+               begin_idx, end_idx, output_file)
+  return num_examples
+
+
+def _convert_shard(shard_args):
+  return convert_shard(*shard_args)
+
+
+def run(argv=None):
+  """Converts the HDF5 file to sharded, gzip-compressed TFRecord files.
+
+  Args:
+    argv: Command line arguments as a list.
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--input_file', required=True, help='Path to the 10X HDF5 file.')
+  parser.add_argument(
+      '--output',
+      required=True,
+      help='Output directory to which to write results.')
+  parser.add_argument(
+      '--genome', default='mm10', help='Genome of data in the file.')
+  parser.add_argument(
+      '--begin_idx',
+      type=int,
+      default=0,
+      help='Index with which to start reading cells (inclusive).')
+  parser.add_argument(
+      '--end_idx',
+      type=int,
+      default=None,
+      help='Index at which to stop reading cells (exclusive). Defaults to '
+      'the number of cells in the file.')
+  parser.add_argument(
+      '--num_shards',
+      type=int,
+      default=100,
+      help='Number of TFRecord files to write. Each holds about the same '
+      'number of nonzero values.')
+  parser.add_argument(
+      '--num_workers',
+      type=int,
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes.')
+  parser.add_argument(
+      '--chunk_size',
+      type=int,
+      default=1000,
+      help='Number of cells to read from the input file at a time.')
+  parser.add_argument(
+      '--genes_file',
+      help='Optional newline-separated file of the gene names to keep, such '
+      'as the passing genes from quality control.')
+  parser.add_argument(
+      '--cells_file',
+      help='Optional newline-separated file of the cells to keep, such as '
+      'the passing cells from quality control.')
+  parser.add_argument(
+      '--vocabulary_file',
+      help='If set, a newline-separated file of gene names. The genes of '
+      'each example are then stored as sorted int64 indices into it, and a '
+      'copy of it is written with the examples.')
+  args = parser.parse_args(argv)
+
+  output_dir = os.path.join(args.output,
+                            datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+  tf.gfile.MakeDirs(output_dir)
+  genes = read_lines(args.genes_file) if args.genes_file else None
+  cells = read_lines(args.cells_file) if args.cells_file else None
+  vocabulary = None
+  if args.vocabulary_file:
+    vocabulary = read_vocabulary(args.vocabulary_file)
+    tf.gfile.Copy(args.vocabulary_file,
+                  os.path.join(output_dir, VOCABULARY_FILE))
+
+  indptr = read_indptr(args.input_file, args.genome)
+  end_idx = len(indptr) - 1 if args.end_idx is None else args.end_idx
+  shards = compute_shard_boundaries(indptr, args.begin_idx, end_idx,
+                                    args.num_shards)
+  shard_args = [
+      (args.input_file, args.genome, begin_idx, shard_end_idx,
+       os.path.join(output_dir, 'examples-%05d-of-%05d.tfrecord.gz'
+                    % (shard, len(shards))),
+       args.chunk_size, genes, cells, vocabulary)
+      for shard, (begin_idx, shard_end_idx) in enumerate(shards)]
+
+  pool = multiprocessing.Pool(args.num_workers)
+  try:
+    num_examples = sum(pool.map(_convert_shard, shard_args, chunksize=1))
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+  logging.info('Wrote %d examples to %s', num_examples, output_dir)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  run()
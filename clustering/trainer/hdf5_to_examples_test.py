@@ -0,0 +1,84 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test conversion of 10X HDF5 matrices to TensorFlow Example protos."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables
+import tensorflow as tf
+from trainer import hdf5_to_examples
+from trainer import preprocess_measurements as preproc
+
+GENOME = 'mm10'
+
+# Test data, three gene ids of which two share the name Glul, by three cells
+# of which the last has no measurements.
+GENE_NAMES = ['Glul', 'Rho', 'Glul']
+BARCODES = ['cell1', 'cell2', 'cell3']
+DATA = [1, 2, 3, 5]
+INDICES = [0, 1, 2, 1]
+INDPTR = [0, 3, 4, 4]
+
+
+class Hdf5ToExamplesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.input_file = os.path.join(self.path, 'matrix.h5')
+    with tables.open_file(self.input_file, 'w') as f:
+      group = f.create_group('/', GENOME)
+      f.create_array(group, 'data', np.array(DATA, dtype=np.int32))
+      f.create_array(group, 'indices', np.array(INDICES, dtype=np.int64))
+      f.create_array(group, 'indptr', np.array(INDPTR, dtype=np.int64))
+      f.create_array(group, 'gene_names', np.array(GENE_NAMES, dtype='S'))
+      f.create_array(group, 'barcodes', np.array(BARCODES, dtype='S'))
+    self.output_file = os.path.join(self.path, 'examples.tfrecord.gz')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def convert(self, **kwargs):
+    hdf5_to_examples.convert_shard(self.input_file, GENOME, 0, 3,
+                                   self.output_file, 2, **kwargs)
+    options = tf.python_io.TFRecordOptions(
+        tf.python_io.TFRecordCompressionType.GZIP)
+    examples = []
+    for record in tf.python_io.tf_record_iterator(self.output_file, options):
+      feature = tf.train.Example.FromString(record).features.feature
+      measurements = (
+          feature[preproc.MEASUREMENT_INDICES_FEATURE].int64_list.value
+          if 'vocabulary' in kwargs else
+          feature[preproc.MEASUREMENTS_FEATURE].bytes_list.value)
+      examples.append((feature[preproc.SAMPLE_NAME_FEATURE].bytes_list.value[0],
+                       list(measurements),
+                       list(feature[preproc.VALUES_FEATURE].float_list.value)))
+    return examples
+
+  def test_sums_gene_ids(self):
+    self.assertEqual([('cell1', ['Glul', 'Rho'], [4, 2]),
+                      ('cell2', ['Rho'], [5])], self.convert())
+
+  def test_genes_and_cells(self):
+    self.assertEqual([('cell1', ['Rho'], [2])],
+                     self.convert(genes=['Rho'], cells=['cell1']))
+    self.assertEqual([('cell1', ['Glul'], [4])],
+                     self.convert(genes=['Glul'], cells=['cell1', 'cell2']))
+
+  def test_vocabulary(self):
+    self.assertEqual([('cell1', [0, 1], [2, 4]), ('cell2', [0], [5])],
+                     self.convert(vocabulary={'Rho': 0, 'Glul': 1}))
+
+  def test_compute_shard_boundaries(self):
+    indptr = hdf5_to_examples.read_indptr(self.input_file, GENOME)
+    self.assertEqual([(0, 1), (1, 3)],
+                     hdf5_to_examples.compute_shard_boundaries(indptr, 0, 3, 2))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,594 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Mini-batch k-means of SciPy sparse matrices on a single machine.
+
+For development and datasets that fit in the memory of one machine, this
+clusters a CSR matrix of samples by measurements, or a dense matrix of their
+principal components, without starting a TensorFlow experiment. The distances
+of a batch to the clusters are computed as
+
+  ||x||^2 - 2 * x . c + ||c||^2
+
+with a sparse-dense matrix multiplication, or as 1 - x . c on normalized
+samples and clusters for cosine distance, over chunks of rows in a thread
+pool. The clusters are updated with the per-cluster learning rate of
+https://www.eecs.tufts.edu/~dsculley/papers/fastkmeans.pdf, as by
+sparse_kmeans.SparseKMeansClustering.
+
+The trained clusters are saved with the vocabulary and the principal
+components, if any, so that predict_clusters can assign examples to them.
+"""
+
+import collections
+import contextlib
+import io
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.sparse as sp_sparse
+
+from trainer import sparse_pca
+
+CENTROIDS_FILE = 'centroids.npz'
+
+# The number of rows whose distances to the clusters are computed by each task
+# of the thread pool.
+CHUNK_ROWS = 4096
+
+# The weight of each batch in the moving average of the loss whose relative
+# change is compared to the tolerance.
+LOSS_SMOOTHING = 0.1
+
+# The number of rounds of k-means|| sampling, each making two passes over the
+# samples, and the number of candidates sampled in each round per cluster.
+KMEANS_PARALLEL_ROUNDS = 2
+KMEANS_PARALLEL_OVERSAMPLING = 2
+
+# The number of iterations of weighted k-means of the k-means|| candidates.
+KMEANS_PARALLEL_ITERATIONS = 10
+
+# The number of training steps between log messages.
+LOG_STEPS = 100
+
+# Avoids dividing by the norm of an empty sample.
+EPSILON = 1e-12
+
+Centroids = collections.namedtuple('Centroids', [
+    'clusters', 'use_cosine_distance', 'vocabulary', 'use_measurement_indices',
+    'pca'
+])
+
+
+def _squared_row_norms(matrix):
+  if sp_sparse.issparse(matrix):
+    return np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+  return np.einsum('ij,ij->i', matrix, matrix)
+
+
+def normalize_rows(matrix):
+  """Scale each row of a CSR or dense matrix to unit L2 norm."""
+  norms = np.sqrt(np.maximum(_squared_row_norms(matrix), EPSILON))
+  if sp_sparse.issparse(matrix):
+    return sp_sparse.diags(1 / norms).dot(matrix).tocsr()
+  return matrix / norms[:, np.newaxis]
+
+
+def _to_dense(matrix):
+  if sp_sparse.issparse(matrix):
+    return matrix.toarray().astype(np.float64)
+  return np.array(matrix, dtype=np.float64)
+
+
+def _chunk_distances(matrix, clusters, use_cosine_distance):
+  """The distances of each row of a matrix to each cluster.
+
+  For cosine distance, the rows and the clusters must have unit norm.
+  """
+  products = np.asarray(matrix.dot(clusters.T))
+  if use_cosine_distance:
+    distances = 1 - products
+  else:
+    distances = (_squared_row_norms(matrix)[:, np.newaxis] - 2 * products +
+                 _squared_row_norms(clusters)[np.newaxis, :])
+  # Rounding can make the distance of a sample to itself slightly negative.
+  return np.maximum(distances, 0)
+
+
+def _chunks(matrix):
+  return [matrix[begin:begin + CHUNK_ROWS]
+          for begin in range(0, matrix.shape[0], CHUNK_ROWS)]
+
+
+def assign(matrix, clusters, use_cosine_distance=False, pool=None):
+  """Assign each row of a matrix to its closest cluster.
+
+  Args:
+    matrix: CSR or dense matrix of samples by features. For cosine distance,
+      the rows must have unit norm.
+    clusters: array of clusters by features. For cosine distance, the
+      clusters must have unit norm.
+    use_cosine_distance: whether to use the cosine distance instead of the
+      squared euclidean distance
+    pool: if set, a ThreadPool computing the distances of chunks of rows
+
+  Returns:
+    A tuple of the index of the closest cluster of each row, and the distance
+    to it.
+  """
+
+  def assign_chunk(chunk):
+    distances = _chunk_distances(chunk, clusters, use_cosine_distance)
+    closest = distances.argmin(axis=1)
+    return closest, distances[np.arange(len(closest)), closest]
+
+  chunks = _chunks(matrix)
+  results = (pool.map(assign_chunk, chunks) if pool is not None
+             else [assign_chunk(chunk) for chunk in chunks])
+  if not results:
+    return np.zeros(0, dtype=np.int64), np.zeros(0)
+  closest, distances = zip(*results)
+  return np.concatenate(closest), np.concatenate(distances)
+
+
+def _probabilities(weights):
+  total = weights.sum()
+  return weights / total if total > 0 else None
+
+
+def kmeans_plus_plus(matrix, num_clusters, random, use_cosine_distance=False,
+                     weights=None):
+  """Choose initial clusters among the rows of a matrix with k-means++.
+
+  Args:
+    matrix: CSR or dense matrix of samples by features
+    num_clusters: the number of clusters to choose
+    random: numpy RandomState
+    use_cosine_distance: whether the rows have unit norm and are compared with
+      the cosine distance
+    weights: if set, array of the weight of each row
+
+  Returns:
+    An array of clusters by features.
+  """
+  num_rows = matrix.shape[0]
+  if weights is None:
+    weights = np.ones(num_rows)
+  chosen = [random.choice(num_rows, p=_probabilities(weights))]
+  closest = _chunk_distances(matrix, _to_dense(matrix[chosen]),
+                             use_cosine_distance)[:, 0]
+  for _ in range(1, num_clusters):
+    chosen.append(random.choice(num_rows,
+                                p=_probabilities(weights * closest)))
+    closest = np.minimum(closest, _chunk_distances(
+        matrix, _to_dense(matrix[chosen[-1:]]), use_cosine_distance)[:, 0])
+  return _to_dense(matrix[chosen])
+
+
+def kmeans_parallel_candidates(read_batches, num_clusters, random,
+                               use_cosine_distance=False, pool=None):
+  """Sample weighted candidate clusters among streamed samples with k-means||.
+
+  See http://vldb.org/pvldb/vol5/p622_bahmani_vldb2012.pdf. In each of
+  KMEANS_PARALLEL_ROUNDS rounds, about KMEANS_PARALLEL_OVERSAMPLING candidates
+  per cluster are sampled with probability proportional to their distance to
+  the previous candidates. The candidates are weighted by the number of
+  samples closest to them. Candidates sampled for a number of clusters can be
+  reduced by reduce_candidates to any smaller number of clusters, with any
+  seed, without reading the samples again.
+
+  Args:
+    read_batches: function returning an iterable of CSR or dense matrices of
+      samples by features. It is called for each pass and must return the same
+      samples.
+    num_clusters: the largest number of clusters to choose
+    random: numpy RandomState
+    use_cosine_distance: whether to use the cosine distance instead of the
+      squared euclidean distance
+    pool: if set, a ThreadPool computing the distances of chunks of rows
+
+  Returns:
+    A tuple of an array of candidates by features, normalized for the cosine
+    distance, and an array of their weights.
+  """
+
+  def batches():
+    for batch in read_batches():
+      yield normalize_rows(batch) if use_cosine_distance else batch
+
+  def distances(batch, candidates):
+    return assign(batch, candidates, use_cosine_distance, pool)[1]
+
+  # Choose the first candidate uniformly by reservoir sampling.
+  candidates = None
+  num_samples = 0
+  for batch in batches():
+    num_samples += batch.shape[0]
+    if (batch.shape[0] and
+        random.uniform() < float(batch.shape[0]) / num_samples):
+      candidates = _to_dense(batch[[random.randint(batch.shape[0])]])
+  if num_samples < num_clusters:
+    raise ValueError('Cannot choose %d clusters among %d samples.'
+                     % (num_clusters, num_samples))
+
+  num_rounds = 0
+  while num_rounds < KMEANS_PARALLEL_ROUNDS or len(candidates) < num_clusters:
+    cost = sum(distances(batch, candidates).sum() for batch in batches())
+    if not cost > 0:
+      # Every sample is equal to a candidate.
+      break
+    sampled = [candidates]
+    for batch in batches():
+      probabilities = (KMEANS_PARALLEL_OVERSAMPLING * num_clusters *
+                       distances(batch, candidates) / cost)
+      chosen = np.flatnonzero(random.uniform(size=len(probabilities)) <
+                              probabilities)
+      if len(chosen):
+        sampled.append(_to_dense(batch[chosen]))
+    candidates = np.vstack(sampled)
+    num_rounds += 1
+    logging.info('k-means|| round %d: cost %f, %d candidates', num_rounds,
+                 cost, len(candidates))
+  if len(candidates) < num_clusters:
+    raise ValueError('Cannot choose %d clusters among %d distinct samples.'
+                     % (num_clusters, len(candidates)))
+
+  weights = np.zeros(len(candidates))
+  for batch in batches():
+    closest, _ = assign(batch, candidates, use_cosine_distance, pool)
+    weights += np.bincount(closest, minlength=len(candidates))
+  return candidates, weights
+
+
+def reduce_candidates(candidates, weights, num_clusters, random,
+                      use_cosine_distance=False):
+  """Reduce weighted candidates to clusters by k-means++ and k-means.
+
+  Args:
+    candidates: array of candidates by features from
+      kmeans_parallel_candidates
+    weights: array of the weights of the candidates
+    num_clusters: the number of clusters to choose
+    random: numpy RandomState
+    use_cosine_distance: whether to use the cosine distance instead of the
+      squared euclidean distance
+
+  Returns:
+    An array of clusters by features.
+  """
+  if len(candidates) < num_clusters:
+    raise ValueError('Cannot choose %d clusters among %d candidates.'
+                     % (num_clusters, len(candidates)))
+  clusters = kmeans_plus_plus(candidates, num_clusters, random,
+                              use_cosine_distance, weights)
+  for _ in range(KMEANS_PARALLEL_ITERATIONS):
+    closest, _ = assign(
+        candidates,
+        normalize_rows(clusters) if use_cosine_distance else clusters,
+        use_cosine_distance)
+    counts = np.bincount(closest, weights=weights, minlength=num_clusters)
+    sums = np.zeros(clusters.shape)
+    np.add.at(sums, closest, candidates * weights[:, np.newaxis])
+    nonempty = counts > 0
+    clusters[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+  return clusters
+
+
+def kmeans_parallel(read_batches, num_clusters, random,
+                    use_cosine_distance=False, pool=None):
+  """Choose initial clusters among streamed samples with k-means||.
+
+  The weighted candidates of kmeans_parallel_candidates are reduced to the
+  clusters by weighted k-means++ and k-means. Unlike k-means++ of a single
+  batch, the clusters are chosen among all the samples, in a few passes, and
+  there may be more clusters than samples in a batch.
+
+  Args:
+    read_batches: function returning an iterable of CSR or dense matrices of
+      samples by features, see kmeans_parallel_candidates
+    num_clusters: the number of clusters to choose
+    random: numpy RandomState
+    use_cosine_distance: whether to use the cosine distance instead of the
+      squared euclidean distance
+    pool: if set, a ThreadPool computing the distances of chunks of rows
+
+  Returns:
+    An array of clusters by features.
+  """
+  candidates, weights = kmeans_parallel_candidates(
+      read_batches, num_clusters, random, use_cosine_distance, pool)
+  return reduce_candidates(candidates, weights, num_clusters, random,
+                           use_cosine_distance)
+
+
+class MiniBatchKMeans(object):
+  """Mini-batch k-means of CSR or dense matrices."""
+
+  def __init__(self,
+               num_clusters,
+               use_cosine_distance=False,
+               use_kmeans_plus_plus=False,
+               relative_tolerance=None,
+               batch_size=50,
+               seed=0):
+    """Creates a model for running mini-batch k-means.
+
+    Args:
+      num_clusters: The number of clusters to train.
+      use_cosine_distance: whether to use the cosine distance instead of the
+        squared euclidean distance.
+      use_kmeans_plus_plus: whether to choose the initial clusters among the
+        first batch with k-means++ instead of at random.
+      relative_tolerance: A relative tolerance of change in the moving average
+        of the loss. Stops learning if it changes less than this amount.
+      batch_size: The number of samples in each training step.
+      seed: seed of the initialization.
+    """
+    self.num_clusters = num_clusters
+    self.use_cosine_distance = use_cosine_distance
+    self.use_kmeans_plus_plus = use_kmeans_plus_plus
+    self.relative_tolerance = relative_tolerance
+    self.batch_size = batch_size
+    self.seed = seed
+    self.random = np.random.RandomState(seed)
+    self.clusters = None
+    self.counts = np.zeros(num_clusters)
+    self.loss = None
+    self.num_steps = 0
+    self.converged = False
+
+  def initialize(self, batch):
+    """Choose the initial clusters among the rows of a batch."""
+    if batch.shape[0] < self.num_clusters:
+      raise ValueError('Cannot choose %d clusters among %d samples.'
+                       % (self.num_clusters, batch.shape[0]))
+    if self.use_kmeans_plus_plus:
+      self.clusters = kmeans_plus_plus(batch, self.num_clusters, self.random,
+                                       self.use_cosine_distance)
+    else:
+      self.clusters = _to_dense(batch[self.random.choice(
+          batch.shape[0], self.num_clusters, replace=False)])
+
+  def initialize_parallel(self, read_batches, pool=None):
+    """Choose the initial clusters among streamed samples with k-means||.
+
+    Args:
+      read_batches: function returning an iterable of CSR or dense matrices
+        of samples by features, see kmeans_parallel
+      pool: if set, a ThreadPool computing the distances of chunks of rows
+    """
+    self.clusters = kmeans_parallel(read_batches, self.num_clusters,
+                                    self.random, self.use_cosine_distance,
+                                    pool)
+
+  def initialize_from_candidates(self, candidates, weights):
+    """Choose the initial clusters among shared k-means|| candidates.
+
+    Args:
+      candidates: array of candidates by features from
+        kmeans_parallel_candidates, sampled for at least num_clusters
+      weights: array of the weights of the candidates
+    """
+    self.clusters = reduce_candidates(candidates, weights, self.num_clusters,
+                                      self.random, self.use_cosine_distance)
+
+  def _normalized_clusters(self):
+    if self.use_cosine_distance:
+      return normalize_rows(self.clusters)
+    return self.clusters
+
+  def partial_fit(self, batch, pool=None):
+    """Run one training step.
+
+    Args:
+      batch: CSR or dense matrix of samples by features. For cosine distance,
+        the rows must have unit norm.
+      pool: if set, a ThreadPool computing the distances of chunks of rows
+
+    Returns:
+      The mean distance of the samples of the batch to their clusters, before
+      the update.
+    """
+    if self.clusters is None:
+      self.initialize(batch)
+    closest, distances = assign(batch, self._normalized_clusters(),
+                                self.use_cosine_distance, pool)
+    batch_counts = np.bincount(closest, minlength=self.num_clusters)
+    one_hot = sp_sparse.csr_matrix(
+        (np.ones(len(closest)), (closest, np.arange(len(closest)))),
+        shape=(self.num_clusters, len(closest)))
+    batch_sums = one_hot.dot(batch)
+    if sp_sparse.issparse(batch_sums):
+      batch_sums = batch_sums.toarray()
+    self.counts += batch_counts
+    self.clusters += ((batch_sums - batch_counts[:, np.newaxis] * self.clusters)
+                      / np.maximum(self.counts, 1)[:, np.newaxis])
+
+    loss = distances.mean()
+    if self.loss is None:
+      self.loss = loss
+    else:
+      smoothed = (1 - LOSS_SMOOTHING) * self.loss + LOSS_SMOOTHING * loss
+      if (self.relative_tolerance is not None and
+          abs(smoothed - self.loss) / (1 + abs(self.loss)) <
+          self.relative_tolerance):
+        self.converged = True
+      self.loss = smoothed
+    self.num_steps += 1
+    return loss
+
+  def fit(self, matrix, num_steps, num_threads=None):
+    """Train on random batches of the rows of a matrix.
+
+    Args:
+      matrix: CSR or dense matrix of samples by features
+      num_steps: the maximum number of training steps
+      num_threads: the number of threads computing distances, by default the
+        number of cores
+
+    Returns:
+      This model.
+    """
+    fit_models([self], matrix, num_steps, num_threads)
+    return self
+
+  def predict(self, matrix, num_threads=None):
+    """Assign each row of a matrix to its closest cluster.
+
+    Returns:
+      A tuple of the index of the closest cluster of each row, and the
+      distance to it.
+    """
+    if self.use_cosine_distance:
+      matrix = normalize_rows(matrix)
+    with contextlib.closing(ThreadPool(num_threads)) as pool:
+      return assign(matrix, self._normalized_clusters(),
+                    self.use_cosine_distance, pool)
+
+
+def fit_models(models, matrix, num_steps, num_threads=None, seed=0):
+  """Train several models on the same random batches of the rows of a matrix.
+
+  Each batch is drawn, and normalized for the models using the cosine
+  distance, once and used by every model that has not converged, such as
+  models of different numbers of clusters. The models are trained in parallel
+  in a thread pool, or, if there is only one, the distances of chunks of the
+  batch are computed in parallel.
+
+  Args:
+    models: list of MiniBatchKMeans of the same batch size
+    matrix: CSR or dense matrix of samples by features
+    num_steps: the maximum number of training steps
+    num_threads: the number of threads, by default the number of cores
+    seed: seed of the batches
+
+  Returns:
+    The list of models.
+  """
+  batch_sizes = set(model.batch_size for model in models)
+  if len(batch_sizes) != 1:
+    raise ValueError('The models should have the same batch size, not %s.'
+                     % sorted(batch_sizes))
+  batch_size, = batch_sizes
+  random = np.random.RandomState(seed)
+  with contextlib.closing(ThreadPool(num_threads)) as pool:
+    for step in range(num_steps):
+      active = [model for model in models if not model.converged]
+      if not active:
+        break
+      batch = matrix[random.randint(0, matrix.shape[0], size=batch_size)]
+      normalized = None
+      if any(model.use_cosine_distance for model in active):
+        normalized = normalize_rows(batch)
+
+      def train_step(model, pool=None):
+        model.partial_fit(normalized if model.use_cosine_distance else batch,
+                          pool)
+
+      if len(active) == 1:
+        train_step(active[0], pool)
+      else:
+        pool.map(train_step, active)
+      if (step + 1) % LOG_STEPS == 0:
+        logging.info('Step %d, losses %s', step + 1,
+                     ', '.join('%f' % model.loss for model in active))
+  for model in models:
+    logging.info('Trained %d clusters in %d steps%s, loss %f',
+                 model.num_clusters, model.num_steps,
+                 ' until convergence' if model.converged else '', model.loss)
+  return models
+
+
+def select_best_models(models, matrix, num_threads=None):
+  """Select the model of lowest inertia for each number of clusters.
+
+  Models of the same number of clusters differ by the seed of their
+  initialization. The inertia of each model is logged.
+
+  Args:
+    models: list of trained MiniBatchKMeans
+    matrix: CSR or dense matrix of samples by features
+    num_threads: the number of threads, by default the number of cores
+
+  Returns:
+    A list of tuples of the best model and its inertia, the sum of the
+    distances of the samples to their clusters, in the order of the numbers
+    of clusters in models.
+  """
+  best = collections.OrderedDict()
+  for model in models:
+    _, distances = model.predict(matrix, num_threads)
+    inertia = distances.sum()
+    logging.info('%d clusters, seed %d: inertia %f after %d steps%s',
+                 model.num_clusters, model.seed, inertia, model.num_steps,
+                 ' until convergence' if model.converged else '')
+    if (model.num_clusters not in best or
+        inertia < best[model.num_clusters][1]):
+      best[model.num_clusters] = (model, inertia)
+  for model, inertia in best.values():
+    logging.info('Selected %d clusters with seed %d, inertia %f',
+                 model.num_clusters, model.seed, inertia)
+  return list(best.values())
+
+
+def normalize_centroids(centroids):
+  """Scale the clusters of Centroids to unit norm if they use cosine distance.
+
+  Predicting with the returned Centroids and normalized=True avoids
+  normalizing the clusters again for every matrix.
+  """
+  if not centroids.use_cosine_distance:
+    return centroids
+  return centroids._replace(clusters=normalize_rows(centroids.clusters))
+
+
+def predict_centroids(centroids, matrix, normalized=False):
+  """Assign each row of a matrix of measurements to its closest centroid.
+
+  Args:
+    centroids: Centroids from load_centroids
+    matrix: CSR matrix of samples by the vocabulary of the centroids
+    normalized: whether the centroids were returned by normalize_centroids
+
+  Returns:
+    An array of the index of the closest centroid of each row.
+  """
+  if centroids.pca is not None:
+    matrix = sparse_pca.transform(centroids.pca, matrix)
+  if not normalized:
+    centroids = normalize_centroids(centroids)
+  if centroids.use_cosine_distance:
+    matrix = normalize_rows(matrix)
+  closest, _ = assign(matrix, centroids.clusters,
+                      centroids.use_cosine_distance)
+  return closest
+
+
+def save_centroids(f, centroids):
+  """Write Centroids to a binary file object, such as a tf.gfile.GFile."""
+  arrays = {
+      'clusters': centroids.clusters,
+      'use_cosine_distance': centroids.use_cosine_distance,
+      'vocabulary': np.array(centroids.vocabulary),
+      'use_measurement_indices': centroids.use_measurement_indices
+  }
+  if centroids.pca is not None:
+    for field, array in centroids.pca._asdict().items():
+      arrays['pca_' + field] = array
+  buf = io.BytesIO()
+  np.savez(buf, **arrays)
+  f.write(buf.getvalue())
+
+
+def load_centroids(f):
+  """Read Centroids written by save_centroids from a binary file object."""
+  arrays = np.load(io.BytesIO(f.read()))
+  pca = None
+  if 'pca_components' in arrays:
+    pca = sparse_pca.PCA(*[arrays['pca_' + field]
+                           for field in sparse_pca.PCA._fields])
+  return Centroids(arrays['clusters'], bool(arrays['use_cosine_distance']),
+                   [str(name) for name in arrays['vocabulary']],
+                   bool(arrays['use_measurement_indices']), pca)
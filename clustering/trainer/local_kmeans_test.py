@@ -0,0 +1,141 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test mini-batch k-means of sparse matrices."""
+
+import io
+import unittest
+
+import numpy as np
+import scipy.sparse as sp_sparse
+from trainer import local_kmeans
+
+VOCABULARY = ['Glul', 'Prkca', 'Rho', 'Sox2']
+
+
+class LocalKMeansTest(unittest.TestCase):
+
+  def setUp(self):
+    random = np.random.RandomState(2)
+    # Three groups of samples, each expressing a different pair of genes.
+    self.labels = np.repeat([0, 1, 2], 100)
+    patterns = np.array([[10, 10, 0, 0], [0, 0, 10, 10], [10, 0, 0, 10]])
+    self.matrix = sp_sparse.csr_matrix(
+        patterns[self.labels] + random.uniform(size=(300, 4)) *
+        (patterns[self.labels] > 0))
+
+  def assertSameClustering(self, labels, predicted):
+    # The cluster indices are arbitrary, but each group is a cluster.
+    pairs = set(zip(labels, predicted))
+    self.assertEqual(3, len(pairs))
+    self.assertEqual(3, len(set(predicted)))
+
+  def test_chunk_distances(self):
+    clusters = np.array([[1., 0, 0, 0], [0, 2, 0, 1]])
+    expected = ((self.matrix.toarray()[:, np.newaxis, :] -
+                 clusters[np.newaxis, :, :])**2).sum(axis=2)
+    np.testing.assert_allclose(
+        expected, local_kmeans._chunk_distances(self.matrix, clusters, False))
+
+  def test_fit(self):
+    for use_cosine_distance in [False, True]:
+      kmeans = local_kmeans.MiniBatchKMeans(
+          3, use_cosine_distance=use_cosine_distance,
+          use_kmeans_plus_plus=True, batch_size=30)
+      kmeans.fit(self.matrix, 100, num_threads=2)
+      predicted, _ = kmeans.predict(self.matrix, num_threads=2)
+      self.assertSameClustering(self.labels, predicted)
+
+  def test_kmeans_parallel(self):
+    batches = lambda: [self.matrix[begin:begin + 20]
+                       for begin in range(0, 300, 20)]
+    for use_cosine_distance in [False, True]:
+      # More clusters than samples in a batch.
+      clusters = local_kmeans.kmeans_parallel(
+          batches, 30, np.random.RandomState(0), use_cosine_distance)
+      self.assertEqual((30, 4), clusters.shape)
+      kmeans = local_kmeans.MiniBatchKMeans(
+          3, use_cosine_distance=use_cosine_distance)
+      kmeans.initialize_parallel(batches)
+      predicted, _ = kmeans.predict(self.matrix)
+      self.assertSameClustering(self.labels, predicted)
+    with self.assertRaises(ValueError):
+      local_kmeans.kmeans_parallel(batches, 301, np.random.RandomState(0))
+
+  def test_kmeans_parallel_candidates(self):
+    batches = lambda: [self.matrix[begin:begin + 20]
+                       for begin in range(0, 300, 20)]
+    candidates, weights = local_kmeans.kmeans_parallel_candidates(
+        batches, 30, np.random.RandomState(0))
+    self.assertEqual(300, weights.sum())
+    # The candidates of the largest model are shared by every seed and every
+    # smaller number of clusters.
+    for num_clusters, seed in [(3, 0), (3, 1), (30, 0)]:
+      kmeans = local_kmeans.MiniBatchKMeans(num_clusters, seed=seed)
+      kmeans.initialize_from_candidates(candidates, weights)
+      self.assertEqual((num_clusters, 4), kmeans.clusters.shape)
+      if num_clusters == 3:
+        predicted, _ = kmeans.predict(self.matrix)
+        self.assertSameClustering(self.labels, predicted)
+    with self.assertRaises(ValueError):
+      local_kmeans.reduce_candidates(candidates, weights, len(candidates) + 1,
+                                     np.random.RandomState(0))
+
+  def test_fit_models(self):
+    models = [local_kmeans.MiniBatchKMeans(num_clusters, batch_size=30)
+              for num_clusters in [1, 3]]
+    local_kmeans.fit_models(models, self.matrix, 50, num_threads=2)
+    self.assertEqual([50, 50], [model.num_steps for model in models])
+    inertias = [model.predict(self.matrix)[1].sum() for model in models]
+    self.assertGreater(inertias[0], inertias[1])
+    with self.assertRaises(ValueError):
+      local_kmeans.fit_models(
+          [local_kmeans.MiniBatchKMeans(3, batch_size=size)
+           for size in [30, 40]], self.matrix, 1)
+
+  def test_select_best_models(self):
+    models = [local_kmeans.MiniBatchKMeans(num_clusters, batch_size=30,
+                                           seed=seed)
+              for num_clusters in [2, 3] for seed in range(3)]
+    local_kmeans.fit_models(models, self.matrix, 20)
+    best = local_kmeans.select_best_models(models, self.matrix)
+    self.assertEqual([2, 3], [model.num_clusters for model, _ in best])
+    for model, inertia in best:
+      self.assertEqual(min(other.predict(self.matrix)[1].sum()
+                           for other in models
+                           if other.num_clusters == model.num_clusters),
+                       inertia)
+
+  def test_save_centroids(self):
+    kmeans = local_kmeans.MiniBatchKMeans(3, use_kmeans_plus_plus=True,
+                                          batch_size=30)
+    kmeans.fit(self.matrix, 100)
+    f = io.BytesIO()
+    local_kmeans.save_centroids(f, local_kmeans.Centroids(
+        kmeans.clusters, False, VOCABULARY, True, None))
+    centroids = local_kmeans.load_centroids(io.BytesIO(f.getvalue()))
+    self.assertEqual(VOCABULARY, centroids.vocabulary)
+    self.assertTrue(centroids.use_measurement_indices)
+    self.assertIsNone(centroids.pca)
+    predicted, _ = kmeans.predict(self.matrix)
+    np.testing.assert_array_equal(
+        predicted, local_kmeans.predict_centroids(centroids, self.matrix))
+
+  def test_predict_normalized_centroids(self):
+    kmeans = local_kmeans.MiniBatchKMeans(3, use_cosine_distance=True,
+                                          batch_size=30)
+    kmeans.fit(local_kmeans.normalize_rows(self.matrix), 100)
+    centroids = local_kmeans.Centroids(kmeans.clusters, True, VOCABULARY,
+                                       False, None)
+    predicted = local_kmeans.predict_centroids(centroids, self.matrix)
+    normalized = local_kmeans.normalize_centroids(centroids)
+    np.testing.assert_allclose(
+        1, np.linalg.norm(normalized.clusters, axis=1), rtol=1e-6)
+    np.testing.assert_array_equal(
+        predicted, local_kmeans.predict_centroids(normalized, self.matrix,
+                                                  normalized=True))
+
+
+if __name__ == '__main__':
+  unittest.main()
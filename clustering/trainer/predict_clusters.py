@@ -16,25 +16,37 @@ from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import SetupOptions
 from apache_beam.options.pipeline_options import WorkerOptions
 import logging
+import numpy as np
+import scipy.sparse as sp_sparse
 import tensorflow as tf
 
 # The KMeansClustering import is not used in the python code below, but
 # it is necessary to import it so that the TensorFlow Ops used by the
 # saved model are loaded into the runtime environment.
 from tensorflow.contrib.learn import KMeansClustering
+from trainer import example_shards
+from trainer import local_kmeans
 from trainer.shared_constants import SAMPLE_NAME_FEATURE
 
 # BigQuery column name constants.
 SAMPLE = 'cell'
 CLUSTER = 'cluster'
 
+# The largest number of examples whose clusters are predicted at once from
+# local engine centroids.
+PREDICT_BATCH_SIZE = 1000
+
 
 class PredictOptions(PipelineOptions):
 
   @classmethod
   def _add_argparse_args(cls, parser):
     parser.add_argument(
-        '--model', required=True, help='Path to the saved TensorFlow model.')
+        '--model', help='Path to the saved TensorFlow model.')
+    parser.add_argument(
+        '--centroids',
+        help='Path to the centroids.npz file written by the local engine of '
+        'cluster_measurements, to use instead of a saved TensorFlow model.')
     parser.add_argument(
         '--output',
         required=True,
@@ -65,7 +77,10 @@ class PredictDoFn(beam.DoFn):
     perform prediction.
   """
   INPUT_TENSOR = 'examples:0'
-  CLUSTER_CLASSIFICATION_TENSOR = 'Squeeze_1:0'
+  # The key of the cluster predictions in the outputs of the serving
+  # signature, which is the same for KMeansClustering and
+  # SparseKMeansClustering. The name of the tensor depends on the graph.
+  CLUSTER_IDX_KEY = 'cluster_idx'
 
   def __init__(self, model_export_dir):
     self.model_export_dir = model_export_dir
@@ -83,20 +98,19 @@ class PredictDoFn(beam.DoFn):
                        self.INPUT_TENSOR,
                        self.input_tensors,
                        signature_def.inputs.keys())
-    self.output_tensors = [str(x.name) for x in signature_def.outputs.values()]
-    if self.CLUSTER_CLASSIFICATION_TENSOR not in self.output_tensors:
-      raise ValueError('Expected cluster classification output tensor %s '
-                       'not in %s with keys %s',
-                       self.CLUSTER_CLASSIFICATION_TENSOR,
-                       self.output_tensors,
+    if self.CLUSTER_IDX_KEY not in signature_def.outputs:
+      raise ValueError('Expected cluster classification output key %s '
+                       'not in %s',
+                       self.CLUSTER_IDX_KEY,
                        signature_def.outputs.keys())
+    self.cluster_tensor = str(signature_def.outputs[self.CLUSTER_IDX_KEY].name)
 
     self.sess = sess
 
   def predict(self, serialized_example):
     input_list = [serialized_example]
     output = self.sess.run(
-        [self.CLUSTER_CLASSIFICATION_TENSOR],
+        [self.cluster_tensor],
         feed_dict={self.INPUT_TENSOR: input_list})
     example = tf.train.Example.FromString(serialized_example)
     return (example.features.feature[SAMPLE_NAME_FEATURE].bytes_list.value[0],
@@ -107,6 +121,40 @@ class PredictDoFn(beam.DoFn):
     return [{SAMPLE: output_key, CLUSTER: predicted_cluster}]
 
 
+class PredictCentroidsDoFn(beam.DoFn):
+  """DoFn to assign each batch of examples to their closest centroids.
+
+    This class loads the centroids trained by the local engine, and computes
+    the distances with NumPy instead of restoring a TensorFlow model. The
+    centroids are normalized once per bundle, and the distances of a whole
+    batch of examples are computed at once.
+  """
+
+  def __init__(self, centroids_file):
+    self.centroids_file = centroids_file
+
+  def start_bundle(self):
+    with tf.gfile.Open(self.centroids_file, 'rb') as f:
+      self.centroids = local_kmeans.normalize_centroids(
+          local_kmeans.load_centroids(f))
+    self.positions = dict(
+        (name, i) for i, name in enumerate(self.centroids.vocabulary))
+
+  def process(self, elements):
+    samples, columns, values = zip(*[
+        example_shards.example_to_row(
+            element, self.positions, self.centroids.use_measurement_indices)
+        for element in elements])
+    indptr = np.cumsum([0] + [len(row_columns) for row_columns in columns])
+    matrix = sp_sparse.csr_matrix(
+        (np.concatenate(values), np.concatenate(columns), indptr),
+        shape=(len(samples), len(self.centroids.vocabulary)))
+    clusters = local_kmeans.predict_centroids(self.centroids, matrix,
+                                              normalized=True)
+    return [{SAMPLE: sample, CLUSTER: int(cluster)}
+            for sample, cluster in zip(samples, clusters)]
+
+
 def run(argv=None):
   """Runs the sparse measurements prediction pipeline.
 
@@ -119,13 +167,25 @@ def run(argv=None):
   pipeline_options.view_as(
       WorkerOptions).autoscaling_algorithm = 'THROUGHPUT_BASED'
 
+  if bool(predict_options.model) == bool(predict_options.centroids):
+    raise ValueError('Exactly one of --model and --centroids should be '
+                     'specified.')
+
   with beam.Pipeline(options=pipeline_options) as p:
     examples = (p | 'ReadExamples' >> tfrecordio.ReadFromTFRecord(
         file_pattern=predict_options.input,
-        compression_type=CompressionTypes.GZIP))
-
-    predictions = examples | 'Predict' >> beam.ParDo(
-        PredictDoFn(model_export_dir=predict_options.model))
+        compression_type=CompressionTypes.AUTO))
+
+    if predict_options.centroids:
+      predictions = (
+          examples
+          | 'BatchExamples' >> beam.BatchElements(
+              max_batch_size=PREDICT_BATCH_SIZE)
+          | 'Predict' >> beam.ParDo(
+              PredictCentroidsDoFn(predict_options.centroids)))
+    else:
+      predictions = examples | 'Predict' >> beam.ParDo(
+          PredictDoFn(model_export_dir=predict_options.model))
 
     _ = predictions | 'WriteTableRows' >> beam.io.Write(
         beam.io.BigQuerySink(
@@ -2,11 +2,20 @@
 #
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
-"""Convert sparse measurements data from BigQuery to tf.Example protos."""
+"""Convert sparse measurements data to tf.Example protos.
 
+The data is read from BigQuery, from the long format CSV or Parquet files
+written by the data loaders, or from a local cell store.
+"""
+
+import array
 import datetime
+import itertools
+import json
 import logging
+import math
 import os
+import zlib
 
 import apache_beam as beam
 from apache_beam.io.filesystem import CompressionTypes
@@ -17,8 +26,11 @@ from apache_beam.options.pipeline_options import SetupOptions
 from apache_beam.options.pipeline_options import WorkerOptions
 from jinja2 import Template
 
+import numpy as np
 import tensorflow as tf
 
+from trainer import cell_store
+from trainer import example_shards
 from trainer.shared_constants import *
 
 
@@ -36,57 +48,951 @@ DATA_QUERY_REPLACEMENTS = {
     'VALUE_COLUMN': VALUE_COLUMN
 }
 
+# The default names of the columns of the long format files written by the
+# data loaders.
+DEFAULT_SAMPLE_FIELD = 'cell'
+DEFAULT_MEASUREMENT_FIELD = 'gene'
+DEFAULT_VALUE_FIELD = 'trans_cnt'
 
-def sample_measurements_to_example(sample, sample_measurements):
-  """Convert sparse measurements to TensorFlow Example protocol buffers.
+# The number of cells read from a cell store by each element of the pipeline.
+CELL_STORE_RANGE_SIZE = 10000
 
-  See also
-  https://www.tensorflow.org/versions/r0.10/how_tos/reading_data/index.html
+# The approximate number of bytes of sorted CSV input grouped by each element
+# of the pipeline.
+SORTED_RANGE_BYTES = 64 * 1024 * 1024
+
+# The tag of the samples that may continue in a neighboring range of sorted
+# input.
+BOUNDARY_TAG = 'boundary'
+
+# The files written alongside the examples by --write_measurement_stats.
+MEASUREMENT_STATS_FILE = 'measurement_stats.csv'
+ALL_MEASUREMENTS_FILE = 'vocabulary_all.txt'
+HIGHLY_VARIABLE_FILE = 'vocabulary_highly_variable.txt'
+
+# The name of the copy of the vocabulary written alongside examples holding
+# measurement indices.
+VOCABULARY_FILE = 'vocabulary.txt'
+
+# The file describing how the examples were preprocessed.
+METADATA_FILE = 'metadata.json'
+
+# The supported --transforms, in the order in which they are applied.
+TRANSFORMS = ['library_size', 'log1p', 'l2']
+
+# The total to which the values of each sample are scaled by the library_size
+# transform.
+LIBRARY_SIZE = 10000.0
+
+# The transforms of the values from which the measurement statistics are
+# computed, so that they do not depend on the sequencing depth of each sample.
+STATS_TRANSFORMS = ['library_size']
+
+# The number of equal-width bins of log mean within which the dispersions are
+# compared when selecting highly variable measurements.
+NUM_MEAN_BINS = 20
+
+
+def read_vocabulary(vocabulary_file):
+  """Read a vocabulary file into a dictionary of measurement indices.
+
+  Args:
+    vocabulary_file: Newline-separated file of the measurement names.
+
+  Returns:
+    A dictionary of the index of each measurement name.
+  """
+  with tf.gfile.Open(vocabulary_file, 'r') as f:
+    return dict((line.rstrip('\n'), idx) for idx, line in enumerate(f))
+
+
+def measurements_to_indices(vocabulary, measurements, values):
+  """Map measurement names to sorted, unique vocabulary indices.
+
+  Measurements absent from the vocabulary are dropped and the values of
+  measurements appearing more than once are summed.
+
+  Args:
+    vocabulary: dictionary from read_vocabulary
+    measurements: list of the names of the sample's nonzero measurements
+    values: list of the values of the sample's nonzero measurements
+
+  Returns:
+    A tuple of the list of sorted indices and the list of their values.
+  """
+  indices = np.array([vocabulary.get(str(name), -1) for name in measurements],
+                     dtype=np.int64)
+  values = np.asarray(values, dtype=np.float32)
+  known = indices >= 0
+  unique_indices, positions = np.unique(indices[known], return_inverse=True)
+  summed = np.bincount(positions.ravel(), weights=values[known],
+                       minlength=len(unique_indices))
+  return unique_indices.tolist(), summed.tolist()
+
+
+def parse_transforms(transforms):
+  """Parse a comma-separated list of transforms.
+
+  Args:
+    transforms: string of names from TRANSFORMS, or None
+
+  Returns:
+    The list of the transforms, in the order in which they are applied.
+  """
+  names = transforms.split(',') if transforms else []
+  unknown = sorted(set(names) - set(TRANSFORMS))
+  if unknown:
+    raise ValueError('Unknown transforms %s, expected some of %s.'
+                     % (', '.join(unknown), ', '.join(TRANSFORMS)))
+  return [name for name in TRANSFORMS if name in names]
+
+
+def transform_values(values, transforms, total=None):
+  """Normalize the values of a sample.
+
+  Args:
+    values: list of the values of the sample's nonzero measurements
+    transforms: list from parse_transforms
+    total: the sum of all the values of the sample, if some were dropped
+
+  Returns:
+    The list of the transformed values.
+  """
+  values = np.asarray(values, dtype=np.float64)
+  if 'library_size' in transforms:
+    total = values.sum() if total is None else total
+    if total:
+      values = values * (LIBRARY_SIZE / total)
+  if 'log1p' in transforms:
+    values = np.log1p(values)
+  if 'l2' in transforms:
+    norm = np.sqrt(np.dot(values, values))
+    if norm:
+      values = values / norm
+  return values.tolist()
+
+
+def sparse_measurements_to_example(sample, measurements, values,
+                                   vocabulary=None, transforms=None):
+  """Convert parallel lists of measurements to a TensorFlow Example proto.
 
   Args:
     sample: the identifier for the sample
-    sample_measurements: list of the sample's sparse measurements
+    measurements: list of the names of the sample's nonzero measurements
+    values: list of the values of the sample's nonzero measurements
+    vocabulary: optional dictionary from read_vocabulary. If set, the
+      measurements are stored as sorted vocabulary indices instead of names.
+    transforms: optional list from parse_transforms. The library size is that
+      of all the measurements, while the L2 norm is that of the measurements
+      in the vocabulary.
 
   Returns:
     A filled in TensorFlow Example proto for this sample.
   """
-  feature_tuples = [(str(cnt[MEASUREMENT_COLUMN]), cnt[VALUE_COLUMN])
-                    for cnt in sample_measurements]
-  measurements, values = map(list, zip(*feature_tuples))
+  total = float(sum(values))
+  if vocabulary is not None:
+    measurements, values = measurements_to_indices(vocabulary, measurements,
+                                                   values)
+  if transforms:
+    values = transform_values(values, transforms, total)
   features = {
       SAMPLE_NAME_FEATURE:
           tf.train.Feature(bytes_list=tf.train.BytesList(value=[str(sample)])),
       # These are tf.VarLenFeature.
-      MEASUREMENTS_FEATURE:
-          tf.train.Feature(bytes_list=tf.train.BytesList(value=measurements)),
       VALUES_FEATURE:
           tf.train.Feature(float_list=tf.train.FloatList(value=values))
   }
+  if vocabulary is not None:
+    features[MEASUREMENT_INDICES_FEATURE] = tf.train.Feature(
+        int64_list=tf.train.Int64List(value=measurements))
+  else:
+    features[MEASUREMENTS_FEATURE] = tf.train.Feature(
+        bytes_list=tf.train.BytesList(value=measurements))
 
   return tf.train.Example(features=tf.train.Features(feature=features))
 
 
-def measurements_to_examples(input_data):
+def sample_measurements_to_example(sample, sample_measurements,
+                                   vocabulary=None, transforms=None):
+  """Convert sparse measurements to TensorFlow Example protocol buffers.
+
+  See also
+  https://www.tensorflow.org/versions/r0.10/how_tos/reading_data/index.html
+
+  Args:
+    sample: the identifier for the sample
+    sample_measurements: list of the sample's sparse measurements
+    vocabulary: optional dictionary from read_vocabulary
+    transforms: optional list from parse_transforms
+
+  Returns:
+    A filled in TensorFlow Example proto for this sample.
+  """
+  feature_tuples = [(str(cnt[MEASUREMENT_COLUMN]), cnt[VALUE_COLUMN])
+                    for cnt in sample_measurements]
+  measurements, values = map(list, zip(*feature_tuples))
+  return sparse_measurements_to_example(sample, measurements, values,
+                                        vocabulary, transforms)
+
+
+class SampleMeasurementsCombineFn(beam.CombineFn):
+  """Accumulate the measurements of a sample into compact arrays.
+
+  The accumulator is a list of the measurement names and an array of their
+  float32 values, so that partial accumulators combined before the shuffle
+  are much smaller than the rows they replace.
+  """
+
+  def create_accumulator(self):
+    return [], array.array('f')
+
+  def add_input(self, accumulator, measurement):
+    measurements, values = accumulator
+    name, value = measurement
+    measurements.append(str(name))
+    values.append(value)
+    return accumulator
+
+  def merge_accumulators(self, accumulators):
+    return merge_sample_measurements(accumulators)
+
+  def extract_output(self, accumulator):
+    return accumulator
+
+
+def merge_sample_measurements(parts):
+  """Concatenate parts of the measurements of a sample.
+
+  Args:
+    parts: iterable of (list of measurement names, array of values) tuples
+
+  Returns:
+    A tuple of the list of all the measurement names and the array of all
+    their values.
+  """
+  merged_measurements, merged_values = [], array.array('f')
+  for measurements, values in parts:
+    merged_measurements.extend(measurements)
+    merged_values.extend(values)
+  return merged_measurements, merged_values
+
+
+def sum_duplicate_measurements(sample_measurements):
+  """Sum the values of the measurements appearing more than once in a sample.
+
+  Long format files may hold several rows of a sample and measurement, such as
+  the rows of the gene ids sharing a gene name written by hdf5_to_sparse.py.
+  Their values are summed, as by the GROUP BY of the BigQuery query and by
+  cell stores.
+
+  Args:
+    sample_measurements: (sample, (list of measurement names, array of
+      values)) tuple
+
+  Returns:
+    The tuple, with the measurement names sorted and unique if any were
+    repeated.
+  """
+  sample, (measurements, values) = sample_measurements
+  if len(set(measurements)) == len(measurements):
+    return sample_measurements
+  names, positions = np.unique(measurements, return_inverse=True)
+  summed = np.bincount(positions.ravel(),
+                       weights=np.asarray(values, dtype=np.float64),
+                       minlength=len(names))
+  return sample, (names.tolist(), array.array('f', summed.tolist()))
+
+
+def samples_to_examples(samples, vocabulary=None, transforms=None):
+  """Converts grouped sample measurements to TensorFlow Example protos.
+
+  Args:
+    samples: (sample, (list of measurement names, array of values)) tuples
+    vocabulary: optional dictionary from read_vocabulary
+    transforms: optional list from parse_transforms
+
+  Returns:
+    TensorFlow Example protos.
+  """
+  return samples | 'SamplesToExamples' >> beam.Map(
+      lambda (key, (measurements, values)):
+      sparse_measurements_to_example(key, measurements, values.tolist(),
+                                     vocabulary, transforms))
+
+
+def group_measurements(input_data, combine=True, hot_key_fanout=0):
+  """Group the sparse measurements of each sample.
+
+  Args:
+    input_data: dictionary objects with keys from
+      DATA_QUERY_REPLACEMENTS
+    combine: whether to group the measurements of each sample with
+      SampleMeasurementsCombineFn instead of GroupByKey
+    hot_key_fanout: if nonzero, the number of intermediate keys over which
+      the measurements of each sample are combined before being merged
+
+  Returns:
+    A PCollection of (sample, (list of measurement names, array of values))
+    tuples, in which each measurement of a sample appears once.
+  """
+  keyed = input_data | 'KeyBySample' >> beam.Map(
+      lambda row: (row[SAMPLE_COLUMN], (row[MEASUREMENT_COLUMN],
+                                        row[VALUE_COLUMN])))
+  if combine:
+    combine_per_sample = beam.CombinePerKey(SampleMeasurementsCombineFn())
+    if hot_key_fanout:
+      combine_per_sample = combine_per_sample.with_hot_key_fanout(
+          hot_key_fanout)
+    samples = keyed | 'CombineBySample' >> combine_per_sample
+  else:
+    samples = (
+        keyed
+        | 'GroupBySample' >> beam.GroupByKey()
+        | 'PackSampleMeasurements' >> beam.Map(
+            lambda (key, measurements): (key, (
+                [str(name) for name, _ in measurements],
+                array.array('f', [value for _, value in measurements])))))
+  return samples | 'SumDuplicateMeasurements' >> beam.Map(
+      sum_duplicate_measurements)
+
+
+def measurements_to_examples(input_data, combine=True, hot_key_fanout=0,
+                             vocabulary=None, transforms=None):
   """Converts sparse measurements to TensorFlow Example protos.
 
   Args:
     input_data: dictionary objects with keys from
       DATA_QUERY_REPLACEMENTS
+    combine: whether to group the measurements of each sample with
+      SampleMeasurementsCombineFn instead of GroupByKey
+    hot_key_fanout: if nonzero, the number of intermediate keys over which
+      the measurements of each sample are combined before being merged
+    vocabulary: optional dictionary from read_vocabulary
+    transforms: optional list from parse_transforms
 
   Returns:
     TensorFlow Example protos.
   """
-  meas_kvs = input_data | 'BucketMeasurements' >> beam.Map(
-      lambda row: (row[SAMPLE_COLUMN], row))
+  return samples_to_examples(
+      group_measurements(input_data, combine, hot_key_fanout), vocabulary,
+      transforms)
+
+
+class MeasurementStatsCombineFn(beam.CombineFn):
+  """Combine the statistics of the nonzero values of a measurement.
+
+  Inputs and accumulators are (number of nonzero values, mean, sum of squared
+  deviations from the mean) tuples, so that the partial statistics of many
+  samples can be combined as well as single values. They are merged with the
+  pairwise update of Chan et al., which unlike sums of squares does not lose
+  the variance to cancellation when the mean is large.
+  """
+
+  def create_accumulator(self):
+    return 0, 0.0, 0.0
+
+  def add_input(self, accumulator, stats):
+    return merge_stats(accumulator, stats)
+
+  def merge_accumulators(self, accumulators):
+    merged = self.create_accumulator()
+    for accumulator in accumulators:
+      merged = merge_stats(merged, accumulator)
+    return merged
+
+  def extract_output(self, accumulator):
+    return accumulator
+
+
+def merge_stats(first, second):
+  """Merge two (count, mean, sum of squared deviations) tuples."""
+  count_a, mean_a, m2_a = first
+  count_b, mean_b, m2_b = second
+  count = count_a + count_b
+  if not count:
+    return first
+  delta = mean_b - mean_a
+  return (count, mean_a + delta * count_b / float(count),
+          m2_a + m2_b + delta * delta * count_a * count_b / float(count))
+
+
+def value_stats(value):
+  """The statistics of a single nonzero value, see MeasurementStatsCombineFn."""
+  return 1, float(value), 0.0
+
+
+def sample_measurement_stats(sample_measurements):
+  """The statistics of each normalized value of a grouped sample.
+
+  The values are first scaled to a total of LIBRARY_SIZE, as by the
+  library_size transform, so that deeply sequenced samples do not dominate.
+
+  Args:
+    sample_measurements: (sample, (list of measurement names, array of
+      values)) tuple
+
+  Returns:
+    A list of (measurement, statistics) tuples.
+  """
+  _, (measurements, values) = sample_measurements
+  return [(measurement, value_stats(value))
+          for measurement, value in zip(
+              measurements, transform_values(values, STATS_TRANSFORMS))]
+
+
+def summarize_measurement_stats(measurement_stats, num_samples):
+  """Compute the mean and variance of each measurement over all samples.
+
+  Samples lacking a measurement count as zero values, which are merged into
+  the statistics of the nonzero values as one more group.
+
+  Args:
+    measurement_stats: list of (measurement, (count, mean, sum of squared
+      deviations)) tuples of the nonzero values
+    num_samples: the number of samples
+
+  Returns:
+    A tuple of the sorted array of measurement names, and arrays of their
+    number of nonzero values, means, variances and dispersions, where the
+    dispersion is the variance divided by the mean.
+  """
+  measurement_stats = sorted(measurement_stats)
+  names = np.array([name for name, _ in measurement_stats], dtype=object)
+  stats = np.array([stats for _, stats in measurement_stats],
+                   dtype=np.float64).reshape(-1, 3)
+  counts, nonzero_means, m2 = stats.T
+  num_samples = max(num_samples, 1)
+  means = nonzero_means * counts / num_samples
+  m2 = m2 + nonzero_means * nonzero_means * counts * (
+      num_samples - counts) / num_samples
+  variances = np.maximum(m2 / num_samples, 0)
+  dispersions = np.where(means > 0, variances / np.maximum(means, 1e-12), 0)
+  return names, counts.astype(np.int64), means, variances, dispersions
+
+
+def normalize_dispersions(means, dispersions, num_bins=NUM_MEAN_BINS):
+  """Z-score the log dispersions within bins of measurements of similar mean.
+
+  The dispersion of count data grows with its mean, so comparing each
+  measurement only with those of similar mean keeps highly expressed
+  measurements from being selected for their expression alone. Measurements
+  alone in their bin, or in a bin of equal dispersions, are given 0.
+
+  Args:
+    means: array of the mean of each measurement
+    dispersions: array of the dispersion of each measurement
+    num_bins: the number of equal-width bins of log mean
+
+  Returns:
+    The array of the normalized dispersion of each measurement.
+  """
+  log_means = np.log1p(means)
+  log_dispersions = np.log(np.maximum(dispersions, 1e-12))
+  normalized = np.zeros(len(means))
+  if not len(means):
+    return normalized
+  edges = np.linspace(log_means.min(), log_means.max(), num_bins + 1)
+  bins = np.digitize(log_means, edges[1:-1])
+  for idx in np.unique(bins).tolist():
+    members = np.flatnonzero(bins == idx)
+    if len(members) < 2:
+      continue
+    std = log_dispersions[members].std(ddof=1)
+    if std > 0:
+      normalized[members] = (log_dispersions[members] -
+                             log_dispersions[members].mean()) / std
+  return normalized
+
+
+def select_highly_variable(names, dispersions, num_measurements):
+  """Select the measurements with the highest dispersion.
+
+  Args:
+    names: sorted array of measurement names
+    dispersions: array of the dispersion of each measurement, such as from
+      normalize_dispersions
+    num_measurements: the number of measurements to select
+
+  Returns:
+    The sorted list of the selected measurement names.
+  """
+  # Sorting by decreasing dispersion and then by name breaks ties stably.
+  order = np.lexsort((np.arange(len(names)), -dispersions))
+  return sorted(names[order[:num_measurements]].tolist())
+
+
+def write_measurement_stats(measurement_stats, num_samples, output_dir,
+                            num_highly_variable):
+  """Write the measurement statistics and vocabularies.
+
+  Args:
+    measurement_stats: list of (measurement, (count, mean, sum of squared
+      deviations)) tuples of the nonzero values
+    num_samples: the number of samples
+    output_dir: Output directory to which to write the files.
+    num_highly_variable: the number of measurements in the vocabulary of
+      highly variable measurements
+  """
+  names, counts, means, variances, dispersions = summarize_measurement_stats(
+      measurement_stats, num_samples)
+  normalized_dispersions = normalize_dispersions(means, dispersions)
+  with tf.gfile.Open(os.path.join(output_dir, MEASUREMENT_STATS_FILE),
+                     'w') as f:
+    f.write('measurement,num_nonzero,mean,variance,dispersion,'
+            'normalized_dispersion\n')
+    for row in zip(names.tolist(), counts.tolist(), means.tolist(),
+                   variances.tolist(), dispersions.tolist(),
+                   normalized_dispersions.tolist()):
+      f.write('%s,%d,%r,%r,%r,%r\n' % row)
+  with tf.gfile.Open(os.path.join(output_dir, ALL_MEASUREMENTS_FILE),
+                     'w') as f:
+    f.write(''.join(name + '\n' for name in names.tolist()))
+  with tf.gfile.Open(os.path.join(output_dir, HIGHLY_VARIABLE_FILE),
+                     'w') as f:
+    f.write(''.join(
+        name + '\n'
+        for name in select_highly_variable(names, normalized_dispersions,
+                                           num_highly_variable)))
+  logging.info('Wrote statistics of %d measurements over %d samples to %s',
+               len(names), num_samples, output_dir)
+
+
+def cell_store_ranges(store_path, range_size=CELL_STORE_RANGE_SIZE):
+  """Split the cells of a cell store into ranges to be read in parallel.
+
+  Args:
+    store_path: Path of the cell store directory.
+    range_size: The maximum number of cells per range.
+
+  Returns:
+    A list of (begin_idx, end_idx) tuples.
+  """
+  num_cells = cell_store.CellStore(store_path).num_cells
+  return [(begin_idx, min(begin_idx + range_size, num_cells))
+          for begin_idx in range(0, num_cells, range_size)]
+
+
+def cell_store_to_examples(store_path, cell_range, vocabulary=None,
+                           transforms=None):
+  """Convert a range of cells from a cell store to TensorFlow Example protos.
+
+  The cells in a store are already grouped, so no shuffle is needed.
+
+  Args:
+    store_path: Path of the cell store directory.
+    cell_range: (begin_idx, end_idx) tuple of the cells to convert
+    vocabulary: optional dictionary from read_vocabulary
+    transforms: optional list from parse_transforms
+
+  Yields:
+    A TensorFlow Example proto for each cell having nonzero measurements.
+  """
+  store = cell_store.CellStore(store_path)
+  begin_idx, end_idx = cell_range
+  matrix = store.cells(begin_idx, end_idx)
+  genes = np.array(store.genes)
+  for cell in range(end_idx - begin_idx):
+    first, last = matrix.indptr[cell], matrix.indptr[cell + 1]
+    if first == last:
+      continue
+    yield sparse_measurements_to_example(
+        store.barcodes[begin_idx + cell],
+        genes[matrix.indices[first:last]].tolist(),
+        matrix.data[first:last].tolist(), vocabulary, transforms)
+
+
+def cell_store_measurement_stats(store_path, cell_range):
+  """Compute the statistics of each gene over a range of cells of a store.
+
+  As in sample_measurement_stats, the values of each cell are first scaled to
+  a total of LIBRARY_SIZE.
+
+  Args:
+    store_path: Path of the cell store directory.
+    cell_range: (begin_idx, end_idx) tuple of the cells
+
+  Yields:
+    A (gene, (count, mean, sum of squared deviations)) tuple for each gene
+    with nonzero values in the range.
+  """
+  store = cell_store.CellStore(store_path)
+  matrix = store.cells(*cell_range)
+  data = np.asarray(matrix.data, dtype=np.float64)
+  totals = np.repeat(np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel(),
+                     np.diff(matrix.indptr))
+  data = data * LIBRARY_SIZE / np.maximum(totals, 1e-12)
+  counts = np.bincount(matrix.indices, minlength=store.num_genes)
+  means = np.bincount(matrix.indices, weights=data,
+                      minlength=store.num_genes) / np.maximum(counts, 1)
+  deviations = data - means[matrix.indices]
+  m2 = np.bincount(matrix.indices, weights=deviations * deviations,
+                   minlength=store.num_genes)
+  for gene in np.flatnonzero(counts).tolist():
+    yield store.genes[gene], (int(counts[gene]), float(means[gene]),
+                              float(m2[gene]))
+
+
+def read_csv_header(file_pattern):
+  """Read the column names from the first CSV file matching a pattern.
+
+  Args:
+    file_pattern: pattern of CSV files sharing the same header
+
+  Returns:
+    The list of the column names.
+  """
+  input_files = sorted(tf.gfile.Glob(file_pattern))
+  if not input_files:
+    raise ValueError('No files match %s.' % file_pattern)
+  with tf.gfile.Open(input_files[0], 'r') as f:
+    return f.readline().rstrip('\r\n').split(',')
+
+
+def csv_line_to_row(line, positions):
+  """Convert a line of a long format CSV file to a measurement row.
+
+  Args:
+    line: a line of text, without quoting
+    positions: list of (key, column index) tuples for the keys of
+      DATA_QUERY_REPLACEMENTS
+
+  Returns:
+    A dictionary with the keys of DATA_QUERY_REPLACEMENTS.
+  """
+  fields = line.split(',')
+  row = dict((key, fields[idx]) for key, idx in positions)
+  row[VALUE_COLUMN] = float(row[VALUE_COLUMN])
+  return row
+
+
+def csv_column_positions(file_pattern, fields):
+  """Find the columns of CSV files holding the measurement row fields.
+
+  Args:
+    file_pattern: pattern of CSV files sharing the same header
+    fields: list of (key, column name) tuples for the keys of
+      DATA_QUERY_REPLACEMENTS
+
+  Returns:
+    A list of (key, column index) tuples.
+  """
+  columns = read_csv_header(file_pattern)
+  missing = [field for _, field in fields if field not in columns]
+  if missing:
+    raise ValueError('%s lacks the columns %s.'
+                     % (file_pattern, ', '.join(missing)))
+  return [(key, columns.index(field)) for key, field in fields]
+
+
+def measurement_fields(preprocess_options):
+  """The column names of the measurement row fields in CSV or Parquet files."""
+  return [(SAMPLE_COLUMN, preprocess_options.sample_field),
+          (MEASUREMENT_COLUMN, preprocess_options.measurement_field),
+          (VALUE_COLUMN, preprocess_options.value_field)]
+
+
+def sorted_file_ranges(file_pattern, range_bytes=SORTED_RANGE_BYTES):
+  """Split files into byte ranges to be read in parallel.
+
+  Args:
+    file_pattern: pattern of the files
+    range_bytes: the maximum size of each range
+
+  Returns:
+    A list of (file, begin offset, end offset) tuples.
+  """
+  file_ranges = []
+  for input_file in sorted(tf.gfile.Glob(file_pattern)):
+    size = tf.gfile.Stat(input_file).length
+    file_ranges.extend((input_file, begin, min(begin + range_bytes, size))
+                       for begin in range(0, size, range_bytes))
+  return file_ranges
+
+
+def read_range_lines(input_file, begin, end):
+  """Read the lines of a CSV file starting within a byte range.
+
+  Args:
+    input_file: path of the CSV file
+    begin: offset of the first byte of the range
+    end: offset at which the range stops
+
+  Yields:
+    Each line starting at or after begin and before end, other than the
+    header.
+  """
+  with tf.gfile.Open(input_file, 'r') as f:
+    # Skip the header, or the rest of a line starting before the range.
+    f.seek(max(begin - 1, 0))
+    f.readline()
+    while f.tell() < end:
+      line = f.readline().rstrip('\r\n')
+      if not line:
+        break
+      yield line
+
+
+def group_sorted_range(file_range, positions):
+  """Group the consecutive rows of each sample in a range of a sorted file.
+
+  The first and last samples of the range may continue in the neighboring
+  ranges, so they are tagged to be merged with their other parts. A sample
+  reappearing after other samples raises a ValueError, since the file is then
+  not grouped by sample.
+
+  Args:
+    file_range: (file, begin offset, end offset) tuple
+    positions: list of (key, column index) tuples for the keys of
+      DATA_QUERY_REPLACEMENTS
+
+  Yields:
+    A (sample, (list of measurement names, array of values)) tuple for each
+    sample in the range.
+  """
+  rows = (csv_line_to_row(line, positions)
+          for line in read_range_lines(*file_range))
+  previous = None
+  seen = set()
+  for idx, (sample, sample_rows) in enumerate(
+      itertools.groupby(rows, key=lambda row: row[SAMPLE_COLUMN])):
+    if sample in seen:
+      raise ValueError('The rows of sample %s are not consecutive in %s, '
+                       'which cannot be read with --sorted_input.'
+                       % (sample, file_range[0]))
+    seen.add(sample)
+    measurements, values = [], array.array('f')
+    for row in sample_rows:
+      measurements.append(row[MEASUREMENT_COLUMN])
+      values.append(row[VALUE_COLUMN])
+    if previous is not None:
+      yield (beam.pvalue.TaggedOutput(BOUNDARY_TAG, previous) if idx == 1
+             else previous)
+    previous = (sample, (measurements, values))
+  if previous is not None:
+    yield beam.pvalue.TaggedOutput(BOUNDARY_TAG, previous)
+
+
+def check_sample_count(sample_count):
+  """Raise an error if a sample was grouped more than once."""
+  sample, count = sample_count
+  if count > 1:
+    raise ValueError('The rows of sample %s are in %d separate places in the '
+                     'input, which cannot be read with --sorted_input.'
+                     % (sample, count))
+
+
+def read_sorted_samples(p, preprocess_options):
+  """Group the measurements of CSV files in which samples are consecutive.
+
+  Each sample is grouped while its file is read, so only the samples at the
+  boundaries of the ranges read in parallel are shuffled, along with the
+  sample names to check that no sample was grouped in more than one place.
+
+  Args:
+    p: the pipeline
+    preprocess_options: PreprocessOptions naming the input
+
+  Returns:
+    A PCollection of (sample, (list of measurement names, array of values))
+    tuples, in which each measurement of a sample appears once.
+  """
+  positions = csv_column_positions(preprocess_options.input,
+                                   measurement_fields(preprocess_options))
+  groups = (
+      p
+      | 'CreateFileRanges' >> beam.Create(
+          sorted_file_ranges(preprocess_options.input))
+      | 'GroupSortedRanges' >> beam.FlatMap(
+          group_sorted_range, positions).with_outputs(BOUNDARY_TAG,
+                                                      main='samples'))
+  boundary_samples = (groups[BOUNDARY_TAG]
+                      | 'MergeBoundarySamples' >> beam.CombinePerKey(
+                          merge_sample_measurements))
+  samples = ((groups.samples, boundary_samples)
+             | 'FlattenSamples' >> beam.Flatten()
+             | 'SumDuplicateMeasurements' >> beam.Map(
+                 sum_duplicate_measurements))
+  _ = (samples
+       | 'KeySampleNames' >> beam.Map(
+           lambda sample_measurements: (sample_measurements[0], 1))
+       | 'CountSampleNames' >> beam.CombinePerKey(sum)
+       | 'CheckSampleCounts' >> beam.Map(check_sample_count))
+  return samples
+
+
+def read_measurement_rows(p, preprocess_options):
+  """Read the measurement rows from BigQuery, CSV or Parquet.
+
+  Args:
+    p: the pipeline
+    preprocess_options: PreprocessOptions naming the input
+
+  Returns:
+    A PCollection of dictionaries with the keys of DATA_QUERY_REPLACEMENTS.
+  """
+  fields = measurement_fields(preprocess_options)
+
+  if preprocess_options.input_format == 'csv':
+    positions = csv_column_positions(preprocess_options.input, fields)
+    return (p
+            | 'ReadMeasurements' >> beam.io.ReadFromText(
+                preprocess_options.input, skip_header_lines=1)
+            | 'ParseMeasurements' >> beam.Map(csv_line_to_row, positions))
+
+  if preprocess_options.input_format == 'parquet':
+    return (p
+            | 'ReadMeasurements' >> beam.io.ReadFromParquet(
+                preprocess_options.input,
+                columns=[field for _, field in fields])
+            | 'RenameMeasurements' >> beam.Map(
+                lambda record: dict((key, record[field])
+                                    for key, field in fields)))
+
+  data_query = str(
+      Template(open(preprocess_options.input, 'r').read()).render(
+          DATA_QUERY_REPLACEMENTS))
+  logging.info('data query : %s', data_query)
+
+  # Read the table rows into a PCollection.
+  return p | 'ReadMeasurements' >> beam.io.Read(
+      beam.io.BigQuerySource(query=data_query, use_standard_sql=True))
+
+
+def example_to_record(example):
+  """Serialize an example along with the fields of its shard index entry.
+
+  Args:
+    example: a TensorFlow Example proto from sparse_measurements_to_example
+
+  Returns:
+    A tuple of the sample name, the serialized example, its number of nonzero
+    measurements and the sum of its values.
+  """
+  feature = example.features.feature
+  values = feature[VALUES_FEATURE].float_list.value
+  return (feature[SAMPLE_NAME_FEATURE].bytes_list.value[0],
+          example.SerializeToString(), len(values), float(sum(values)))
+
 
-  sample_meas_kvs = meas_kvs | 'GroupBySample' >> beam.GroupByKey()
+def shard_of(sample, num_shards):
+  """Assign a sample to a shard, deterministically so that retries agree."""
+  return (zlib.crc32(sample) & 0xffffffff) % num_shards
 
-  examples = (
-      sample_meas_kvs
-      | 'SamplesToExamples' >>
-      beam.Map(lambda (key, vals): sample_measurements_to_example(key, vals)))
 
-  return examples
+class WriteShardFn(beam.DoFn):
+  """Write a shard of records along with its index file."""
+
+  def __init__(self, output_dir, compressed):
+    super(WriteShardFn, self).__init__()
+    self.output_dir = output_dir
+    self.compressed = compressed
+
+  def process(self, shard_records, num_shards):
+    """Write the shard and yield its description for shards.json.
+
+    Args:
+      shard_records: tuple of the shard and its records from
+        example_to_record
+      num_shards: the number of shards
+
+    Yields:
+      A dictionary describing the shard.
+    """
+    shard, records = shard_records
+    shard_file = example_shards.shard_file_name(shard, num_shards,
+                                                self.compressed)
+    shard_path = os.path.join(self.output_dir, shard_file)
+    options = None
+    if self.compressed:
+      options = tf.python_io.TFRecordOptions(
+          tf.python_io.TFRecordCompressionType.GZIP)
+
+    # Write to temporary files so that a retried bundle never leaves a
+    # partially written shard.
+    offset = 0
+    num_values = 0
+    entries = []
+    with tf.python_io.TFRecordWriter(shard_path + '.tmp',
+                                     options=options) as writer:
+      for sample, serialized, nnz, total in records:
+        writer.write(serialized)
+        entries.append(example_shards.IndexEntry(sample, offset,
+                                                 len(serialized), nnz, total))
+        offset += len(serialized) + example_shards.RECORD_OVERHEAD_BYTES
+        num_values += nnz
+    index_file = example_shards.index_file_name(shard, num_shards)
+    index_path = os.path.join(self.output_dir, index_file)
+    with tf.gfile.Open(index_path + '.tmp', 'w') as f:
+      f.write('\t'.join(example_shards.INDEX_COLUMNS) + '\n')
+      for entry in entries:
+        f.write(example_shards.format_index_entry(entry))
+    tf.gfile.Rename(shard_path + '.tmp', shard_path, overwrite=True)
+    tf.gfile.Rename(index_path + '.tmp', index_path, overwrite=True)
+
+    yield {
+        'file': shard_file,
+        'index_file': index_file,
+        'num_records': len(entries),
+        'num_values': num_values,
+        'uncompressed_bytes': offset
+    }
+
+
+def write_shards_manifest(shards, output_dir, compressed):
+  """Write shards.json describing all the shards, see example_shards."""
+  shards = sorted(shards, key=lambda shard: shard['file'])
+  with tf.gfile.Open(os.path.join(output_dir, example_shards.SHARDS_FILE),
+                     'w') as f:
+    json.dump({
+        'compression': 'GZIP' if compressed else 'NONE',
+        'num_records': sum(shard['num_records'] for shard in shards),
+        'num_values': sum(shard['num_values'] for shard in shards),
+        'shards': shards
+    }, f, indent=2, sort_keys=True)
+
+
+def write_balanced_shards(examples, output_dir, num_shards=0,
+                          target_shard_bytes=0, compressed=True):
+  """Write examples to shards of a chosen number or size, with index files.
+
+  Samples are assigned to shards by a hash of their name, so that the shards
+  hold about the same number of records.
+
+  Args:
+    examples: PCollection of TensorFlow Example protos
+    output_dir: Output directory to which to write the shards.
+    num_shards: the number of shards, or 0 to derive it from
+      target_shard_bytes
+    target_shard_bytes: the approximate uncompressed size of each shard
+    compressed: whether to compress the shards with GZIP, which prevents
+      reading single records using their offsets
+  """
+  records = examples | 'ExamplesToRecords' >> beam.Map(example_to_record)
+  if num_shards:
+    shard_count = records.pipeline | 'NumShards' >> beam.Create([num_shards])
+  else:
+    shard_count = (
+        records
+        | 'RecordBytes' >> beam.Map(
+            lambda record: (len(record[1]) +
+                            example_shards.RECORD_OVERHEAD_BYTES))
+        | 'SumRecordBytes' >> beam.CombineGlobally(sum)
+        | 'ComputeNumShards' >> beam.Map(
+            lambda total: max(1, int(math.ceil(
+                total / float(target_shard_bytes))))))
+  shard_count = beam.pvalue.AsSingleton(shard_count)
+
+  _ = (records
+       | 'KeyByShard' >> beam.Map(
+           lambda record, num_shards: (shard_of(record[0], num_shards),
+                                       record),
+           shard_count)
+       | 'GroupByShard' >> beam.GroupByKey()
+       | 'WriteShards' >> beam.ParDo(WriteShardFn(output_dir, compressed),
+                                     shard_count)
+       | 'GatherShards' >> beam.combiners.ToList()
+       | 'WriteShardsManifest' >> beam.Map(write_shards_manifest, output_dir,
+                                           compressed))
 
 
 class PreprocessOptions(PipelineOptions):
@@ -100,7 +1006,97 @@ class PreprocessOptions(PipelineOptions):
     parser.add_argument(
         '--input',
         required=True,
-        help='Jinja file holding the query for the sample data.')
+        help='Jinja file holding the query for the sample data, the file '
+        'pattern of the CSV or Parquet files, or the path of the cell store '
+        'directory.')
+    parser.add_argument(
+        '--input_format',
+        choices=['bigquery', 'csv', 'parquet', 'cell_store'],
+        default='bigquery',
+        help='Whether --input is a query for BigQuery, long format CSV files '
+        'with a header, long format Parquet files, or a local cell store, '
+        'which can only be read by the DirectRunner.')
+    parser.add_argument(
+        '--sample_field',
+        default=DEFAULT_SAMPLE_FIELD,
+        help='The column of the CSV or Parquet files holding the sample.')
+    parser.add_argument(
+        '--measurement_field',
+        default=DEFAULT_MEASUREMENT_FIELD,
+        help='The column of the CSV or Parquet files holding the measurement '
+        'name.')
+    parser.add_argument(
+        '--value_field',
+        default=DEFAULT_VALUE_FIELD,
+        help='The column of the CSV or Parquet files holding the value.')
+    parser.add_argument(
+        '--sorted_input',
+        action='store_true',
+        help='Whether the rows of each sample are consecutive in the CSV '
+        'files, as in the CSV written by hdf5_to_sparse.py, and no sample '
+        'spans two files other than at their ends. The rows are then grouped '
+        'as the files are read, without shuffling them. The CSV written by '
+        'dense_to_sparse.py is grouped by measurement instead. A sample whose '
+        'rows are not consecutive fails the pipeline.')
+    parser.add_argument(
+        '--num_shards',
+        type=int,
+        default=0,
+        help='If nonzero, the number of shards of examples to write, each '
+        'with an index file. By default the runner chooses the number of '
+        'shards and no index files are written.')
+    parser.add_argument(
+        '--target_shard_bytes',
+        type=int,
+        default=0,
+        help='If nonzero and --num_shards is not set, the approximate '
+        'uncompressed size of each shard of examples to write, each with an '
+        'index file.')
+    parser.add_argument(
+        '--uncompressed_shards',
+        action='store_true',
+        help='Whether to write the shards of --num_shards or '
+        '--target_shard_bytes without compression, so that single examples '
+        'can be read using the offsets in the index files.')
+    parser.add_argument(
+        '--grouping',
+        choices=['combine', 'group_by_key'],
+        default='combine',
+        help='Whether to group the measurements of each sample with a '
+        'combiner, which combines them into compact arrays before the '
+        'shuffle, or with GroupByKey, which shuffles every row.')
+    parser.add_argument(
+        '--hot_key_fanout',
+        type=int,
+        default=0,
+        help='If nonzero, the number of intermediate keys over which the '
+        'measurements of each sample are combined, to spread samples with '
+        'very many measurements over more workers.')
+    parser.add_argument(
+        '--vocabulary_file',
+        help='If set, a newline-separated file of measurement names. The '
+        'measurements of each example are then stored as sorted int64 '
+        'indices into it, and a copy of it is written with the examples.')
+    parser.add_argument(
+        '--write_measurement_stats',
+        action='store_true',
+        help='Whether to also write the number of nonzero values, and the '
+        'mean and variance of the library size normalized values, of each '
+        'measurement, the vocabulary of all measurements and a vocabulary of '
+        'the most highly variable measurements.')
+    parser.add_argument(
+        '--num_highly_variable',
+        type=int,
+        default=2000,
+        help='The number of measurements with the highest dispersion, '
+        'relative to measurements of similar mean, to write to the highly '
+        'variable vocabulary.')
+    parser.add_argument(
+        '--transforms',
+        help='Comma-separated list of the transforms to apply to the values '
+        'of each sample, always in the order library_size (scale the values '
+        'to sum to %d), log1p and l2 (scale the values to unit L2 norm).'
+        % LIBRARY_SIZE)
 
 
 def run(argv=None):
@@ -122,27 +1118,87 @@ def run(argv=None):
   cloud_options.job_name = 'preprocess-measurements-%s' % (
       datetime.datetime.now().strftime('%y%m%d-%H%M%S'))
 
-  data_query = str(
-      Template(open(preprocess_options.input, 'r').read()).render(
-          DATA_QUERY_REPLACEMENTS))
-  logging.info('data query : %s', data_query)
+  transforms = parse_transforms(preprocess_options.transforms)
+  vocabulary = None
+  tf.gfile.MakeDirs(output_dir)
+  if preprocess_options.vocabulary_file:
+    vocabulary = read_vocabulary(preprocess_options.vocabulary_file)
+    tf.gfile.Copy(preprocess_options.vocabulary_file,
+                  os.path.join(output_dir, VOCABULARY_FILE))
+  with tf.gfile.Open(os.path.join(output_dir, METADATA_FILE), 'w') as f:
+    json.dump({
+        'input': preprocess_options.input,
+        'input_format': preprocess_options.input_format,
+        'measurement_indices': vocabulary is not None,
+        'transforms': transforms,
+        'library_size': LIBRARY_SIZE
+    }, f, indent=2, sort_keys=True)
 
   with beam.Pipeline(options=pipeline_options) as p:
-    # Read the table rows into a PCollection.
-    rows = p | 'ReadMeasurements' >> beam.io.Read(
-        beam.io.BigQuerySource(query=data_query, use_standard_sql=True))
-
-    # Convert the data into TensorFlow Example Protocol Buffers.
-    examples = measurements_to_examples(rows)
-
-    # Write the serialized compressed protocol buffers to Cloud Storage.
-    _ = (examples
-         | 'EncodeExamples'
-         >> beam.Map(lambda example: example.SerializeToString())
-         | 'WriteExamples' >> tfrecordio.WriteToTFRecord(
-             file_path_prefix=os.path.join(output_dir, 'examples'),
-             compression_type=CompressionTypes.GZIP,
-             file_name_suffix='.tfrecord.gz'))
+    if preprocess_options.input_format == 'cell_store':
+      store_path = preprocess_options.input
+      cell_ranges = p | 'CreateCellRanges' >> beam.Create(
+          cell_store_ranges(store_path))
+      examples = (
+          cell_ranges
+          | 'CellStoreToExamples' >> beam.FlatMap(
+              lambda cell_range: cell_store_to_examples(store_path,
+                                                        cell_range,
+                                                        vocabulary,
+                                                        transforms)))
+      if preprocess_options.write_measurement_stats:
+        measurement_stats = (
+            cell_ranges
+            | 'CellStoreMeasurementStats' >> beam.FlatMap(
+                lambda cell_range: cell_store_measurement_stats(store_path,
+                                                                cell_range)))
+    elif preprocess_options.sorted_input:
+      if preprocess_options.input_format != 'csv':
+        raise ValueError('--sorted_input requires --input_format csv.')
+      samples = read_sorted_samples(p, preprocess_options)
+      examples = samples_to_examples(samples, vocabulary, transforms)
+      if preprocess_options.write_measurement_stats:
+        measurement_stats = samples | 'MeasurementValueStats' >> beam.FlatMap(
+            sample_measurement_stats)
+    else:
+      rows = read_measurement_rows(p, preprocess_options)
+      samples = group_measurements(rows,
+                                   preprocess_options.grouping == 'combine',
+                                   preprocess_options.hot_key_fanout)
+
+      # Convert the data into TensorFlow Example Protocol Buffers.
+      examples = samples_to_examples(samples, vocabulary, transforms)
+      if preprocess_options.write_measurement_stats:
+        measurement_stats = samples | 'MeasurementValueStats' >> beam.FlatMap(
+            sample_measurement_stats)
+
+    if preprocess_options.write_measurement_stats:
+      # The statistics are combined per measurement in the same pass as the
+      # examples are written, and gathered once to select the vocabularies.
+      num_samples = examples | 'CountSamples' >> beam.combiners.Count.Globally()
+      _ = (measurement_stats
+           | 'CombineMeasurementStats' >> beam.CombinePerKey(
+               MeasurementStatsCombineFn())
+           | 'GatherMeasurementStats' >> beam.combiners.ToList()
+           | 'WriteMeasurementStats' >> beam.Map(
+               write_measurement_stats,
+               beam.pvalue.AsSingleton(num_samples), output_dir,
+               preprocess_options.num_highly_variable))
+
+    if preprocess_options.num_shards or preprocess_options.target_shard_bytes:
+      write_balanced_shards(examples, output_dir,
+                            preprocess_options.num_shards,
+                            preprocess_options.target_shard_bytes,
+                            not preprocess_options.uncompressed_shards)
+    else:
+      # Write the serialized compressed protocol buffers to Cloud Storage.
+      _ = (examples
+           | 'EncodeExamples'
+           >> beam.Map(lambda example: example.SerializeToString())
+           | 'WriteExamples' >> tfrecordio.WriteToTFRecord(
+               file_path_prefix=os.path.join(output_dir, 'examples'),
+               compression_type=CompressionTypes.GZIP,
+               file_name_suffix='.tfrecord.gz'))
 
 
 if __name__ == '__main__':
@@ -4,7 +4,17 @@
 # license that can be found in the LICENSE file.
 """Test encoding of sparse count data to TensorFlow features."""
 
+import array
+import os
+import shutil
+import tempfile
 import unittest
+
+import apache_beam as beam
+from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.util import assert_that
+from apache_beam.testing.util import equal_to
+import numpy as np
 from trainer import preprocess_measurements as preproc
 
 # Test data.
@@ -21,6 +31,11 @@ MEASUREMENTS = [{
 }]
 
 
+def flatten_sample(sample_measurements):
+  sample, (measurements, values) = sample_measurements
+  return sample, list(measurements), list(values)
+
+
 class PreprocessMeasurementsTest(unittest.TestCase):
 
   def test_sample_measurements_to_example(self):
@@ -57,6 +72,162 @@ class PreprocessMeasurementsTest(unittest.TestCase):
         expected,
         str(preproc.sample_measurements_to_example(SAMPLE_ID, MEASUREMENTS)))
 
+  def test_sample_measurements_combine_fn(self):
+    combine_fn = preproc.SampleMeasurementsCombineFn()
+    accumulators = []
+    for measurement in MEASUREMENTS:
+      accumulators.append(combine_fn.add_input(
+          combine_fn.create_accumulator(),
+          (measurement[preproc.MEASUREMENT_COLUMN],
+           measurement[preproc.VALUE_COLUMN])))
+    measurements, values = combine_fn.extract_output(
+        combine_fn.merge_accumulators(accumulators))
+    self.assertEqual(
+        str(preproc.sample_measurements_to_example(SAMPLE_ID, MEASUREMENTS)),
+        str(preproc.sparse_measurements_to_example(SAMPLE_ID, measurements,
+                                                   values.tolist())))
+
+  def test_sample_measurements_to_example_with_vocabulary(self):
+    vocabulary = {'Rho': 0, 'Prkca': 1, 'Glul': 2}
+    example = preproc.sample_measurements_to_example(SAMPLE_ID, MEASUREMENTS,
+                                                     vocabulary)
+    features = example.features.feature
+    self.assertNotIn(preproc.MEASUREMENTS_FEATURE, features)
+    self.assertEqual(
+        [1, 2],
+        list(features[preproc.MEASUREMENT_INDICES_FEATURE].int64_list.value))
+    self.assertEqual([35, 8],
+                     list(features[preproc.VALUES_FEATURE].float_list.value))
+
+  def test_measurement_stats(self):
+    combine_fn = preproc.MeasurementStatsCombineFn()
+    glul = combine_fn.merge_accumulators([
+        combine_fn.add_input(combine_fn.create_accumulator(),
+                             preproc.value_stats(1)),
+        combine_fn.add_input(combine_fn.create_accumulator(),
+                             preproc.value_stats(2))])
+    self.assertEqual((2, 1.5, 0.5), glul)
+    names, counts, means, variances, dispersions = (
+        preproc.summarize_measurement_stats(
+            [('Prkca', (1, 10.0, 0.0)), ('Glul', glul)], num_samples=4))
+    self.assertEqual(['Glul', 'Prkca'], names.tolist())
+    self.assertEqual([2, 1], counts.tolist())
+    self.assertEqual([0.75, 2.5], means.tolist())
+    self.assertEqual([0.6875, 18.75], variances.tolist())
+    self.assertEqual(['Prkca'], preproc.select_highly_variable(
+        names, dispersions, 1))
+
+  def test_measurement_stats_of_large_values(self):
+    # The variance of large values with a small spread is not lost to
+    # cancellation.
+    stats = preproc.MeasurementStatsCombineFn().merge_accumulators(
+        [preproc.value_stats(1e9 + 1), preproc.value_stats(1e9 + 2)])
+    _, _, _, variances, _ = preproc.summarize_measurement_stats(
+        [('Glul', stats)], num_samples=2)
+    self.assertAlmostEqual(0.25, variances[0])
+
+  def test_sample_measurement_stats(self):
+    self.assertEqual(
+        [('Glul', (1, 2500.0, 0.0)), ('Prkca', (1, 7500.0, 0.0))],
+        preproc.sample_measurement_stats(('cell1', (['Glul', 'Prkca'],
+                                                    [1, 3]))))
+
+  def test_normalize_dispersions(self):
+    # Two groups of measurements of very different means, with the same
+    # spread of dispersions within each group.
+    names = np.array(['a', 'b', 'c', 'd', 'e', 'f'], dtype=object)
+    means = np.array([1, 1.1, 1.2, 100, 110, 120])
+    dispersions = np.array([1, 2, 4, 10, 20, 40])
+    normalized = preproc.normalize_dispersions(means, dispersions, num_bins=2)
+    np.testing.assert_allclose(normalized[:3], normalized[3:])
+    self.assertEqual(['c', 'f'], preproc.select_highly_variable(
+        names, normalized, 2))
+    self.assertEqual(['e', 'f'], preproc.select_highly_variable(
+        names, dispersions, 2))
+
+  def test_transform_values(self):
+    transforms = preproc.parse_transforms('l2,library_size')
+    self.assertEqual(['library_size', 'l2'], transforms)
+    self.assertEqual([0.6, 0.8],
+                     preproc.transform_values([3, 4], transforms, total=10))
+    self.assertEqual([preproc.LIBRARY_SIZE * 0.25, preproc.LIBRARY_SIZE * 0.75],
+                     preproc.transform_values([1, 3], ['library_size']))
+    with self.assertRaises(ValueError):
+      preproc.parse_transforms('log2')
+
+  def test_csv_line_to_row(self):
+    positions = [(preproc.SAMPLE_COLUMN, 2), (preproc.MEASUREMENT_COLUMN, 1),
+                 (preproc.VALUE_COLUMN, 3)]
+    self.assertEqual(MEASUREMENTS[1], preproc.csv_line_to_row(
+        'ENSMUSG00000050965,Prkca,cell1,35', positions))
+
+  def test_group_measurements_sums_repeated_measurements(self):
+    positions = [(preproc.SAMPLE_COLUMN, 0), (preproc.MEASUREMENT_COLUMN, 1),
+                 (preproc.VALUE_COLUMN, 2)]
+    # Glul is repeated, as for gene ids sharing a gene name.
+    rows = [preproc.csv_line_to_row(line, positions)
+            for line in ['cell1,Glul,8', 'cell1,Prkca,35', 'cell1,Glul,2',
+                         'cell2,Rho,1']]
+    expected = [('cell1', ['Glul', 'Prkca'], [10, 35]), ('cell2', ['Rho'], [1])]
+    for combine in [True, False]:
+      with TestPipeline() as p:
+        samples = preproc.group_measurements(p | beam.Create(rows), combine)
+        assert_that(samples | beam.Map(flatten_sample), equal_to(expected))
+
+  def test_sum_duplicate_measurements(self):
+    sample = ('cell1', (['Prkca', 'Glul'], array.array('f', [35, 8])))
+    self.assertIs(sample, preproc.sum_duplicate_measurements(sample))
+    self.assertEqual(
+        ('cell1', ['Glul', 'Prkca'], [10, 35]),
+        flatten_sample(preproc.sum_duplicate_measurements(
+            ('cell1', (['Glul', 'Prkca', 'Glul'],
+                       array.array('f', [8, 35, 2]))))))
+
+  def test_group_sorted_range(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      input_file = os.path.join(temp_dir, 'sorted.csv')
+      with open(input_file, 'w') as f:
+        f.write('cell,gene,trans_cnt\n'
+                'cell1,Glul,8\ncell1,Prkca,35\n'
+                'cell2,Glul,1\n'
+                'cell3,Rho,2\ncell3,Glul,3\n')
+      positions = [(preproc.SAMPLE_COLUMN, 0), (preproc.MEASUREMENT_COLUMN, 1),
+                   (preproc.VALUE_COLUMN, 2)]
+      outputs = list(preproc.group_sorted_range(
+          (input_file, 0, os.path.getsize(input_file)), positions))
+    finally:
+      shutil.rmtree(temp_dir)
+
+    # Only the first and last samples may continue in other ranges.
+    self.assertEqual([preproc.BOUNDARY_TAG, None, preproc.BOUNDARY_TAG],
+                     [getattr(output, 'tag', None) for output in outputs])
+    samples = [getattr(output, 'value', output) for output in outputs]
+    self.assertEqual(['cell1', 'cell2', 'cell3'],
+                     [sample for sample, _ in samples])
+    self.assertEqual((['Glul', 'Prkca'], [8, 35]),
+                     (samples[0][1][0], samples[0][1][1].tolist()))
+
+  def test_group_sorted_range_of_unsorted_file(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      # Rows grouped by gene, as written by dense_to_sparse.py.
+      input_file = os.path.join(temp_dir, 'by_gene.csv')
+      with open(input_file, 'w') as f:
+        f.write('cell,gene,trans_cnt\n'
+                'cell1,Glul,8\ncell2,Glul,1\n'
+                'cell1,Prkca,35\n')
+      positions = [(preproc.SAMPLE_COLUMN, 0), (preproc.MEASUREMENT_COLUMN, 1),
+                   (preproc.VALUE_COLUMN, 2)]
+      with self.assertRaises(ValueError):
+        list(preproc.group_sorted_range(
+            (input_file, 0, os.path.getsize(input_file)), positions))
+    finally:
+      shutil.rmtree(temp_dir)
+    with self.assertRaises(ValueError):
+      preproc.check_sample_count(('cell1', 2))
+    preproc.check_sample_count(('cell1', 1))
+
 
 if __name__ == '__main__':
   unittest.main()
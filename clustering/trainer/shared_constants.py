@@ -7,4 +7,7 @@
 # Names of features in the tf.Example proto.
 SAMPLE_NAME_FEATURE = 'sample_name'
 MEASUREMENTS_FEATURE = 'meas'
+# Sorted int64 indices into a vocabulary, used instead of MEASUREMENTS_FEATURE
+# when examples are preprocessed with a vocabulary file.
+MEASUREMENT_INDICES_FEATURE = 'meas_idx'
 VALUES_FEATURE = 'values'
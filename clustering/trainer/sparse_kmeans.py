@@ -0,0 +1,250 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Mini-batch k-means clustering of sparse batches.
+
+KMeansClustering requires dense batches of shape [batch_size, num_features].
+With tens of thousands of measurements and a few percent of them nonzero, most
+of each batch is zeros. This estimator instead computes the distances of a
+sparse batch to the clusters as
+
+  ||x||^2 - 2 * x . c + ||c||^2
+
+with a sparse-dense matrix multiplication, so that batches are never
+densified, other than once to initialize the clusters. Cosine distance is
+computed as 1 - x . c on normalized inputs and clusters.
+
+The clusters are updated with the per-cluster learning rate of
+https://www.eecs.tufts.edu/~dsculley/papers/fastkmeans.pdf, so that each
+cluster is the mean of all the samples assigned to it so far.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+from tensorflow.contrib.learn.python.learn.estimators import model_fn as model_fn_lib
+
+# Keys of the predictions, shared with KMeansClustering so that the exported
+# models of both estimators have the same serving signature outputs.
+ALL_SCORES = "all_scores"
+CLUSTER_IDX = "cluster_idx"
+
+# Names of the variables of the model.
+CLUSTERS_VARIABLE = "clusters"
+CLUSTER_COUNTS_VARIABLE = "cluster_counts"
+INITIALIZED_VARIABLE = "initialized"
+
+# Avoids dividing by the norm of an empty sample.
+EPSILON = 1e-12
+
+
+def _is_sparse(inputs):
+  return isinstance(inputs, tf.SparseTensor)
+
+
+def _squared_row_norms(inputs):
+  """The squared L2 norm of each row of a sparse or dense batch."""
+  if _is_sparse(inputs):
+    return tf.sparse_reduce_sum(
+        tf.SparseTensor(inputs.indices, tf.square(inputs.values),
+                        inputs.dense_shape), axis=1)
+  return tf.reduce_sum(tf.square(inputs), axis=1)
+
+
+def _normalize_rows(inputs):
+  """Scale each row of a sparse or dense batch to unit L2 norm."""
+  if _is_sparse(inputs):
+    norms = tf.sqrt(tf.maximum(_squared_row_norms(inputs), EPSILON))
+    return tf.SparseTensor(
+        inputs.indices,
+        inputs.values / tf.gather(norms, inputs.indices[:, 0]),
+        inputs.dense_shape)
+  return tf.nn.l2_normalize(inputs, 1)
+
+
+def _matmul_clusters(inputs, clusters):
+  """Compute the dot products of each row of a batch with each cluster."""
+  if _is_sparse(inputs):
+    return tf.sparse_tensor_dense_matmul(inputs, clusters, adjoint_b=True)
+  return tf.matmul(inputs, clusters, transpose_b=True)
+
+
+def _sum_by_cluster(inputs, assignments, num_clusters):
+  """Sum the rows of a batch assigned to each cluster."""
+  one_hot = tf.one_hot(assignments, num_clusters, dtype=tf.float32)
+  if _is_sparse(inputs):
+    return tf.transpose(
+        tf.sparse_tensor_dense_matmul(inputs, one_hot, adjoint_a=True))
+  return tf.matmul(one_hot, inputs, transpose_a=True)
+
+
+def _num_rows(inputs):
+  if _is_sparse(inputs):
+    return tf.cast(inputs.dense_shape[0], tf.int32)
+  return tf.shape(inputs)[0]
+
+
+def _to_dense(inputs):
+  if _is_sparse(inputs):
+    return tf.sparse_tensor_to_dense(inputs, validate_indices=False)
+  return inputs
+
+
+def pairwise_distances(inputs, clusters, use_cosine_distance=False):
+  """Compute the distance of each row of a batch to each cluster.
+
+  Args:
+    inputs: SparseTensor or Tensor of shape [batch_size, num_features]
+    clusters: Tensor of shape [num_clusters, num_features]
+    use_cosine_distance: whether to compute the cosine distance instead of
+      the squared euclidean distance
+
+  Returns:
+    A Tensor of shape [batch_size, num_clusters].
+  """
+  if use_cosine_distance:
+    return 1 - _matmul_clusters(_normalize_rows(inputs),
+                                tf.nn.l2_normalize(clusters, 1))
+  distances = (tf.expand_dims(_squared_row_norms(inputs), 1)
+               - 2 * _matmul_clusters(inputs, clusters)
+               + tf.expand_dims(tf.reduce_sum(tf.square(clusters), 1), 0))
+  # Rounding can make the distance of a sample to itself slightly negative.
+  return tf.maximum(distances, 0)
+
+
+class _LossRelativeChangeHook(tf.train.SessionRunHook):
+  """Stop training when the relative change in loss goes below a tolerance."""
+
+  def __init__(self, loss, tolerance):
+    self._loss = loss
+    self._tolerance = tolerance
+    self._prev_loss = None
+
+  def before_run(self, run_context):
+    return tf.train.SessionRunArgs(self._loss)
+
+  def after_run(self, run_context, run_values):
+    loss = run_values.results
+    if self._prev_loss is not None:
+      relative_change = abs(loss - self._prev_loss) / (1 + abs(self._prev_loss))
+      if relative_change < self._tolerance:
+        run_context.request_stop()
+    self._prev_loss = loss
+
+
+def _model_fn(features, labels, mode, params):
+  """Model function for SparseKMeansClustering."""
+  del labels  # Clustering is unsupervised.
+  inputs = features
+  if isinstance(features, dict):
+    # The serving input function supplies a dictionary of a single tensor.
+    inputs, = features.values()
+  if not _is_sparse(inputs):
+    inputs = tf.convert_to_tensor(inputs, dtype=tf.float32)
+  num_clusters = params["num_clusters"]
+  use_cosine_distance = params["use_cosine_distance"]
+  initial_clusters = params["initial_clusters"]
+
+  clusters = tf.get_variable(
+      CLUSTERS_VARIABLE, [num_clusters, params["num_features"]],
+      initializer=(tf.zeros_initializer() if initial_clusters is None
+                   else tf.constant_initializer(initial_clusters)),
+      trainable=False)
+  cluster_counts = tf.get_variable(
+      CLUSTER_COUNTS_VARIABLE, [num_clusters],
+      initializer=tf.zeros_initializer(), trainable=False)
+  initialized = tf.get_variable(
+      INITIALIZED_VARIABLE, [], dtype=tf.bool,
+      initializer=tf.constant_initializer(initial_clusters is not None),
+      trainable=False)
+
+  def initialize_clusters():
+    # Use random samples of the first batch as the initial clusters.
+    samples = tf.random_shuffle(tf.range(_num_rows(inputs)))[:num_clusters]
+    with tf.control_dependencies([tf.assign(initialized, True)]):
+      return tf.assign(clusters, tf.gather(_to_dense(inputs), samples))
+
+  if mode == tf.contrib.learn.ModeKeys.TRAIN:
+    current_clusters = tf.cond(initialized, lambda: tf.identity(clusters),
+                               initialize_clusters)
+  else:
+    current_clusters = tf.identity(clusters)
+
+  distances = pairwise_distances(inputs, current_clusters, use_cosine_distance)
+  assignments = tf.argmin(distances, axis=1)
+  loss = tf.reduce_sum(tf.reduce_min(distances, axis=1))
+  predictions = {ALL_SCORES: distances, CLUSTER_IDX: assignments}
+
+  train_op = None
+  training_hooks = []
+  if mode == tf.contrib.learn.ModeKeys.TRAIN:
+    # Cosine distance clusters normalized samples.
+    samples = _normalize_rows(inputs) if use_cosine_distance else inputs
+    batch_counts = tf.reduce_sum(
+        tf.one_hot(assignments, num_clusters, dtype=tf.float32), axis=0)
+    batch_sums = _sum_by_cluster(samples, assignments, num_clusters)
+    new_counts = cluster_counts + batch_counts
+    new_clusters = current_clusters + (
+        (batch_sums - tf.expand_dims(batch_counts, 1) * current_clusters)
+        / tf.expand_dims(tf.maximum(new_counts, 1), 1))
+    train_op = tf.group(
+        tf.assign(clusters, new_clusters),
+        tf.assign(cluster_counts, new_counts),
+        tf.assign_add(tf.train.get_global_step(), 1))
+    if params["relative_tolerance"] is not None:
+      training_hooks.append(
+          _LossRelativeChangeHook(loss, params["relative_tolerance"]))
+
+  return model_fn_lib.ModelFnOps(
+      mode=mode,
+      predictions=predictions,
+      loss=loss,
+      train_op=train_op,
+      training_hooks=training_hooks)
+
+
+class SparseKMeansClustering(tf.contrib.learn.Estimator):
+  """Mini-batch k-means estimator accepting SparseTensor batches."""
+
+  def __init__(self,
+               num_clusters,
+               num_features,
+               model_dir=None,
+               use_cosine_distance=False,
+               relative_tolerance=None,
+               initial_clusters=None,
+               config=None):
+    """Creates a model for running mini-batch k-means on sparse batches.
+
+    Args:
+      num_clusters: The number of clusters to train.
+      num_features: The number of columns of the input batches, such as the
+        size of the vocabulary.
+      model_dir: the directory to save the model results and log files.
+      use_cosine_distance: whether to use the cosine distance instead of the
+        squared euclidean distance.
+      relative_tolerance: A relative tolerance of change in the loss between
+        iterations. Stops learning if the loss changes less than this amount.
+      initial_clusters: if set, an array of the initial clusters, instead of
+        random samples of the first batch.
+      config: See Estimator
+    """
+    super(SparseKMeansClustering, self).__init__(
+        model_fn=_model_fn,
+        params={
+            "num_clusters": num_clusters,
+            "num_features": num_features,
+            "use_cosine_distance": use_cosine_distance,
+            "relative_tolerance": relative_tolerance,
+            "initial_clusters": initial_clusters
+        },
+        model_dir=model_dir,
+        config=config)
+
+  def clusters(self):
+    """Returns the cluster centers."""
+    return self.get_variable_value(CLUSTERS_VARIABLE)
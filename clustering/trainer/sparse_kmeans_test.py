@@ -0,0 +1,42 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test distances of sparse batches to clusters."""
+
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from trainer import sparse_kmeans
+
+# Test data, a batch of three samples and two clusters.
+INPUTS = np.array([[0, 1, 0, 2], [3, 0, 0, 0], [0, 0, 0, 0]], dtype=np.float32)
+CLUSTERS = np.array([[0, 1, 0, 1], [2, 0, 1, 0]], dtype=np.float32)
+
+
+class SparseKMeansTest(unittest.TestCase):
+
+  def distances(self, use_cosine_distance):
+    with tf.Graph().as_default(), tf.Session() as sess:
+      sparse = tf.contrib.layers.dense_to_sparse(tf.constant(INPUTS))
+      return sess.run(sparse_kmeans.pairwise_distances(
+          sparse, tf.constant(CLUSTERS), use_cosine_distance))
+
+  def test_squared_euclidean_distances(self):
+    expected = ((INPUTS[:, np.newaxis, :] - CLUSTERS[np.newaxis, :, :])**2).sum(
+        axis=2)
+    np.testing.assert_allclose(expected, self.distances(False), rtol=1e-5)
+
+  def test_cosine_distances(self):
+    distances = self.distances(True)
+    np.testing.assert_allclose(
+        [[1 - 3 / np.sqrt(10), 1], [1, 1 - 2 / np.sqrt(5)]], distances[:2],
+        rtol=1e-5)
+    # Samples without measurements are equally far from all clusters.
+    np.testing.assert_allclose([1, 1], distances[2])
+
+
+if __name__ == '__main__':
+  unittest.main()
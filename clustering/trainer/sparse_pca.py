@@ -0,0 +1,107 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Randomized principal component analysis of streamed sparse batches.
+
+Clustering tens of thousands of measurements costs batch size x vocabulary
+size x number of clusters per step. Projecting the samples on their first 50
+to 100 principal components first makes each step orders of magnitude
+cheaper, and is the usual preprocessing for clustering single-cell data.
+
+The components are found with a randomized range finder and one power
+iteration, see https://arxiv.org/abs/0909.4061, computed in two passes over
+CSR batches of samples so that neither the data nor its covariance matrix is
+ever held in memory. The samples are centered implicitly, so the batches stay
+sparse.
+"""
+
+import collections
+import io
+
+import numpy as np
+
+PCA_FILE = 'pca.npz'
+DEFAULT_OVERSAMPLES = 10
+
+PCA = collections.namedtuple('PCA', ['components', 'mean', 'explained_variance'])
+
+
+def _covariance_product(batches, matrix):
+  """Multiply the covariance matrix of streamed batches by a dense matrix.
+
+  Args:
+    batches: iterable of CSR matrices of samples by features
+    matrix: array of shape [num_features, n]
+
+  Returns:
+    A tuple of the product, of shape [num_features, n], the mean of the
+    samples and the number of samples.
+  """
+  product = np.zeros(matrix.shape, dtype=np.float64)
+  sums = np.zeros(matrix.shape[0], dtype=np.float64)
+  num_samples = 0
+  for batch in batches:
+    product += batch.T.dot(batch.dot(matrix))
+    sums += np.asarray(batch.sum(axis=0)).ravel()
+    num_samples += batch.shape[0]
+  if not num_samples:
+    raise ValueError('No samples to compute principal components of.')
+  mean = sums / num_samples
+  # Subtract the mean from the samples without densifying them.
+  product = product / num_samples - np.outer(mean, mean.dot(matrix))
+  return product, mean, num_samples
+
+
+def fit_pca(read_batches, num_components, num_features,
+            oversamples=DEFAULT_OVERSAMPLES, seed=0):
+  """Compute the principal components of streamed sparse batches.
+
+  Args:
+    read_batches: function returning an iterable of CSR matrices of samples
+      by features. It is called twice and must return the same samples.
+    num_components: the number of principal components to compute
+    num_features: the number of columns of the batches
+    oversamples: the number of additional random directions to sample, which
+      makes the leading components more accurate
+    seed: seed of the random directions
+
+  Returns:
+    A PCA of the components, of shape [num_components, num_features], the
+    mean of the samples and the variance along each component.
+  """
+  if num_components > num_features:
+    raise ValueError('Cannot compute %d principal components of %d features.'
+                     % (num_components, num_features))
+  num_directions = min(num_components + oversamples, num_features)
+  directions = np.random.RandomState(seed).normal(
+      size=(num_features, num_directions))
+  sketch, _, _ = _covariance_product(read_batches(), directions)
+  basis, _ = np.linalg.qr(sketch)
+  product, mean, num_samples = _covariance_product(read_batches(), basis)
+  projected = basis.T.dot(product)
+  eigenvalues, eigenvectors = np.linalg.eigh((projected + projected.T) / 2)
+  order = np.argsort(eigenvalues)[::-1][:num_components]
+  components = basis.dot(eigenvectors[:, order]).T
+  variance = eigenvalues[order] * num_samples / max(num_samples - 1, 1)
+  return PCA(components.astype(np.float32), mean.astype(np.float32),
+             variance.astype(np.float32))
+
+
+def transform(pca, matrix):
+  """Project a CSR or dense matrix of samples on the principal components."""
+  return (matrix.dot(pca.components.T) -
+          pca.mean.dot(pca.components.T)).astype(np.float32)
+
+
+def save_pca(f, pca):
+  """Write a PCA to a binary file object, such as a tf.gfile.GFile."""
+  buf = io.BytesIO()
+  np.savez(buf, **pca._asdict())
+  f.write(buf.getvalue())
+
+
+def load_pca(f):
+  """Read a PCA written by save_pca from a binary file object."""
+  arrays = np.load(io.BytesIO(f.read()))
+  return PCA(*[arrays[field] for field in PCA._fields])
@@ -0,0 +1,56 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test randomized principal components of streamed sparse batches."""
+
+import io
+import unittest
+
+import numpy as np
+import scipy.sparse as sp_sparse
+from trainer import sparse_pca
+
+
+class SparsePcaTest(unittest.TestCase):
+
+  def setUp(self):
+    random = np.random.RandomState(1)
+    # Sparse samples in a subspace of 3 of 20 features.
+    latent = np.maximum(random.normal(size=(200, 3)), 0) * [9, 3, 1]
+    loadings = random.normal(size=(3, 20))
+    loadings[random.uniform(size=loadings.shape) < 0.5] = 0
+    self.dense = latent.dot(loadings)
+    self.matrix = sp_sparse.csr_matrix(self.dense)
+
+  def read_batches(self):
+    return [self.matrix[begin:begin + 32]
+            for begin in range(0, self.matrix.shape[0], 32)]
+
+  def test_fit_pca(self):
+    pca = sparse_pca.fit_pca(self.read_batches, 3, 20)
+    centered = self.dense - self.dense.mean(axis=0)
+    _, singular_values, vectors = np.linalg.svd(centered, full_matrices=False)
+    np.testing.assert_allclose(self.dense.mean(axis=0), pca.mean, rtol=1e-5)
+    np.testing.assert_allclose(
+        singular_values[:3]**2 / (self.dense.shape[0] - 1),
+        pca.explained_variance, rtol=1e-3)
+    # The components are unique up to their sign.
+    np.testing.assert_allclose(
+        np.ones(3), np.abs((vectors[:3] * pca.components).sum(axis=1)),
+        rtol=1e-3)
+    np.testing.assert_allclose(
+        centered.dot(pca.components.T), sparse_pca.transform(pca, self.matrix),
+        rtol=1e-3, atol=1e-3)
+
+  def test_save_pca(self):
+    pca = sparse_pca.fit_pca(self.read_batches, 2, 20)
+    f = io.BytesIO()
+    sparse_pca.save_pca(f, pca)
+    loaded = sparse_pca.load_pca(io.BytesIO(f.getvalue()))
+    for expected, actual in zip(pca, loaded):
+      np.testing.assert_array_equal(expected, actual)
+
+
+if __name__ == '__main__':
+  unittest.main()
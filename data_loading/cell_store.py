@@ -0,0 +1,164 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+r"""Write sparse data as a memory-mappable, compressed sparse row cell store.
+
+A cell store is a directory holding:
+
+* manifest.json: the format version, the shape of the matrix and the dtype of
+  each array
+* indptr.bin, indices.bin, data.bin: the raw compressed sparse row arrays of
+  the cells by genes matrix, with the gene indices of each cell sorted
+* genes.txt, barcodes.txt: the newline-separated gene and cell dictionaries
+
+Readers open the arrays with numpy.memmap so that any range of cells or subset
+of genes can be read without parsing or copying the whole matrix, see
+clustering/trainer/cell_store.py. The counts of genes sharing a name are
+summed, as in the queries used for clustering.
+"""
+
+import json
+import os
+
+# These are only needed for store output, so that the data loaders continue to
+# work without them when writing CSV.
+try:
+  import numpy as np
+  import scipy.sparse as sp_sparse
+except ImportError:
+  np = None
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+INDPTR_FILE = 'indptr.bin'
+INDICES_FILE = 'indices.bin'
+DATA_FILE = 'data.bin'
+GENES_FILE = 'genes.txt'
+BARCODES_FILE = 'barcodes.txt'
+
+INDPTR_DTYPE = 'int64'
+INDICES_DTYPE = 'int32'
+DATA_DTYPE = 'float32'
+
+
+def write_lines(filename, values):
+  with open(filename, 'w') as handle:
+    for value in values:
+      handle.write(value + '\n')
+
+
+class CellStoreWriter(object):
+  """Append blocks of cells to a cell store directory.
+
+  The data and indices are streamed to disk as each block is written, and the
+  manifest is written last so that a partially written store is never read.
+  """
+
+  def __init__(self, path, genes):
+    """Create the cell store directory.
+
+    Args:
+      path: Path of the directory to create.
+      genes: list of the gene names, possibly with duplicates
+    """
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path = path
+    self.genes, self.gene_idx = np.unique(np.asarray(genes, dtype=str),
+                                          return_inverse=True)
+    self.gene_idx = self.gene_idx.ravel()
+    self.indptr = [np.zeros(1, dtype=INDPTR_DTYPE)]
+    self.nnz = 0
+    self.barcodes = []
+    self.indices_handle = open(os.path.join(path, INDICES_FILE), 'wb')
+    self.data_handle = open(os.path.join(path, DATA_FILE), 'wb')
+
+  def write_cells(self, barcodes, indptr, indices, data):
+    """Append a block of cells.
+
+    Args:
+      barcodes: list of the identifiers of the cells in the block
+      indptr: array of the offsets of each cell's values, starting at 0
+      indices: array of the index into the constructor's genes of each value
+      data: array of the values
+    """
+    matrix = sp_sparse.csr_matrix(
+        (data, self.gene_idx[indices], indptr),
+        shape=(len(barcodes), len(self.genes)))
+    matrix.sum_duplicates()
+    matrix.indices.astype(INDICES_DTYPE).tofile(self.indices_handle)
+    matrix.data.astype(DATA_DTYPE).tofile(self.data_handle)
+    self.indptr.append(matrix.indptr[1:].astype(INDPTR_DTYPE) + self.nnz)
+    self.nnz += matrix.nnz
+    self.barcodes.extend(barcodes)
+
+  def close(self):
+    """Write the cell pointers, dictionaries and the manifest."""
+    self.indices_handle.close()
+    self.data_handle.close()
+    indptr = np.concatenate(self.indptr)
+    indptr.tofile(os.path.join(self.path, INDPTR_FILE))
+    write_lines(os.path.join(self.path, GENES_FILE), self.genes.tolist())
+    write_lines(os.path.join(self.path, BARCODES_FILE), self.barcodes)
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'num_cells': len(indptr) - 1,
+        'num_genes': len(self.genes),
+        'nnz': self.nnz,
+        'indptr_dtype': INDPTR_DTYPE,
+        'indices_dtype': INDICES_DTYPE,
+        'data_dtype': DATA_DTYPE
+    }
+    with open(os.path.join(self.path, MANIFEST_FILE), 'w') as handle:
+      json.dump(manifest, handle, indent=2, sort_keys=True)
+
+
+class CellStoreBuilder(object):
+  """Collect measurements in any order and write them as a cell store.
+
+  This is for inputs such as dense matrices with a row per gene, which must be
+  transposed before they can be written by cell. All nonzero values are held
+  in memory until close is called.
+  """
+
+  def __init__(self, path, barcodes):
+    """Start collecting measurements.
+
+    Args:
+      path: Path of the directory to create.
+      barcodes: list of the identifiers of all the cells
+    """
+    self.path = path
+    self.barcodes = list(barcodes)
+    self.gene_ids = {}
+    self.blocks = []
+
+  def add_measurements(self, genes, gene_idx, cell_idx, values):
+    """Add a block of nonzero measurements.
+
+    Args:
+      genes: list of the gene names of the block
+      gene_idx: array of the index into genes of each value
+      cell_idx: array of the index into the barcodes of each value
+      values: array of the values
+    """
+    ids = np.array([self.gene_ids.setdefault(gene, len(self.gene_ids))
+                    for gene in genes], dtype=INDICES_DTYPE)
+    self.blocks.append((ids[gene_idx], np.asarray(cell_idx, dtype=np.int64),
+                        np.asarray(values, dtype=DATA_DTYPE)))
+
+  def close(self):
+    """Write the collected measurements as a cell store."""
+    genes = sorted(self.gene_ids, key=self.gene_ids.get)
+    gene_idx, cell_idx, values = [
+        np.concatenate([block[i] for block in self.blocks]) if self.blocks
+        else np.zeros(0) for i in range(3)]
+    matrix = sp_sparse.coo_matrix(
+        (values, (cell_idx, gene_idx)),
+        shape=(len(self.barcodes), len(genes))).tocsr()
+    writer = CellStoreWriter(self.path, genes)
+    writer.write_cells(self.barcodes, matrix.indptr, matrix.indices,
+                       matrix.data)
+    writer.close()
@@ -0,0 +1,86 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test writing of memory-mappable cell stores."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import cell_store
+
+# Test data, the genes of the matrix rows of which two share the name Glul.
+GENES = ['Glul', 'Rho', 'Glul']
+
+
+def read_lines(filename):
+  with open(filename, 'r') as f:
+    return f.read().splitlines()
+
+
+class CellStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.store = os.path.join(self.path, 'store')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def read_store(self):
+    with open(os.path.join(self.store, cell_store.MANIFEST_FILE), 'r') as f:
+      manifest = json.load(f)
+    arrays = [np.fromfile(os.path.join(self.store, filename), dtype=dtype)
+              for filename, dtype in [
+                  (cell_store.INDPTR_FILE, manifest['indptr_dtype']),
+                  (cell_store.INDICES_FILE, manifest['indices_dtype']),
+                  (cell_store.DATA_FILE, manifest['data_dtype'])]]
+    return (manifest, arrays,
+            read_lines(os.path.join(self.store, cell_store.GENES_FILE)),
+            read_lines(os.path.join(self.store, cell_store.BARCODES_FILE)))
+
+  def test_cell_store_writer(self):
+    writer = cell_store.CellStoreWriter(self.store, GENES)
+    writer.write_cells(['cell1', 'cell2'], np.array([0, 3, 4]),
+                       np.array([0, 1, 2, 1]), np.array([1, 2, 3, 5]))
+    writer.write_cells(['cell3'], np.array([0, 1]), np.array([2]),
+                       np.array([7]))
+    writer.close()
+
+    manifest, (indptr, indices, data), genes, barcodes = self.read_store()
+    self.assertEqual(3, manifest['num_cells'])
+    self.assertEqual(2, manifest['num_genes'])
+    self.assertEqual(4, manifest['nnz'])
+    self.assertEqual(['Glul', 'Rho'], genes)
+    self.assertEqual(['cell1', 'cell2', 'cell3'], barcodes)
+    # The counts of the two Glul genes of cell1 are summed.
+    np.testing.assert_array_equal([0, 2, 3, 4], indptr)
+    np.testing.assert_array_equal([0, 1, 1, 0], indices)
+    np.testing.assert_array_equal([4, 2, 5, 7], data)
+
+  def test_cell_store_builder(self):
+    # Measurements of a gene-major input, such as a dense CSV, in two blocks
+    # of rows with their own gene dictionaries.
+    builder = cell_store.CellStoreBuilder(self.store, ['cell1', 'cell2'])
+    builder.add_measurements(['Rho'], np.array([0, 0]), np.array([0, 1]),
+                             np.array([2, 5]))
+    builder.add_measurements(['Glul', 'Rho'], np.array([0, 1]),
+                             np.array([0, 1]), np.array([4, 1]))
+    builder.close()
+
+    manifest, (indptr, indices, data), genes, barcodes = self.read_store()
+    self.assertEqual(2, manifest['num_cells'])
+    self.assertEqual(['Glul', 'Rho'], genes)
+    self.assertEqual(['cell1', 'cell2'], barcodes)
+    np.testing.assert_array_equal([0, 2, 3], indptr)
+    np.testing.assert_array_equal([0, 1, 1], indices)
+    np.testing.assert_array_equal([4, 2, 6], data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,168 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+r"""Record which cell ranges of an input have been converted.
+
+The manifest is a JSON file holding, for each converted range of cells, a
+fingerprint of the input data in the range and the path, size, modification
+time and row count of the output file. A rerun of a conversion with the same
+manifest skips the ranges whose input is unchanged and whose output is intact,
+so that only missing, failed or changed ranges are converted again.
+
+By default an output file is intact if it still has its recorded size and
+modification time, which is checked without reading it. With verify_checksums,
+the MD5 checksum of each output file is also recorded and verified, which
+reads every output file in full on each rerun.
+
+Output files are first written to a temporary path and then renamed, so that a
+partially written shard is never mistaken for a converted one.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+def file_checksum(filename, block_size=64 * 1024 * 1024):
+  """Compute the MD5 checksum of a file, as reported by gsutil hash -h."""
+  md5 = hashlib.md5()
+  with open(filename, 'rb') as handle:
+    for block in iter(lambda: handle.read(block_size), b''):
+      md5.update(block)
+  return md5.hexdigest()
+
+
+def temporary_path(output_file):
+  """The path to which an output file is written before it is complete."""
+  return output_file + '.tmp'
+
+
+def commit_output(output_file):
+  """Atomically move a completely written output file into place."""
+  os.rename(temporary_path(output_file), output_file)
+
+
+class ConversionManifest(object):
+  """The ranges of cells of an input that have been converted."""
+
+  def __init__(self, path, input_file, verify_checksums=False):
+    """Load the manifest, or start a new one if it does not exist.
+
+    Args:
+      path: Path of the JSON manifest file.
+      input_file: Input file path, recorded to detect reuse of a manifest with
+        a different input.
+      verify_checksums: whether to record and verify the MD5 checksum of each
+        output file, in addition to its size and modification time.
+    """
+    self.path = path
+    self.verify_checksums = verify_checksums
+    self.shards = {}
+    if os.path.exists(path):
+      with open(path, 'r') as handle:
+        manifest = json.load(handle)
+      if manifest['input_file'] != input_file:
+        raise ValueError('Manifest %s records conversion of %s, not %s.'
+                         % (path, manifest['input_file'], input_file))
+      self.shards = manifest['shards']
+    self.input_file = input_file
+
+  @staticmethod
+  def _key(begin_idx, end_idx):
+    return '%d-%d' % (begin_idx, end_idx)
+
+  def ranges(self):
+    """The recorded (begin_idx, end_idx) ranges, in order."""
+    return sorted((shard['begin_idx'], shard['end_idx'])
+                  for shard in self.shards.values())
+
+  def contiguous_ranges(self, begin_idx, end_idx):
+    """The recorded ranges tiling a prefix of a range of cells.
+
+    Reusing these ranges when resharding keeps previously converted shards
+    valid, for example when new cells are appended to the input.
+
+    Args:
+      begin_idx: Index of the first cell (inclusive).
+      end_idx: Index at which to stop (exclusive).
+
+    Returns:
+      A list of (begin_idx, end_idx) tuples starting at begin_idx with no gaps.
+    """
+    contiguous = []
+    covered_idx = begin_idx
+    for range_begin_idx, range_end_idx in self.ranges():
+      if range_begin_idx == covered_idx and range_end_idx <= end_idx:
+        contiguous.append((range_begin_idx, range_end_idx))
+        covered_idx = range_end_idx
+    return contiguous
+
+  def is_converted(self, begin_idx, end_idx, fingerprint, output_file):
+    """Whether a range was converted from identical input and is intact.
+
+    The output file must be the one recorded, so that changing the output
+    path converts the range again, and must still have the recorded size and
+    modification time, and checksum if verify_checksums.
+
+    Args:
+      begin_idx: Index of the first cell of the range (inclusive).
+      end_idx: Index at which the range stops (exclusive).
+      fingerprint: the fingerprint of the current input data in the range
+      output_file: the path to which the range would be converted
+
+    Returns:
+      True if the range need not be converted again.
+    """
+    shard = self.shards.get(self._key(begin_idx, end_idx))
+    if (shard is None or shard['fingerprint'] != fingerprint or
+        shard['output_file'] != output_file or
+        not os.path.exists(output_file) or
+        os.path.getsize(output_file) != shard['size'] or
+        os.path.getmtime(output_file) != shard.get('mtime')):
+      return False
+    if self.verify_checksums:
+      return shard.get('md5') == file_checksum(output_file)
+    return True
+
+  def record(self, begin_idx, end_idx, fingerprint, output_file, num_rows):
+    """Record a converted range and save the manifest.
+
+    Args:
+      begin_idx: Index of the first cell of the range (inclusive).
+      end_idx: Index at which the range stops (exclusive).
+      fingerprint: the fingerprint of the input data in the range
+      output_file: the completely written output file of the range
+      num_rows: the number of rows written to the output file
+    """
+    # Forget any previously converted ranges that this one replaces.
+    for key, shard in list(self.shards.items()):
+      if shard['begin_idx'] < end_idx and begin_idx < shard['end_idx']:
+        del self.shards[key]
+    shard = {
+        'begin_idx': begin_idx,
+        'end_idx': end_idx,
+        'fingerprint': fingerprint,
+        'output_file': output_file,
+        'size': os.path.getsize(output_file),
+        'mtime': os.path.getmtime(output_file),
+        'num_rows': num_rows
+    }
+    if self.verify_checksums:
+      shard['md5'] = file_checksum(output_file)
+    self.shards[self._key(begin_idx, end_idx)] = shard
+    self.save()
+
+  def save(self):
+    """Atomically write the manifest."""
+    manifest = {
+        'manifest_version': MANIFEST_VERSION,
+        'input_file': self.input_file,
+        'shards': self.shards
+    }
+    with open(temporary_path(self.path), 'w') as handle:
+      json.dump(manifest, handle, indent=2, sort_keys=True)
+    commit_output(self.path)
@@ -0,0 +1,83 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test recording of converted ranges of cells."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import conversion_manifest
+
+INPUT_FILE = 'matrix.h5'
+
+
+class ConversionManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.manifest_file = os.path.join(self.path, 'manifest.json')
+    self.output_file = os.path.join(self.path, 'shard_0_10.csv')
+    self.write_output('gene_id,gene,cell,trans_cnt\nE1,Glul,cell1,1\n')
+    manifest = conversion_manifest.ConversionManifest(self.manifest_file,
+                                                      INPUT_FILE)
+    manifest.record(0, 10, 'abc', self.output_file, 1)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def write_output(self, text):
+    with open(conversion_manifest.temporary_path(self.output_file), 'w') as f:
+      f.write(text)
+    conversion_manifest.commit_output(self.output_file)
+
+  def load(self):
+    return conversion_manifest.ConversionManifest(self.manifest_file,
+                                                  INPUT_FILE)
+
+  def test_is_converted(self):
+    manifest = self.load()
+    self.assertTrue(manifest.is_converted(0, 10, 'abc', self.output_file))
+    self.assertFalse(manifest.is_converted(0, 10, 'def', self.output_file))
+    self.assertFalse(manifest.is_converted(0, 11, 'abc', self.output_file))
+    self.assertFalse(manifest.is_converted(
+        0, 10, 'abc', os.path.join(self.path, 'other_0_10.csv')))
+
+  def test_changed_or_deleted_output(self):
+    mtime = os.path.getmtime(self.output_file)
+    os.utime(self.output_file, (mtime + 1, mtime + 1))
+    self.assertFalse(self.load().is_converted(0, 10, 'abc', self.output_file))
+    os.remove(self.output_file)
+    self.assertFalse(self.load().is_converted(0, 10, 'abc', self.output_file))
+
+  def test_verify_checksums(self):
+    manifest = conversion_manifest.ConversionManifest(
+        self.manifest_file, INPUT_FILE, verify_checksums=True)
+    manifest.record(0, 10, 'abc', self.output_file, 1)
+    self.assertTrue(manifest.is_converted(0, 10, 'abc', self.output_file))
+    # The same size and modification time, but a different checksum.
+    mtime = os.path.getmtime(self.output_file)
+    self.write_output('gene_id,gene,cell,trans_cnt\nE1,Glul,cell1,2\n')
+    os.utime(self.output_file, (mtime, mtime))
+    self.assertTrue(self.load().is_converted(0, 10, 'abc', self.output_file))
+    self.assertFalse(manifest.is_converted(0, 10, 'abc', self.output_file))
+
+  def test_record_replaces_overlapping_ranges(self):
+    manifest = self.load()
+    manifest.record(10, 20, 'def', self.output_file, 1)
+    self.assertEqual([(0, 10), (10, 20)], self.load().ranges())
+    self.assertEqual([(0, 10), (10, 20)], manifest.contiguous_ranges(0, 30))
+    self.assertEqual([(0, 10)], manifest.contiguous_ranges(0, 15))
+    manifest.record(5, 15, 'ghi', self.output_file, 1)
+    self.assertEqual([(5, 15)], self.load().ranges())
+    self.assertEqual([], manifest.contiguous_ranges(0, 30))
+
+  def test_different_input_file(self):
+    with self.assertRaises(ValueError):
+      conversion_manifest.ConversionManifest(self.manifest_file, 'other.h5')
+
+
+if __name__ == '__main__':
+  unittest.main()
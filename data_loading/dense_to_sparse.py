@@ -38,30 +38,467 @@ chmod a+x dense_to_sparse.py ; \
   | gunzip \
   | ./dense_to_sparse.py \
   | gsutil cp - gs://BUCKET-NAME/PATH/TO/OUTPUT/FILE.csv
+
+Blank lines are skipped in every mode. Earlier versions stopped at the first
+blank line and silently dropped any rows after it, which are now converted.
+
+When numpy is available, pass --block-size to parse many rows at a time with
+array operations and write each block's output in one bulk write. The output is
+byte-identical to the default line-by-line mode. Run
+dense_to_sparse_benchmark.py to compare the speed of the two modes.
+
+chmod a+x dense_to_sparse.py ; \
+  gsutil cat gs://BUCKET-NAME/PATH/TO/INPUT/FILE.csv \
+  | ./dense_to_sparse.py --block-size 1000 \
+  | gsutil cp - gs://BUCKET-NAME/PATH/TO/OUTPUT/FILE.csv
+
+To use all of the cores of the machine, first copy the uncompressed CSV to
+local disk and pass it via --input-file. The file is split into byte ranges on
+line boundaries which are converted by a pool of worker processes. Output is
+written in input row order unless --unordered is passed.
+
+gsutil cp gs://BUCKET-NAME/PATH/TO/INPUT/FILE.csv /mnt/data/FILE.csv ; \
+  ./dense_to_sparse.py --input-file /mnt/data/FILE.csv --num-workers 32 \
+    --block-size 1000 \
+  | gsutil cp - gs://BUCKET-NAME/PATH/TO/OUTPUT/FILE.csv
+
+Pass --output-format parquet to instead write Parquet with dictionary-encoded
+cell and gene columns and integer transcript counts, see parquet_output.py.
+
+Pass --output-format store and --output-file DIRECTORY to instead write a
+memory-mappable cell store, see cell_store.py. The nonzero values are held in
+memory until all rows have been read, since the store is ordered by cell.
 """
 
+import argparse
+import multiprocessing
+import os
 import sys
 
-header = sys.stdin.readline().strip()
-samples = header.split(",")
-num_cols = len(samples)
+# numpy is only needed for block mode, so that the default mode continues to
+# work on machines with nothing more than a Python interpreter.
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
-# Emit the output CSV file header.
-sys.stdout.write(",".join(["cell", "gene", "trans_cnt"]) + "\n")
+import cell_store
+import parquet_output
+from parquet_output import pa
 
-for line in sys.stdin:
-  trimmed = line.strip()
-  if not trimmed:
-    break
+OUTPUT_COLUMNS = ["cell", "gene", "trans_cnt"]
 
-  values = trimmed.split(",")
-  if len(values) != num_cols:
+
+def check_num_columns(num_values, num_cols):
+  """Raise an error if a row does not have the same width as the header.
+
+  Args:
+    num_values: the number of comma-separated fields in one row
+    num_cols: the number of fields in the header
+  """
+  if num_values != num_cols:
     raise ValueError("Not all rows in the CSV have the same number of " +
-                     "columns: %d != %d" % (len(values), num_cols))
+                     "columns: %d != %d" % (num_values, num_cols))
+
+
+def read_blocks(lines, block_size):
+  """Group the data rows into lists of at most block_size trimmed rows.
+
+  Blank lines are skipped, as in line-by-line mode.
+
+  Args:
+    lines: iterable of the data rows of the dense CSV
+    block_size: the maximum number of rows per block
+
+  Yields:
+    Lists of trimmed rows.
+  """
+  block = []
+  for line in lines:
+    trimmed = line.strip()
+    if not trimmed:
+      continue
+    block.append(trimmed)
+    if len(block) == block_size:
+      yield block
+      block = []
+  if block:
+    yield block
+
+
+def convert_line(samples, trimmed):
+  """Convert one row of the dense matrix to sparse, long format.
+
+  Args:
+    samples: the fields of the header row
+    trimmed: one trimmed data row
+
+  Returns:
+    The output CSV text for the greater than zero measurements in the row.
+  """
+  values = trimmed.split(",")
+  check_num_columns(len(values), len(samples))
 
   measurement = values[0]
-  for i in range(1, num_cols):
+  output = []
+  for i in range(1, len(samples)):
     if float(values[i]) > 0:
-      # Emit the greater than zero measurement in sparse matrix format.
-      sys.stdout.write(",".join([samples[i], measurement, values[i]]) + "\n")
+      output.append(",".join([samples[i], measurement, values[i]]) + "\n")
+  return "".join(output)
+
+
+def find_block_measurements(samples, block):
+  """Find the greater than zero measurements in a block of rows.
+
+  The fields of all rows are located with array operations on the text of the
+  block. Most fields of a dense matrix are "0", so only the other fields are
+  parsed, once, and their text is reused for the output.
+
+  Args:
+    samples: the fields of the header row
+    block: list of trimmed data rows
+
+  Returns:
+    A tuple of the list of row names, and the row indices, column indices,
+    original text and parsed values of the greater than zero measurements.
+    Column indices exclude the first column.
+  """
+  for trimmed in block:
+    check_num_columns(trimmed.count(",") + 1, len(samples))
+
+  rows = [trimmed.split(",", 1) for trimmed in block]
+  genes = [row[0] for row in rows]
+  text = ",".join(row[1] for row in rows)
+  # One byte per character, so that byte offsets are character offsets.
+  data = text if isinstance(text, bytes) else text.encode("ascii", "replace")
+  chars = np.frombuffer(data + b",", dtype=np.uint8)
+  ends = np.flatnonzero(chars == ord(","))
+  starts = np.concatenate([[0], ends[:-1] + 1])
+  unparsed = np.flatnonzero((ends - starts != 1) | (chars[starts] != ord("0")))
+
+  fields = [text[begin:end] for begin, end
+            in zip(starts[unparsed].tolist(), ends[unparsed].tolist())]
+  counts = np.array([float(field) for field in fields], dtype=float)
+  positive = np.flatnonzero(counts > 0)
+  gene_idx, cell_idx = np.divmod(unparsed[positive], len(samples) - 1)
+  measurements = [fields[i] for i in positive.tolist()]
+  return genes, gene_idx, cell_idx, measurements, counts[positive]
+
+
+def convert_block(samples, block):
+  """Convert a block of rows of the dense matrix to sparse, long format.
+
+  The original text of each value is emitted so that the output matches
+  line-by-line mode exactly.
+
+  Args:
+    samples: the fields of the header row
+    block: list of trimmed data rows
+
+  Returns:
+    The output CSV text for the greater than zero measurements in the block.
+  """
+  genes, gene_idx, cell_idx, measurements, _ = find_block_measurements(
+      samples, block)
+  if not measurements:
+    return ""
+
+  cells = np.array(samples[1:])[cell_idx].tolist()
+  genes = np.array(genes)[gene_idx].tolist()
+  return "\n".join(map(",".join, zip(cells, genes, measurements))) + "\n"
+
+
+def convert_block_to_table(samples, block):
+  """Convert a block of rows of the dense matrix to a table for Parquet.
+
+  Args:
+    samples: the fields of the header row
+    block: list of trimmed data rows
+
+  Returns:
+    A pyarrow Table of the greater than zero measurements in the block.
+  """
+  genes, gene_idx, cell_idx, _, counts = find_block_measurements(
+      samples, block)
+  return pa.Table.from_arrays(
+      [parquet_output.dictionary_column(cell_idx, samples[1:]),
+       parquet_output.dictionary_column(gene_idx, genes),
+       parquet_output.count_column(counts)],
+      names=OUTPUT_COLUMNS)
+
+
+def convert_lines(samples, lines, block_size, output_format="csv"):
+  """Convert rows of the dense matrix to sparse, long format.
+
+  Args:
+    samples: the fields of the header row
+    lines: iterable of data rows, blank lines are skipped
+    block_size: the number of rows to convert at a time with numpy, or 0 to
+      convert one row at a time
+    output_format: "csv", "parquet" or "store", which require a block_size
+      unless "csv"
+
+  Yields:
+    Output CSV text, pyarrow Tables for Parquet output, or tuples of the gene
+    names, gene indices, cell indices and values of the block for store
+    output.
+  """
+  if output_format == "parquet":
+    for block in read_blocks(lines, block_size):
+      yield convert_block_to_table(samples, block)
+  elif output_format == "store":
+    for block in read_blocks(lines, block_size):
+      genes, gene_idx, cell_idx, _, counts = find_block_measurements(
+          samples, block)
+      yield genes, gene_idx, cell_idx, counts
+  elif block_size:
+    for block in read_blocks(lines, block_size):
+      yield convert_block(samples, block)
+  else:
+    for line in lines:
+      trimmed = line.strip()
+      if trimmed:
+        yield convert_line(samples, trimmed)
+
+
+def find_chunks(handle, begin, end, chunk_bytes):
+  """Split a byte range of a file into chunks that start at line boundaries.
+
+  Args:
+    handle: the file opened in binary mode
+    begin: offset of the first byte of the range, at a line boundary
+    end: offset one past the last byte of the range
+    chunk_bytes: the approximate size of each chunk
+
+  Returns:
+    A list of (begin, end) byte offset tuples.
+  """
+  boundaries = [begin]
+  for offset in range(begin + chunk_bytes, end, chunk_bytes):
+    # Advance to the start of the line following the one containing offset.
+    handle.seek(offset - 1)
+    handle.readline()
+    boundary = min(handle.tell(), end)
+    if boundary > boundaries[-1]:
+      boundaries.append(boundary)
+  if boundaries[-1] < end:
+    boundaries.append(end)
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# Per-process state of the worker pool, set by _init_worker.
+_worker_args = {}
+
+
+def _init_worker(input_file, samples, block_size, output_format):
+  _worker_args.update(input_file=input_file, samples=samples,
+                      block_size=block_size, output_format=output_format)
+
+
+def _convert_chunk(chunk):
+  """Convert the rows within a byte range of the input file.
+
+  Args:
+    chunk: (begin, end) byte offset tuple
+
+  Returns:
+    The output CSV text, a pyarrow Table for Parquet output, or the
+    measurements for store output, for the chunk.
+  """
+  begin, end = chunk
+  with open(_worker_args["input_file"], "rb") as handle:
+    handle.seek(begin)
+    data = handle.read(end - begin)
+  if not isinstance(data, str):
+    data = data.decode("utf-8")
+  outputs = list(convert_lines(_worker_args["samples"], data.split("\n"),
+                               _worker_args["block_size"],
+                               _worker_args["output_format"]))
+  if _worker_args["output_format"] == "parquet":
+    return pa.concat_tables(outputs) if outputs else None
+  if _worker_args["output_format"] == "store":
+    return concatenate_measurements(outputs)
+  return "".join(outputs)
+
+
+def concatenate_measurements(blocks):
+  """Combine the measurements of several blocks of rows for store output.
+
+  Args:
+    blocks: list of tuples of the gene names, gene indices, cell indices and
+      values of each block
+
+  Returns:
+    A tuple of the gene names, gene indices, cell indices and values of all
+    the blocks.
+  """
+  genes = []
+  gene_idx = []
+  for block_genes, block_gene_idx, _, _ in blocks:
+    gene_idx.append(block_gene_idx + len(genes))
+    genes.extend(block_genes)
+  if not blocks:
+    return [], np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+  return (genes, np.concatenate(gene_idx),
+          np.concatenate([block[2] for block in blocks]),
+          np.concatenate([block[3] for block in blocks]))
+
+
+def write_output(output, handle, output_format):
+  """Write converted rows in the output format.
+
+  Args:
+    output: CSV text, a pyarrow Table for Parquet output, or a tuple of the
+      gene names, gene indices, cell indices and values for store output
+    handle: the file, SparseParquetWriter or CellStoreBuilder to write to
+    output_format: "csv", "parquet" or "store"
+  """
+  if output_format == "parquet":
+    if output is not None:
+      handle.write_table(output)
+  elif output_format == "store":
+    handle.add_measurements(*output)
+  else:
+    handle.write(output)
+
+
+def read_header(handle):
+  """Read the header row of the dense CSV.
+
+  Args:
+    handle: the dense CSV file, opened in text or binary mode
+
+  Returns:
+    The list of the fields of the header row.
+  """
+  header = handle.readline()
+  if not isinstance(header, str):
+    header = header.decode("utf-8")
+  return header.strip().split(",")
+
+
+def convert_file_in_parallel(input_file, samples, num_workers, block_size,
+                             chunk_bytes, ordered, handle,
+                             output_format="csv"):
+  """Convert a dense CSV file using a pool of worker processes.
+
+  Args:
+    input_file: path to the uncompressed dense CSV file
+    samples: the fields of the header row
+    num_workers: the number of worker processes
+    block_size: the number of rows to convert at a time with numpy, or 0 to
+      convert one row at a time
+    chunk_bytes: the approximate size of the byte range given to each task
+    ordered: whether to write the output in input row order
+    handle: the file to which to write the output CSV text, a
+      SparseParquetWriter for Parquet output or a CellStoreBuilder for store
+      output
+    output_format: "csv", "parquet" or "store"
+  """
+  with open(input_file, "rb") as f:
+    f.readline()
+    chunks = find_chunks(f, f.tell(), os.path.getsize(input_file),
+                         chunk_bytes)
+
+  pool = multiprocessing.Pool(
+      num_workers, initializer=_init_worker,
+      initargs=(input_file, samples, block_size, output_format))
+  try:
+    results = (pool.imap(_convert_chunk, chunks) if ordered
+               else pool.imap_unordered(_convert_chunk, chunks))
+    for output in results:
+      write_output(output, handle, output_format)
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def run(argv=None):
+  """Converts the dense CSV on stdin to sparse CSV on stdout.
+
+  Args:
+    argv: Command line arguments as a list.
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "--block-size",
+      type=int,
+      default=0,
+      help="Number of rows to parse at a time with numpy. If 0, rows are "
+      "converted one at a time without numpy.")
+  parser.add_argument(
+      "--input-file",
+      help="Uncompressed dense CSV file to convert in parallel. If None, "
+      "stdin will be converted by a single process.")
+  parser.add_argument(
+      "--num-workers",
+      type=int,
+      default=multiprocessing.cpu_count(),
+      help="Number of worker processes to use with --input-file.")
+  parser.add_argument(
+      "--chunk-bytes",
+      type=int,
+      default=64 * 1024 * 1024,
+      help="Approximate size of the portion of --input-file converted by "
+      "each task.")
+  parser.add_argument(
+      "--unordered",
+      action="store_true",
+      help="Write output as soon as each portion of --input-file has been "
+      "converted instead of in input row order.")
+  parser.add_argument(
+      "--output-format",
+      choices=["csv", "parquet", "store"],
+      default="csv",
+      help="Format of the output. Parquet output requires pyarrow. Parquet "
+      "and store output require --block-size.")
+  parser.add_argument(
+      "--output-file",
+      help="Output file path, or directory for store output. If None, stdout "
+      "will be used.")
+  parser.add_argument(
+      "--row-group-size",
+      type=int,
+      default=parquet_output.DEFAULT_ROW_GROUP_SIZE,
+      help="Number of rows per Parquet row group.")
+  args = parser.parse_args(argv)
+
+  if args.block_size and np is None:
+    raise ValueError("Block mode requires numpy.")
+  if args.output_format != "csv" and not args.block_size:
+    raise ValueError("%s output requires --block-size." % args.output_format)
+  if args.output_format == "store" and not args.output_file:
+    raise ValueError("Store output requires --output-file.")
+
+  if args.input_file:
+    with open(args.input_file, "rb") as f:
+      samples = read_header(f)
+  else:
+    samples = read_header(sys.stdin)
+
+  if args.output_format == "parquet":
+    handle = parquet_output.SparseParquetWriter(
+        args.output_file, OUTPUT_COLUMNS, args.row_group_size)
+  elif args.output_format == "store":
+    handle = cell_store.CellStoreBuilder(args.output_file, samples[1:])
+  else:
+    handle = open(args.output_file, "w") if args.output_file else sys.stdout
+    # Emit the output CSV file header.
+    handle.write(",".join(OUTPUT_COLUMNS) + "\n")
+
+  if args.input_file:
+    convert_file_in_parallel(args.input_file, samples, args.num_workers,
+                             args.block_size, args.chunk_bytes,
+                             not args.unordered, handle, args.output_format)
+  else:
+    for output in convert_lines(samples, sys.stdin, args.block_size,
+                                args.output_format):
+      write_output(output, handle, args.output_format)
+
+  if handle is not sys.stdout:
+    handle.close()
+
 
+if __name__ == "__main__":
+  run()
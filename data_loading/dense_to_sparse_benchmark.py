@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+r"""Compare the speed of the line-by-line and block modes of dense_to_sparse.
+
+A random dense matrix of integer counts is converted in memory by each mode,
+and the fastest of several runs of each is reported. The outputs of the modes
+are checked to be identical.
+
+./dense_to_sparse_benchmark.py --num-rows 3000 --num-columns 3000 \
+  --density 0.05 --block-size 1000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import dense_to_sparse
+
+
+def make_dense_csv(num_rows, num_columns, density, seed=0):
+  """Create the rows of a random dense CSV of integer counts.
+
+  Args:
+    num_rows: the number of genes
+    num_columns: the number of cells
+    density: the fraction of the counts that are greater than zero
+    seed: seed of the counts
+
+  Returns:
+    A tuple of the fields of the header row and the list of data rows.
+  """
+  random = np.random.RandomState(seed)
+  counts = ((random.uniform(size=(num_rows, num_columns)) < density) *
+            random.randint(1, 100, size=(num_rows, num_columns)))
+  samples = [""] + ["cell%d" % i for i in range(num_columns)]
+  lines = ["gene%d,%s\n" % (i, ",".join(map(str, row.tolist())))
+           for i, row in enumerate(counts)]
+  return samples, lines
+
+
+def time_conversion(samples, lines, block_size, repeats):
+  """Convert the rows several times and return the output and fastest time."""
+  best = None
+  for _ in range(repeats):
+    start = time.time()
+    output = "".join(dense_to_sparse.convert_lines(samples, lines, block_size))
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return output, best
+
+
+def run(argv=None):
+  """Times both modes of dense_to_sparse on a random matrix.
+
+  Args:
+    argv: Command line arguments as a list.
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num-rows", type=int, default=3000,
+                      help="Number of genes of the random matrix.")
+  parser.add_argument("--num-columns", type=int, default=3000,
+                      help="Number of cells of the random matrix.")
+  parser.add_argument("--density", type=float, default=0.05,
+                      help="Fraction of the counts that are nonzero.")
+  parser.add_argument("--block-size", type=int, default=1000,
+                      help="Number of rows per block in block mode.")
+  parser.add_argument("--repeats", type=int, default=3,
+                      help="Number of runs of each mode.")
+  args = parser.parse_args(argv)
+
+  samples, lines = make_dense_csv(args.num_rows, args.num_columns,
+                                  args.density)
+  line_output, line_time = time_conversion(samples, lines, 0, args.repeats)
+  block_output, block_time = time_conversion(samples, lines, args.block_size,
+                                             args.repeats)
+  if line_output != block_output:
+    raise ValueError("The outputs of line and block mode differ.")
+  print("Line mode: %.2fs" % line_time)
+  print("Block mode: %.2fs" % block_time)
+  print("Speedup: %.2fx" % (line_time / block_time))
+
+
+if __name__ == "__main__":
+  run()
@@ -0,0 +1,100 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test conversion of dense CSV matrices to sparse, long format."""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyarrow.parquet as pq
+
+import dense_to_sparse
+import dense_to_sparse_benchmark
+import parquet_output
+
+DENSE_CSV = ",c1,c2\ng1,1,2\n\ng2,3,0\ng3,0,5.5\n\n"
+SPARSE_CSV = "c1,g1,1\nc2,g1,2\nc1,g2,3\nc2,g3,5.5\n"
+
+
+class DenseToSparseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.input_file = os.path.join(self.temp_dir, "dense.csv")
+    with open(self.input_file, "w") as f:
+      f.write(DENSE_CSV)
+    self.samples = DENSE_CSV.split("\n", 1)[0].split(",")
+    self.lines = io.StringIO(DENSE_CSV.split("\n", 1)[1])
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def test_line_by_line(self):
+    self.assertEqual(SPARSE_CSV, "".join(
+        dense_to_sparse.convert_lines(self.samples, self.lines, 0)))
+
+  def test_block(self):
+    self.assertEqual(SPARSE_CSV, "".join(
+        dense_to_sparse.convert_lines(self.samples, self.lines, 2)))
+
+  def test_block_matches_line_mode(self):
+    # Zeros and positive values written in several ways, and rows split over
+    # blocks of several sizes.
+    values = ["0", "0.0", "00", "-1", "2", "0.5", "1e3", "007"]
+    samples, lines = dense_to_sparse_benchmark.make_dense_csv(7, 5, 0.5)
+    lines.append("gene7," + ",".join(values[:5]) + "\n")
+    lines.append("gene8," + ",".join(values[3:]) + "\n")
+    expected = "".join(dense_to_sparse.convert_lines(samples, lines, 0))
+    self.assertTrue(expected.endswith(
+        "cell4,gene7,2\n"
+        "cell1,gene8,2\ncell2,gene8,0.5\ncell3,gene8,1e3\ncell4,gene8,007\n"))
+    for block_size in [1, 3, 100]:
+      self.assertEqual(expected, "".join(
+          dense_to_sparse.convert_lines(samples, lines, block_size)))
+    with self.assertRaises(ValueError):
+      list(dense_to_sparse.convert_lines(samples, ["g1,1,x,0,0,0\n"], 2))
+
+  def test_parallel(self):
+    for block_size in [0, 2]:
+      output = io.StringIO()
+      # Small chunks so that the blank lines fall in different chunks.
+      dense_to_sparse.convert_file_in_parallel(
+          self.input_file, self.samples, 2, block_size, 8, True, output)
+      self.assertEqual(SPARSE_CSV, output.getvalue())
+
+  def test_parquet(self):
+    # Parquet output requires whole number counts.
+    with open(self.input_file, "w") as f:
+      f.write(DENSE_CSV.replace("5.5", "5"))
+    outputs = [os.path.join(self.temp_dir, name + ".parquet")
+               for name in ["serial", "parallel"]]
+    writer = parquet_output.SparseParquetWriter(
+        outputs[0], dense_to_sparse.OUTPUT_COLUMNS)
+    with open(self.input_file, "r") as f:
+      f.readline()
+      for table in dense_to_sparse.convert_lines(self.samples, f, 2,
+                                                 "parquet"):
+        writer.write_table(table)
+    writer.close()
+    writer = parquet_output.SparseParquetWriter(
+        outputs[1], dense_to_sparse.OUTPUT_COLUMNS)
+    dense_to_sparse.convert_file_in_parallel(
+        self.input_file, self.samples, 2, 2, 8, True, writer, "parquet")
+    writer.close()
+
+    serial, parallel = [pq.read_table(output).to_pydict()
+                        for output in outputs]
+    self.assertEqual(serial, parallel)
+    self.assertEqual([1, 2, 3, 5], serial["trans_cnt"])
+
+  def test_check_num_columns(self):
+    with self.assertRaises(ValueError):
+      list(dense_to_sparse.convert_lines(self.samples, ["g1,1\n"], 0))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -11,16 +11,39 @@ This code is based loosely on
 http://cf.10xgenomics.com/supp/cell-exp/megacell_tutorial.html
 and is hardcoded to load
 https://support.10xgenomics.com/single-cell/datasets/1M_neurons
+
+Pass --num-shards to split the cells into ranges holding about the same number
+of nonzero values. The ranges are either written to a dsub --tasks file via
+--tasks-file or converted on a local pool of worker processes.
+
+Pass --output-format parquet to instead write Parquet with dictionary-encoded
+gene_id, gene and cell columns and integer transcript counts, see
+parquet_output.py. Pass --output-format store to instead write a
+memory-mappable cell store directory, see cell_store.py.
+
+Pass --manifest to record each converted range of cells along with a
+fingerprint of its input and the size, modification time and row count of its
+output, see conversion_manifest.py. Add --verify-checksums to also record and
+verify the checksum of each output. Rerunning the same command then only converts the
+ranges that are missing, failed or whose input changed, such as newly appended
+cells.
 """
 
 import sys
 import argparse
 import collections
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 import os
 import scipy.sparse as sp_sparse
 import tables
 
+import cell_store
+import conversion_manifest
+import parquet_output
+
 GENOME = 'mm10'
 
 # This dsub-compatible script will read configuration from the environment,
@@ -30,6 +53,11 @@ DEFAULT_END_IDX = os.getenv('END_IDX', 1306127)  # Last cell in the file.
 DEFAULT_INPUT_FILE = os.getenv('INPUT_FILE',
                                '1M_neurons_filtered_gene_bc_matrices_h5.h5')
 DEFAULT_OUTPUT_FILE = os.getenv('OUTPUT_FILE')
+DEFAULT_CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 1000))  # Cells per read.
+# One of csv, parquet or store.
+DEFAULT_OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'csv')
+
+OUTPUT_COLUMNS = ['gene_id', 'gene', 'cell', 'trans_cnt']
 
 np.random.seed(0)
 
@@ -67,6 +95,365 @@ def get_matrix_from_h5(filename, genome):
                       % filename)
 
 
+def read_cell_blocks_from_h5(filename, genome, begin_idx, end_idx,
+                             chunk_size=None):
+  """Load the cells in a range from the HDF5 file, a block at a time.
+
+  Only the slices of the indptr, indices, data and barcodes arrays holding
+  the requested cells are read, so memory use is bounded by the block size
+  rather than by the size of the whole matrix.
+
+  Args:
+    filename: HDF5 filename
+    genome: Genome of data in the file.
+    begin_idx: Index of the first cell to read (inclusive).
+    end_idx: Index at which to stop reading cells (exclusive).
+    chunk_size: The maximum number of cells per block. If None, all the cells
+      in the range are returned in a single block.
+
+  Yields:
+    Tuples of the index of the first cell in the block and a GeneBCMatrix
+    holding the barcodes and the sparse matrix of data for only the cells in
+    the block.
+  """
+  with tables.open_file(filename, 'r') as f:
+    try:
+      group = f.get_node('/' + genome)
+    except tables.NoSuchNodeError:
+      raise Exception('Genome %s does not exist in %s.' % (genome, filename))
+    try:
+      dsets = {name: f.get_node(group, name)
+               for name in ['data', 'indices', 'indptr', 'shape', 'genes',
+                            'gene_names', 'barcodes']}
+    except tables.NoSuchNodeError:
+      raise Exception('File %s missing one or more required datasets.'
+                      % filename)
+
+    num_genes = dsets['shape'].read()[0]
+    gene_ids = dsets['genes'].read().astype(str)
+    gene_names = dsets['gene_names'].read().astype(str)
+    end_idx = min(end_idx, dsets['indptr'].nrows - 1)
+    indptr = dsets['indptr'][begin_idx:end_idx + 1]
+    chunk_size = chunk_size or max(end_idx - begin_idx, 1)
+
+    for block_begin in range(begin_idx, end_idx, chunk_size):
+      block_end = min(block_begin + chunk_size, end_idx)
+      block_indptr = indptr[block_begin - begin_idx:block_end - begin_idx + 1]
+      first, last = block_indptr[0], block_indptr[-1]
+      matrix = sp_sparse.csc_matrix(
+          (dsets['data'][first:last], dsets['indices'][first:last],
+           block_indptr - first),
+          shape=(num_genes, block_end - block_begin))
+      yield block_begin, GeneBCMatrix(
+          gene_ids, gene_names,
+          dsets['barcodes'][block_begin:block_end].astype(str), matrix)
+
+
+def format_block(block):
+  """Format a block of cells as sparse, long format CSV text.
+
+  The text for every gene, cell and distinct count is built once, and the
+  pieces of each output line are gathered for all the nonzero values in the
+  block with array operations.
+
+  Args:
+    block: GeneBCMatrix holding the cells to format.
+
+  Returns:
+    The CSV text for the block, one line per nonzero value.
+  """
+  matrix = block.matrix
+  gene_prefixes = np.array(
+      [gene_id + ',' + gene_name + ','
+       for gene_id, gene_name in zip(block.gene_ids.tolist(),
+                                     block.gene_names.tolist())],
+      dtype=object)
+  cells = np.array([barcode + ',' for barcode in block.barcodes.tolist()],
+                   dtype=object)
+  counts, count_idx = np.unique(matrix.data, return_inverse=True)
+  count_suffixes = np.array(
+      [count + '\n' for count in counts.astype(str).tolist()], dtype=object)
+
+  columns = [gene_prefixes[matrix.indices],
+             np.repeat(cells, np.diff(matrix.indptr)),
+             count_suffixes[count_idx.ravel()]]
+  return ''.join(itertools.chain.from_iterable(
+      zip(*[column.tolist() for column in columns])))
+
+
+def block_to_columns(block):
+  """Convert a block of cells to dictionary-encoded columns for Parquet.
+
+  Args:
+    block: GeneBCMatrix holding the cells to convert.
+
+  Returns:
+    A list of pyarrow arrays, one per output column.
+  """
+  matrix = block.matrix
+  cell_idx = np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+  return [parquet_output.dictionary_column(matrix.indices, block.gene_ids),
+          parquet_output.dictionary_column(matrix.indices, block.gene_names),
+          parquet_output.dictionary_column(cell_idx, block.barcodes),
+          parquet_output.count_column(matrix.data)]
+
+
+def compute_fingerprints(input_file, ranges):
+  """Compute the fingerprints of ranges of cells without converting them.
+
+  A fingerprint covers the gene ids of the file and the number of values and
+  barcode of every cell in the range. Only the small genes, indptr and
+  barcodes arrays are read, not the values, so every shard of a large file is
+  fingerprinted in seconds. A fingerprint does not depend on the position of
+  the range in the file, so appending cells leaves earlier ranges unchanged,
+  but it does not detect edits to the values that keep every cell's number of
+  values.
+
+  Args:
+    input_file: Input file path.
+    ranges: list of (begin_idx, end_idx) tuples
+
+  Returns:
+    The list of the hexadecimal fingerprints of the ranges.
+  """
+  with tables.open_file(input_file, 'r') as f:
+    try:
+      group = f.get_node('/' + GENOME)
+      genes_digest = hashlib.sha1(
+          ('\n'.join(group.genes.read().astype(str).tolist()) + '\n\n')
+          .encode('utf-8'))
+      fingerprints = []
+      for begin_idx, end_idx in ranges:
+        end_idx = min(end_idx, group.indptr.nrows - 1)
+        barcodes = group.barcodes[begin_idx:end_idx].astype(str).tolist()
+        digest = genes_digest.copy()
+        digest.update(np.diff(group.indptr[begin_idx:end_idx + 1])
+                      .astype(np.int64).tobytes())
+        digest.update(('\n'.join(barcodes) + '\n').encode('utf-8'))
+        fingerprints.append(digest.hexdigest())
+    except tables.NoSuchNodeError:
+      raise Exception('Genome %s does not exist in %s or is missing '
+                      'datasets.' % (GENOME, input_file))
+  return fingerprints
+
+
+def read_indptr_from_h5(filename, genome):
+  """Load the column pointers of the matrix from the HDF5 file.
+
+  Args:
+    filename: HDF5 filename
+    genome: Genome of data in the file.
+
+  Returns:
+    The indptr array, with one more entry than there are cells.
+  """
+  with tables.open_file(filename, 'r') as f:
+    try:
+      return f.get_node('/' + genome, 'indptr').read()
+    except tables.NoSuchNodeError:
+      raise Exception('Genome %s does not exist in %s or is missing indptr.'
+                      % (genome, filename))
+
+
+def plan_shards(indptr, begin_idx, end_idx, num_shards, manifest=None):
+  """Reuse the shards recorded in a manifest and shard the remaining cells.
+
+  Args:
+    indptr: the column pointers of the whole matrix
+    begin_idx: Index of the first cell to shard (inclusive).
+    end_idx: Index at which to stop sharding cells (exclusive).
+    num_shards: The desired number of shards for the whole range.
+    manifest: optional ConversionManifest of a previous conversion
+
+  Returns:
+    A list of (begin_idx, end_idx) tuples.
+  """
+  end_idx = min(end_idx, len(indptr) - 1)
+  shards = manifest.contiguous_ranges(begin_idx, end_idx) if manifest else []
+  covered_idx = shards[-1][1] if shards else begin_idx
+  if covered_idx < end_idx:
+    # Give the remaining cells their share of the shards.
+    total_nnz = max(indptr[end_idx] - indptr[begin_idx], 1)
+    remaining_nnz = indptr[end_idx] - indptr[covered_idx]
+    shards.extend(compute_shard_boundaries(
+        indptr, covered_idx, end_idx,
+        max(1, int(round(num_shards * float(remaining_nnz) / total_nnz)))))
+  return shards
+
+
+def compute_shard_boundaries(indptr, begin_idx, end_idx, num_shards):
+  """Split a range of cells into shards with balanced numbers of nonzeros.
+
+  Args:
+    indptr: the column pointers of the whole matrix
+    begin_idx: Index of the first cell to shard (inclusive).
+    end_idx: Index at which to stop sharding cells (exclusive).
+    num_shards: The desired number of shards.
+
+  Returns:
+    A list of (begin_idx, end_idx) tuples. Fewer than num_shards are returned
+    when a single cell holds more than a shard's share of the nonzeros.
+  """
+  end_idx = min(end_idx, len(indptr) - 1)
+  cell_indptr = indptr[begin_idx:end_idx + 1]
+  targets = np.linspace(cell_indptr[0], cell_indptr[-1], num_shards + 1)
+  boundaries = np.searchsorted(cell_indptr, targets[1:-1]) + begin_idx
+  boundaries = np.unique(
+      np.concatenate([[begin_idx], boundaries, [end_idx]])).tolist()
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def get_shard_output_file(output_prefix, begin_idx, end_idx,
+                          output_format='csv'):
+  return '%s_%d_%d.%s' % (output_prefix, begin_idx, end_idx, output_format)
+
+
+def write_tasks_file(tasks_file, shards, input_file, output_prefix,
+                     output_format='csv'):
+  """Write a dsub --tasks file with one task per shard.
+
+  Args:
+    tasks_file: Path of the TSV file to write.
+    shards: list of (begin_idx, end_idx) tuples
+    input_file: Input file path for the tasks, such as a Cloud Storage path.
+    output_prefix: Prefix of the output file path for the tasks.
+    output_format: 'csv' or 'parquet'
+  """
+  with open(tasks_file, 'w') as handle:
+    handle.write('\t'.join(['--env BEGIN_IDX', '--env END_IDX',
+                            '--env OUTPUT_FORMAT', '--input INPUT_FILE',
+                            '--output OUTPUT_FILE']) + '\n')
+    for begin_idx, end_idx in shards:
+      handle.write('\t'.join([
+          str(begin_idx), str(end_idx), output_format, input_file,
+          get_shard_output_file(output_prefix, begin_idx, end_idx,
+                                output_format)]) + '\n')
+
+
+def convert_cells(input_file, begin_idx, end_idx, output_file, chunk_size,
+                  output_format='csv',
+                  row_group_size=parquet_output.DEFAULT_ROW_GROUP_SIZE):
+  """Convert a range of cells from the HDF5 file to sparse, long format.
+
+  Args:
+    input_file: Input file path.
+    begin_idx: Index of the first cell to convert (inclusive).
+    end_idx: Index at which to stop converting cells (exclusive).
+    output_file: Output file path, or directory for store output. If None,
+      stdout will be used.
+    chunk_size: Number of cells to read from the input file at a time.
+    output_format: 'csv', 'parquet' or 'store'
+    row_group_size: Number of rows per Parquet row group.
+
+  Returns:
+    The number of rows written.
+  """
+  sys.stderr.write('Processing cells [%d,%d) from file %s\n'
+                   % (begin_idx, end_idx, input_file))
+  num_rows = 0
+  blocks = (block for _, block in read_cell_blocks_from_h5(
+      input_file, GENOME, begin_idx, end_idx, chunk_size))
+
+  if output_format == 'store':
+    if not output_file:
+      raise ValueError('Store output requires --output-file.')
+    writer = None
+    for block in blocks:
+      if writer is None:
+        writer = cell_store.CellStoreWriter(output_file, block.gene_names)
+      writer.write_cells(block.barcodes.tolist(), block.matrix.indptr,
+                         block.matrix.indices, block.matrix.data)
+      num_rows += block.matrix.nnz
+    if writer is not None:
+      writer.close()
+  elif output_format == 'parquet':
+    writer = parquet_output.SparseParquetWriter(output_file, OUTPUT_COLUMNS,
+                                                row_group_size)
+    for block in blocks:
+      writer.write_columns(block_to_columns(block))
+      num_rows += block.matrix.nnz
+    writer.close()
+  else:
+    handle = open(output_file, 'w') if output_file else sys.stdout
+
+    # Emit the output CSV file header.
+    handle.write(','.join(OUTPUT_COLUMNS) + '\n')
+
+    for block in blocks:
+      handle.write(format_block(block))
+      num_rows += block.matrix.nnz
+
+    if handle is not sys.stdout:
+      handle.close()
+
+  return num_rows
+
+
+def convert_cells_atomically(input_file, begin_idx, end_idx, output_file,
+                             *args):
+  """Convert a range of cells to a temporary file and then move it into place.
+
+  Args:
+    input_file: Input file path.
+    begin_idx: Index of the first cell to convert (inclusive).
+    end_idx: Index at which to stop converting cells (exclusive).
+    output_file: Output file path.
+    *args: the remaining arguments of convert_cells
+
+  Returns:
+    A tuple of the range, the output file path and the number of rows written.
+  """
+  num_rows = convert_cells(
+      input_file, begin_idx, end_idx,
+      conversion_manifest.temporary_path(output_file), *args)
+  conversion_manifest.commit_output(output_file)
+  return begin_idx, end_idx, output_file, num_rows
+
+
+def _convert_shard(shard_args):
+  return convert_cells_atomically(*shard_args)
+
+
+def convert_shards_in_parallel(input_file, shards, output_prefix, chunk_size,
+                               num_workers, output_format='csv',
+                               row_group_size=None, manifest=None,
+                               fingerprints=None):
+  """Convert each shard to its own output file on a local process pool.
+
+  Args:
+    input_file: Input file path.
+    shards: list of (begin_idx, end_idx) tuples
+    output_prefix: Prefix of the output file path for the shards.
+    chunk_size: Number of cells to read from the input file at a time.
+    num_workers: The number of worker processes.
+    output_format: 'csv' or 'parquet'
+    row_group_size: Number of rows per Parquet row group.
+    manifest: optional ConversionManifest in which to record each shard as
+      soon as it has been converted
+    fingerprints: dictionary of the fingerprint of each shard, required with
+      a manifest
+  """
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    results = pool.imap_unordered(
+        _convert_shard,
+        [(input_file, begin_idx, end_idx,
+          get_shard_output_file(output_prefix, begin_idx, end_idx,
+                                output_format),
+          chunk_size, output_format,
+          row_group_size or parquet_output.DEFAULT_ROW_GROUP_SIZE)
+         for begin_idx, end_idx in shards])
+    for begin_idx, end_idx, output_file, num_rows in results:
+      if manifest:
+        manifest.record(begin_idx, end_idx,
+                        fingerprints[(begin_idx, end_idx)], output_file,
+                        num_rows)
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
 def run(argv=None):
   """Runs the variant preprocess pipeline.
 
@@ -92,29 +479,120 @@ def run(argv=None):
       '--output-file',
       default=DEFAULT_OUTPUT_FILE,
       help='Output file path. If None, stdout will be used.')
+  parser.add_argument(
+      '--chunk-size',
+      type=int,
+      default=DEFAULT_CHUNK_SIZE,
+      help='Number of cells to read from the input file at a time.')
+  parser.add_argument(
+      '--num-shards',
+      type=int,
+      default=0,
+      help='If set, split the cells into this many shards holding about the '
+      'same number of nonzero values.')
+  parser.add_argument(
+      '--output-prefix',
+      help='Prefix of the output file path for each shard. Required with '
+      '--num-shards.')
+  parser.add_argument(
+      '--tasks-file',
+      help='If set, write the shards as a dsub --tasks file instead of '
+      'converting them locally.')
+  parser.add_argument(
+      '--tasks-input-file',
+      help='Input file path to use in the --tasks-file, such as the Cloud '
+      'Storage path of --input-file. Defaults to --input-file.')
+  parser.add_argument(
+      '--num-workers',
+      type=int,
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes used to convert shards locally.')
+  parser.add_argument(
+      '--output-format',
+      choices=['csv', 'parquet', 'store'],
+      default=DEFAULT_OUTPUT_FORMAT,
+      help='Format of the output. Parquet output requires pyarrow. Store '
+      'output is written to the --output-file directory and cannot be '
+      'sharded.')
+  parser.add_argument(
+      '--row-group-size',
+      type=int,
+      default=parquet_output.DEFAULT_ROW_GROUP_SIZE,
+      help='Number of rows per Parquet row group.')
+  parser.add_argument(
+      '--manifest',
+      help='If set, the path of a JSON file recording the converted ranges '
+      'of cells, so that a rerun only converts missing or changed ranges. '
+      'Cannot be used with --tasks-file.')
+  parser.add_argument(
+      '--verify-checksums',
+      action='store_true',
+      help='With --manifest, also record the checksum of each output file and '
+      'verify it on a rerun, which reads every converted output file.')
   args = parser.parse_args(argv)
 
-  sys.stderr.write('Processing cells [%d,%d) from file %s'
-                   % (args.begin_idx, args.end_idx, args.input_file))
-  mm10_gbm = get_matrix_from_h5(args.input_file, GENOME)
-
-  handle = open(args.output_file, 'w') if args.output_file else sys.stdout
+  manifest = None
+  if args.manifest:
+    if args.output_format == 'store':
+      raise ValueError('Store output cannot be recorded in a manifest.')
+    if not (args.output_file or args.num_shards):
+      raise ValueError('--manifest requires --output-file or --num-shards.')
+    if args.tasks_file:
+      # Each dsub task runs on its own machine and writes to Cloud Storage,
+      # so the tasks cannot record their shards in the local manifest.
+      raise ValueError('--manifest cannot be used with --tasks-file.')
+    manifest = conversion_manifest.ConversionManifest(
+        args.manifest, args.input_file, args.verify_checksums)
 
-  # Emit the output CSV file header.
-  handle.write(','.join(['gene_id', 'gene', 'cell', 'trans_cnt']) + '\n')
+  if not args.num_shards:
+    if not manifest:
+      convert_cells(args.input_file, args.begin_idx, args.end_idx,
+                    args.output_file, args.chunk_size, args.output_format,
+                    args.row_group_size)
+      return
+    fingerprint, = compute_fingerprints(args.input_file,
+                                        [(args.begin_idx, args.end_idx)])
+    if manifest.is_converted(args.begin_idx, args.end_idx, fingerprint,
+                             args.output_file):
+      sys.stderr.write('Cells [%d,%d) are already converted.\n'
+                       % (args.begin_idx, args.end_idx))
+      return
+    _, _, _, num_rows = convert_cells_atomically(
+        args.input_file, args.begin_idx, args.end_idx, args.output_file,
+        args.chunk_size, args.output_format, args.row_group_size)
+    manifest.record(args.begin_idx, args.end_idx, fingerprint,
+                    args.output_file, num_rows)
+    return
 
-  for cell in range(args.begin_idx, args.end_idx):
-    for sparse_idx in range(mm10_gbm.matrix.indptr[cell],
-                            mm10_gbm.matrix.indptr[cell+1]):
-      dense_idx = mm10_gbm.matrix.indices[sparse_idx]
-      handle.write(','.join([mm10_gbm.gene_ids[dense_idx],
-                             mm10_gbm.gene_names[dense_idx],
-                             mm10_gbm.barcodes[cell],
-                             str(mm10_gbm.matrix.data[sparse_idx])])
-                   + '\n')
+  if not args.output_prefix:
+    raise ValueError('--output-prefix is required with --num-shards.')
+  if args.output_format == 'store':
+    raise ValueError('Store output cannot be sharded.')
+  shards = plan_shards(read_indptr_from_h5(args.input_file, GENOME),
+                       args.begin_idx, args.end_idx, args.num_shards,
+                       manifest)
+  fingerprints = None
+  if manifest:
+    fingerprints = dict(zip(shards,
+                            compute_fingerprints(args.input_file, shards)))
+    converted = [(begin_idx, end_idx) for begin_idx, end_idx in shards
+                 if manifest.is_converted(
+                     begin_idx, end_idx, fingerprints[(begin_idx, end_idx)],
+                     get_shard_output_file(args.output_prefix, begin_idx,
+                                           end_idx, args.output_format))]
+    sys.stderr.write('Skipping %d of %d shards that are already converted.\n'
+                     % (len(converted), len(shards)))
+    shards = [shard for shard in shards if shard not in converted]
 
-  if handle is not sys.stdout:
-    handle.close()
+  if args.tasks_file:
+    write_tasks_file(args.tasks_file, shards,
+                     args.tasks_input_file or args.input_file,
+                     args.output_prefix, args.output_format)
+  else:
+    convert_shards_in_parallel(args.input_file, shards, args.output_prefix,
+                               args.chunk_size, args.num_workers,
+                               args.output_format, args.row_group_size,
+                               manifest, fingerprints)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test conversion of 10X HDF5 matrices to sparse, long format."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables
+
+import hdf5_to_sparse
+
+# Test data, three genes of which two share the name Glul, by five cells of
+# which the third has no measurements.
+GENE_IDS = ['ENSMUSG01', 'ENSMUSG02', 'ENSMUSG03']
+GENE_NAMES = ['Glul', 'Rho', 'Glul']
+BARCODES = ['cell1', 'cell2', 'cell3', 'cell4', 'cell5']
+DATA = [1, 2, 3, 5, 7, 1, 4]
+INDICES = [0, 1, 2, 1, 0, 1, 2]
+INDPTR = [0, 3, 4, 4, 6, 7]
+
+EXPECTED_CSV = """ENSMUSG01,Glul,cell1,1
+ENSMUSG02,Rho,cell1,2
+ENSMUSG03,Glul,cell1,3
+ENSMUSG02,Rho,cell2,5
+ENSMUSG01,Glul,cell4,7
+ENSMUSG02,Rho,cell4,1
+ENSMUSG03,Glul,cell5,4
+"""
+
+
+def write_h5(filename):
+  with tables.open_file(filename, 'w') as f:
+    group = f.create_group('/', hdf5_to_sparse.GENOME)
+    f.create_array(group, 'data', np.array(DATA, dtype=np.int32))
+    f.create_array(group, 'indices', np.array(INDICES, dtype=np.int64))
+    f.create_array(group, 'indptr', np.array(INDPTR, dtype=np.int64))
+    f.create_array(group, 'shape', np.array([3, 5], dtype=np.int32))
+    f.create_array(group, 'genes', np.array(GENE_IDS, dtype='S'))
+    f.create_array(group, 'gene_names', np.array(GENE_NAMES, dtype='S'))
+    f.create_array(group, 'barcodes', np.array(BARCODES, dtype='S'))
+
+
+def read_csv_rows(filename):
+  with open(filename, 'r') as f:
+    header = f.readline()
+    return header, f.read()
+
+
+class Hdf5ToSparseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.input_file = os.path.join(self.path, 'matrix.h5')
+    write_h5(self.input_file)
+    self.output_prefix = os.path.join(self.path, 'shard')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_read_cell_blocks_from_h5(self):
+    blocks = list(hdf5_to_sparse.read_cell_blocks_from_h5(
+        self.input_file, hdf5_to_sparse.GENOME, 1, 5, 2))
+    self.assertEqual([1, 3], [begin_idx for begin_idx, _ in blocks])
+    self.assertEqual([['cell2', 'cell3'], ['cell4', 'cell5']],
+                     [block.barcodes.tolist() for _, block in blocks])
+    whole = hdf5_to_sparse.get_matrix_from_h5(self.input_file,
+                                              hdf5_to_sparse.GENOME)
+    np.testing.assert_array_equal(
+        whole.matrix[:, 3:5].toarray(), blocks[1][1].matrix.toarray())
+
+  def test_format_block(self):
+    text = ''.join(
+        hdf5_to_sparse.format_block(block)
+        for _, block in hdf5_to_sparse.read_cell_blocks_from_h5(
+            self.input_file, hdf5_to_sparse.GENOME, 0, 5, 2))
+    self.assertEqual(EXPECTED_CSV, text)
+
+  def test_shards_concatenate_to_one_shot_output(self):
+    one_shot_file = os.path.join(self.path, 'one_shot.csv')
+    num_rows = hdf5_to_sparse.convert_cells(self.input_file, 0, 5,
+                                            one_shot_file, 1000)
+    self.assertEqual(7, num_rows)
+    header, one_shot = read_csv_rows(one_shot_file)
+    self.assertEqual(EXPECTED_CSV, one_shot)
+
+    shards = hdf5_to_sparse.compute_shard_boundaries(
+        hdf5_to_sparse.read_indptr_from_h5(self.input_file,
+                                           hdf5_to_sparse.GENOME), 0, 5, 3)
+    self.assertEqual([(0, 1), (1, 4), (4, 5)], shards)
+    hdf5_to_sparse.convert_shards_in_parallel(self.input_file, shards,
+                                              self.output_prefix, 1, 2)
+    shard_rows = []
+    for begin_idx, end_idx in shards:
+      shard_header, rows = read_csv_rows(hdf5_to_sparse.get_shard_output_file(
+          self.output_prefix, begin_idx, end_idx))
+      self.assertEqual(header, shard_header)
+      shard_rows.append(rows)
+    self.assertEqual(one_shot, ''.join(shard_rows))
+
+  def test_manifest_rerun_after_deleting_a_shard(self):
+    argv = ['--input-file', self.input_file, '--begin-idx', '0',
+            '--end-idx', '5', '--num-shards', '3', '--output-prefix',
+            self.output_prefix, '--num-workers', '1', '--manifest',
+            os.path.join(self.path, 'manifest.json')]
+    hdf5_to_sparse.run(argv)
+    outputs = [hdf5_to_sparse.get_shard_output_file(self.output_prefix,
+                                                    begin_idx, end_idx)
+               for begin_idx, end_idx in [(0, 1), (1, 4), (4, 5)]]
+    contents = [read_csv_rows(output) for output in outputs]
+    # A rewritten shard is moved into place as a new file.
+    inodes = [os.stat(output).st_ino for output in outputs]
+    os.remove(outputs[1])
+
+    hdf5_to_sparse.run(argv)
+    self.assertEqual([inodes[0], inodes[2]], [os.stat(outputs[0]).st_ino,
+                                              os.stat(outputs[2]).st_ino])
+    self.assertEqual(contents, [read_csv_rows(output) for output in outputs])
+
+  def test_compute_fingerprints(self):
+    fingerprints = hdf5_to_sparse.compute_fingerprints(
+        self.input_file, [(0, 2), (2, 5), (0, 2)])
+    self.assertEqual(fingerprints[0], fingerprints[2])
+    self.assertNotEqual(fingerprints[0], fingerprints[1])
+
+
+if __name__ == '__main__':
+  unittest.main()
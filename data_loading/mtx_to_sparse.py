@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+r"""Convert a Matrix Market gene-barcode matrix to sparse, long format.
+
+This reads the matrix.mtx, genes.tsv and barcodes.tsv files written by 10x
+Genomics Cell Ranger 2, or the gzipped matrix.mtx.gz, features.tsv.gz and
+barcodes.tsv.gz files written by Cell Ranger 3, and writes the same gene_id,
+gene, cell and trans_cnt columns as hdf5_to_sparse.py.
+
+The matrix is streamed: it is decompressed by pigz, if installed, or otherwise
+by a reader thread, while the triplets are parsed and formatted with numpy in
+large chunks on a local pool of worker processes. The whole matrix is never
+held in memory, so the output is in the order of the triplets in the input.
+
+Pass --output-format parquet to instead write Parquet with dictionary-encoded
+gene_id, gene and cell columns and integer transcript counts, see
+parquet_output.py. Pass --manifest to skip the conversion when the input files
+and the output file are unchanged since the last run, see
+conversion_manifest.py. The files are compared by size and modification time,
+or also by checksum with --verify-checksums.
+"""
+
+import argparse
+import collections
+import gzip
+import hashlib
+import itertools
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+
+import conversion_manifest
+import parquet_output
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+OUTPUT_COLUMNS = ['gene_id', 'gene', 'cell', 'trans_cnt']
+
+# The file names of each Cell Ranger output layout, matrix first.
+INPUT_LAYOUTS = [
+    ('matrix.mtx.gz', 'features.tsv.gz', 'barcodes.tsv.gz'),
+    ('matrix.mtx', 'genes.tsv', 'barcodes.tsv')
+]
+
+# The number of blocks the reader thread may decompress ahead of the parser.
+READ_AHEAD_BLOCKS = 4
+
+# The number of chunks per worker process that may be read ahead of their
+# conversion.
+MAX_PENDING_CHUNKS_PER_WORKER = 2
+
+# Set in each worker process by _init_worker.
+_worker_args = {}
+
+
+def find_input_files(input_dir):
+  """Find the matrix, features and barcodes files of a Cell Ranger output.
+
+  Args:
+    input_dir: Directory holding the files of a single matrix.
+
+  Returns:
+    A tuple of the matrix, features and barcodes file paths.
+  """
+  for layout in INPUT_LAYOUTS:
+    paths = tuple(os.path.join(input_dir, filename) for filename in layout)
+    if all(os.path.exists(path) for path in paths):
+      return paths
+  raise ValueError('%s holds neither %s.' % (
+      input_dir, ' nor '.join(', '.join(layout) for layout in INPUT_LAYOUTS)))
+
+
+def find_executable(name):
+  """The path of an executable on the PATH, or None if there is none."""
+  for directory in os.getenv('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
+
+
+def read_blocks_in_thread(handle, block_bytes):
+  """Read blocks of a file on a thread, ahead of their consumer.
+
+  Args:
+    handle: file opened for binary reads, such as a gzip.GzipFile
+    block_bytes: the size of each block
+
+  Yields:
+    The blocks of the file.
+  """
+  blocks = queue.Queue(READ_AHEAD_BLOCKS)
+  errors = []
+
+  def read():
+    try:
+      for block in iter(lambda: handle.read(block_bytes), b''):
+        blocks.put(block)
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+    blocks.put(b'')
+
+  reader = threading.Thread(target=read)
+  reader.daemon = True
+  reader.start()
+  for block in iter(blocks.get, b''):
+    yield block
+  reader.join()
+  if errors:
+    raise errors[0]
+
+
+def read_decompressed_blocks(filename, block_bytes, num_threads):
+  """Read the blocks of a file, decompressing it if it is gzipped.
+
+  Args:
+    filename: path of the file
+    block_bytes: the size of each block
+    num_threads: the number of threads pigz may use to decompress
+
+  Yields:
+    The decompressed blocks of the file.
+  """
+  if not filename.endswith('.gz'):
+    with open(filename, 'rb') as handle:
+      for block in iter(lambda: handle.read(block_bytes), b''):
+        yield block
+    return
+
+  pigz = find_executable('pigz')
+  if pigz is None:
+    handle = gzip.open(filename, 'rb')
+    try:
+      for block in read_blocks_in_thread(handle, block_bytes):
+        yield block
+    finally:
+      handle.close()
+    return
+
+  process = subprocess.Popen([pigz, '-dc', '-p', str(num_threads), filename],
+                             stdout=subprocess.PIPE)
+  for block in iter(lambda: process.stdout.read(block_bytes), b''):
+    yield block
+  process.stdout.close()
+  if process.wait():
+    raise ValueError('pigz failed to decompress %s.' % filename)
+
+
+def split_lines(blocks):
+  """Regroup blocks of text so that each ends at the end of a line.
+
+  Args:
+    blocks: iterable of blocks of text
+
+  Yields:
+    Chunks of whole lines.
+  """
+  remainder = b''
+  for block in blocks:
+    block = remainder + block
+    end = block.rfind(b'\n') + 1
+    remainder = block[end:]
+    if end:
+      yield block[:end]
+  if remainder:
+    yield remainder
+
+
+def parse_header(chunk):
+  """Parse the Matrix Market header at the start of a chunk.
+
+  Args:
+    chunk: the first chunk of lines of the matrix file
+
+  Returns:
+    A tuple of the number of values per line, whether the values are
+    integers, the shape of the matrix, its number of nonzero values and the
+    offset in the chunk of the first value line.
+  """
+  offset = 0
+  banner = None
+  while True:
+    end = chunk.find(b'\n', offset)
+    if end < 0:
+      raise ValueError('The Matrix Market header must fit in one chunk.')
+    line = chunk[offset:end].decode('ascii').strip()
+    offset = end + 1
+    if banner is None:
+      banner = line.lower().split()
+      if (banner[:3] != ['%%matrixmarket', 'matrix', 'coordinate'] or
+          banner[4:] != ['general']):
+        raise ValueError('Unsupported Matrix Market header: %s' % line)
+    elif line and not line.startswith('%'):
+      num_rows, num_cols, nnz = [int(value) for value in line.split()]
+      field = banner[3]
+      return (2 if field == 'pattern' else 3, field in ['integer', 'pattern'],
+              (num_rows, num_cols), nnz, offset)
+
+
+def parse_triplets(chunk, num_fields):
+  """Parse a chunk of Matrix Market value lines.
+
+  Args:
+    chunk: whole lines of text, each a gene index, a cell index and,
+      unless the matrix is a pattern, a value
+    num_fields: the number of fields per line
+
+  Returns:
+    A tuple of arrays of the zero-based gene index, the zero-based cell index
+    and the value of each line.
+  """
+  fields = np.fromstring(chunk, sep=' ')
+  if fields.size % num_fields:
+    raise ValueError('Expected %d fields per line of the matrix.'
+                     % num_fields)
+  fields = fields.reshape(-1, num_fields)
+  values = fields[:, 2] if num_fields == 3 else np.ones(len(fields))
+  return (fields[:, 0].astype(np.int64) - 1,
+          fields[:, 1].astype(np.int64) - 1, values)
+
+
+def read_tsv(filename):
+  """Read the rows of a possibly gzipped, tab-separated file."""
+  opener = gzip.open if filename.endswith('.gz') else open
+  with opener(filename, 'rb') as handle:
+    return [line.decode('utf-8').rstrip('\r\n').split('\t')
+            for line in handle if line.strip()]
+
+
+def read_features(filename, feature_type=None):
+  """Read the features of the matrix rows.
+
+  Args:
+    filename: path of the genes.tsv or features.tsv.gz file
+    feature_type: optional feature type, such as 'Gene Expression', to which
+      to restrict the conversion
+
+  Returns:
+    A tuple of arrays of the feature ids, the feature names and whether to
+    convert the values of each feature.
+  """
+  rows = read_tsv(filename)
+  gene_ids = np.array([row[0] for row in rows], dtype=object)
+  gene_names = np.array([row[1] if len(row) > 1 else row[0] for row in rows],
+                        dtype=object)
+  if feature_type is None:
+    keep = np.ones(len(rows), dtype=bool)
+  else:
+    keep = np.array([len(row) > 2 and row[2] == feature_type for row in rows],
+                    dtype=bool)
+  return gene_ids, gene_names, keep
+
+
+def format_triplets(gene_prefixes, cells, gene_idx, cell_idx, values):
+  """Format triplets as sparse, long format CSV text.
+
+  Args:
+    gene_prefixes: object array of the 'gene_id,gene,' text of each feature
+    cells: object array of the 'barcode,' text of each cell
+    gene_idx: array of the gene index of each value
+    cell_idx: array of the cell index of each value
+    values: array of the values
+
+  Returns:
+    The CSV text, one line per value.
+  """
+  counts, count_idx = np.unique(values, return_inverse=True)
+  count_suffixes = np.array(
+      [count + '\n' for count in counts.astype(str).tolist()], dtype=object)
+  columns = [gene_prefixes[gene_idx], cells[cell_idx],
+             count_suffixes[count_idx.ravel()]]
+  return ''.join(itertools.chain.from_iterable(
+      zip(*[column.tolist() for column in columns])))
+
+
+def triplets_to_columns(gene_ids, gene_names, barcodes, gene_idx, cell_idx,
+                        values):
+  """Convert triplets to dictionary-encoded columns for Parquet.
+
+  Only the genes and cells present in the triplets are put in the
+  dictionaries of the columns.
+
+  Returns:
+    A list of pyarrow arrays, one per output column.
+  """
+  genes, gene_idx = np.unique(gene_idx, return_inverse=True)
+  cells, cell_idx = np.unique(cell_idx, return_inverse=True)
+  return [parquet_output.dictionary_column(gene_idx, gene_ids[genes]),
+          parquet_output.dictionary_column(gene_idx, gene_names[genes]),
+          parquet_output.dictionary_column(cell_idx, barcodes[cells]),
+          parquet_output.count_column(values)]
+
+
+def _init_worker(gene_ids, gene_names, keep, barcodes, num_fields,
+                 is_integer, output_format):
+  _worker_args.update(
+      gene_ids=gene_ids, gene_names=gene_names, keep=keep, barcodes=barcodes,
+      num_fields=num_fields, is_integer=is_integer,
+      output_format=output_format,
+      gene_prefixes=np.array(
+          [gene_id + ',' + gene_name + ','
+           for gene_id, gene_name in zip(gene_ids.tolist(),
+                                         gene_names.tolist())],
+          dtype=object),
+      cells=np.array([barcode + ',' for barcode in barcodes.tolist()],
+                     dtype=object))
+
+
+def _convert_chunk(chunk):
+  """Convert a chunk of value lines using the worker's arguments.
+
+  Returns:
+    The CSV text or pyarrow Table of the chunk, and its number of rows.
+  """
+  gene_idx, cell_idx, values = parse_triplets(chunk,
+                                              _worker_args['num_fields'])
+  if _worker_args['is_integer']:
+    values = values.astype(np.int64)
+  selected = _worker_args['keep'][gene_idx]
+  if not selected.all():
+    gene_idx, cell_idx, values = (
+        gene_idx[selected], cell_idx[selected], values[selected])
+  if _worker_args['output_format'] == 'parquet':
+    output = parquet_output.pa.Table.from_arrays(
+        triplets_to_columns(_worker_args['gene_ids'],
+                            _worker_args['gene_names'],
+                            _worker_args['barcodes'], gene_idx, cell_idx,
+                            values),
+        OUTPUT_COLUMNS)
+  else:
+    output = format_triplets(_worker_args['gene_prefixes'],
+                             _worker_args['cells'], gene_idx, cell_idx,
+                             values)
+  return output, len(values)
+
+
+def compute_fingerprint(input_files, feature_type, use_checksums=False):
+  """Fingerprint the input files and options of a conversion.
+
+  Args:
+    input_files: the matrix, features and barcodes file paths
+    feature_type: the feature type to which the conversion is restricted
+    use_checksums: whether to fingerprint the contents of the files, which
+      reads them in full, instead of their sizes and modification times
+
+  Returns:
+    The hexadecimal fingerprint.
+  """
+  if use_checksums:
+    descriptions = [conversion_manifest.file_checksum(filename)
+                    for filename in input_files]
+  else:
+    descriptions = ['%d %r' % (os.path.getsize(filename),
+                               os.path.getmtime(filename))
+                    for filename in input_files]
+  return hashlib.sha1(
+      '\n'.join(descriptions + [feature_type or '']).encode()).hexdigest()
+
+
+def convert_matrix(matrix_file, features_file, barcodes_file, output_file,
+                   output_format='csv', feature_type=None,
+                   block_bytes=64 * 1024 * 1024, num_workers=1,
+                   num_threads=1,
+                   row_group_size=parquet_output.DEFAULT_ROW_GROUP_SIZE):
+  """Convert a Matrix Market gene-barcode matrix to sparse, long format.
+
+  Args:
+    matrix_file: path of the matrix.mtx or matrix.mtx.gz file
+    features_file: path of the genes.tsv or features.tsv.gz file
+    barcodes_file: path of the barcodes.tsv or barcodes.tsv.gz file
+    output_file: Output file path. If None, stdout will be used.
+    output_format: 'csv' or 'parquet'
+    feature_type: optional feature type to which to restrict the conversion
+    block_bytes: the approximate size of each chunk of the matrix to convert
+    num_workers: the number of worker processes
+    num_threads: the number of threads pigz may use to decompress
+    row_group_size: Number of rows per Parquet row group.
+
+  Returns:
+    The number of rows written.
+  """
+  gene_ids, gene_names, keep = read_features(features_file, feature_type)
+  barcodes = np.array([row[0] for row in read_tsv(barcodes_file)],
+                      dtype=object)
+
+  chunks = split_lines(read_decompressed_blocks(matrix_file, block_bytes,
+                                                num_threads))
+  first_chunk = next(chunks, b'')
+  num_fields, is_integer, shape, nnz, offset = parse_header(first_chunk)
+  if shape != (len(gene_ids), len(barcodes)):
+    raise ValueError('The %d by %d matrix does not match the %d features and '
+                     '%d barcodes.' % (shape + (len(gene_ids),
+                                                len(barcodes))))
+  sys.stderr.write('Converting %d values of %d features by %d cells from %s\n'
+                   % ((nnz,) + shape + (matrix_file,)))
+  chunks = itertools.chain([first_chunk[offset:]], chunks)
+
+  if output_format == 'parquet':
+    writer = parquet_output.SparseParquetWriter(output_file, OUTPUT_COLUMNS,
+                                                row_group_size)
+    write = writer.write_table
+  else:
+    handle = open(output_file, 'w') if output_file else sys.stdout
+    handle.write(','.join(OUTPUT_COLUMNS) + '\n')
+    write = handle.write
+
+  worker_args = (gene_ids, gene_names, keep, barcodes, num_fields, is_integer,
+                 output_format)
+  num_rows = 0
+  if num_workers > 1:
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=worker_args)
+    try:
+      # Submit chunks only a few at a time, unlike Pool.imap, so that the
+      # decompressed matrix is not read into memory faster than it is
+      # converted.
+      pending = collections.deque()
+      for chunk in chunks:
+        pending.append(pool.apply_async(_convert_chunk, (chunk,)))
+        if len(pending) > MAX_PENDING_CHUNKS_PER_WORKER * num_workers:
+          output, num_chunk_rows = pending.popleft().get()
+          write(output)
+          num_rows += num_chunk_rows
+      for result in pending:
+        output, num_chunk_rows = result.get()
+        write(output)
+        num_rows += num_chunk_rows
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    _init_worker(*worker_args)
+    for chunk in chunks:
+      output, num_chunk_rows = _convert_chunk(chunk)
+      write(output)
+      num_rows += num_chunk_rows
+
+  if output_format == 'parquet':
+    writer.close()
+  elif handle is not sys.stdout:
+    handle.close()
+  return num_rows
+
+
+def run(argv=None):
+  """Runs the Matrix Market conversion."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--input-dir',
+      help='Directory holding the matrix.mtx.gz, features.tsv.gz and '
+      'barcodes.tsv.gz files, or the matrix.mtx, genes.tsv and barcodes.tsv '
+      'files, of a matrix.')
+  parser.add_argument(
+      '--matrix-file',
+      help='Path of the matrix file. Overrides the one in --input-dir.')
+  parser.add_argument(
+      '--features-file',
+      help='Path of the features or genes file. Overrides the one in '
+      '--input-dir.')
+  parser.add_argument(
+      '--barcodes-file',
+      help='Path of the barcodes file. Overrides the one in --input-dir.')
+  parser.add_argument(
+      '--feature-type',
+      help='If set, only convert the values of features of this type, such '
+      'as "Gene Expression".')
+  parser.add_argument(
+      '--output-file',
+      help='Output file path. If None, stdout will be used.')
+  parser.add_argument(
+      '--output-format',
+      choices=['csv', 'parquet'],
+      default='csv',
+      help='Format of the output. Parquet output requires pyarrow.')
+  parser.add_argument(
+      '--row-group-size',
+      type=int,
+      default=parquet_output.DEFAULT_ROW_GROUP_SIZE,
+      help='Number of rows per Parquet row group.')
+  parser.add_argument(
+      '--chunk-bytes',
+      type=int,
+      default=64 * 1024 * 1024,
+      help='Approximate size of the portion of the decompressed matrix '
+      'converted by each task.')
+  parser.add_argument(
+      '--num-workers',
+      type=int,
+      default=multiprocessing.cpu_count(),
+      help='Number of worker processes parsing and formatting the matrix.')
+  parser.add_argument(
+      '--num-threads',
+      type=int,
+      default=multiprocessing.cpu_count(),
+      help='Number of threads pigz may use to decompress the matrix.')
+  parser.add_argument(
+      '--manifest',
+      help='If set, the path of a JSON file recording the conversion, so that '
+      'a rerun with unchanged input and output files does nothing.')
+  parser.add_argument(
+      '--verify-checksums',
+      action='store_true',
+      help='With --manifest, compare the input and output files by checksum '
+      'as well as by size and modification time, which reads them in full.')
+  args = parser.parse_args(argv)
+
+  input_files = find_input_files(args.input_dir) if args.input_dir else (
+      None, None, None)
+  input_files = [override or found for override, found in zip(
+      [args.matrix_file, args.features_file, args.barcodes_file],
+      input_files)]
+  if not all(input_files):
+    raise ValueError('Pass --input-dir or all of --matrix-file, '
+                     '--features-file and --barcodes-file.')
+  conversion_args = (args.output_format, args.feature_type, args.chunk_bytes,
+                     args.num_workers, args.num_threads, args.row_group_size)
+
+  if not args.manifest:
+    convert_matrix(*(input_files + [args.output_file] + list(conversion_args)))
+    return
+
+  if not args.output_file:
+    raise ValueError('--manifest requires --output-file.')
+  manifest = conversion_manifest.ConversionManifest(
+      args.manifest, input_files[0], args.verify_checksums)
+  fingerprint = compute_fingerprint(input_files, args.feature_type,
+                                    args.verify_checksums)
+  num_cells = len(read_tsv(input_files[2]))
+  if manifest.is_converted(0, num_cells, fingerprint, args.output_file):
+    sys.stderr.write('%s is already converted.\n' % input_files[0])
+    return
+  num_rows = convert_matrix(
+      *(input_files + [conversion_manifest.temporary_path(args.output_file)] +
+        list(conversion_args)))
+  conversion_manifest.commit_output(args.output_file)
+  manifest.record(0, num_cells, fingerprint, args.output_file, num_rows)
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,82 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test conversion of Matrix Market gene-barcode matrices."""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import mtx_to_sparse
+
+# Test data, three features by two cells in the Cell Ranger 3 layout.
+MATRIX = """%%MatrixMarket matrix coordinate integer general
+%metadata_json: {}
+3 2 4
+1 1 3
+3 1 1
+2 2 5
+3 2 2
+"""
+FEATURES = """ENSMUSG01\tGlul\tGene Expression
+ENSMUSG02\tRho\tGene Expression
+CD3\tCD3_TotalSeqB\tAntibody Capture
+"""
+BARCODES = 'cell1\ncell2\n'
+
+EXPECTED_CSV = """gene_id,gene,cell,trans_cnt
+ENSMUSG01,Glul,cell1,3
+CD3,CD3_TotalSeqB,cell1,1
+ENSMUSG02,Rho,cell2,5
+CD3,CD3_TotalSeqB,cell2,2
+"""
+
+
+class MtxToSparseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    for filename, text in zip(mtx_to_sparse.INPUT_LAYOUTS[0],
+                              [MATRIX, FEATURES, BARCODES]):
+      with gzip.open(os.path.join(self.path, filename), 'wb') as f:
+        f.write(text.encode('utf-8'))
+    self.input_files = list(mtx_to_sparse.find_input_files(self.path))
+    self.output_file = os.path.join(self.path, 'output.csv')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def convert(self, **kwargs):
+    num_rows = mtx_to_sparse.convert_matrix(
+        *(self.input_files + [self.output_file]), **kwargs)
+    with open(self.output_file, 'r') as f:
+      return num_rows, f.read()
+
+  def test_convert_matrix(self):
+    self.assertEqual((4, EXPECTED_CSV), self.convert())
+
+  def test_workers_match_single_process(self):
+    # Chunks just larger than the header, so that the lines are split over
+    # several chunks.
+    self.assertEqual((4, EXPECTED_CSV),
+                     self.convert(block_bytes=100, num_workers=2))
+
+  def test_feature_type(self):
+    num_rows, text = self.convert(feature_type='Gene Expression')
+    self.assertEqual(2, num_rows)
+    self.assertEqual(
+        'gene_id,gene,cell,trans_cnt\n'
+        'ENSMUSG01,Glul,cell1,3\nENSMUSG02,Rho,cell2,5\n', text)
+
+  def test_mismatched_barcodes(self):
+    with gzip.open(self.input_files[2], 'wb') as f:
+      f.write(b'cell1\n')
+    with self.assertRaises(ValueError):
+      self.convert()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,128 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+r"""Write sparse, long format data as Parquet instead of CSV.
+
+The string columns, such as cell and gene, are dictionary-encoded so that each
+distinct string is stored once per row group instead of once per row, and the
+transcript counts are stored as integers.
+
+Parquet output requires the pyarrow package.
+https://arrow.apache.org/docs/python/parquet.html
+"""
+
+import sys
+
+# These are only needed for Parquet output, so that the data loaders continue
+# to work without them when writing CSV.
+try:
+  import numpy as np
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+
+# The default number of rows per row group, so that files can be loaded by
+# many workers in parallel.
+DEFAULT_ROW_GROUP_SIZE = 1000000
+
+
+def dictionary_column(indices, dictionary):
+  """Create a dictionary-encoded string column.
+
+  Args:
+    indices: array of the index into the dictionary of each row
+    dictionary: list or array of the distinct strings
+
+  Returns:
+    A pyarrow DictionaryArray.
+  """
+  return pa.DictionaryArray.from_arrays(
+      pa.array(np.asarray(indices, dtype=np.int32)),
+      pa.array(list(dictionary), type=pa.string()))
+
+
+def count_column(values):
+  """Create an integer transcript count column.
+
+  Args:
+    values: array of the transcript counts of each row
+
+  Returns:
+    A pyarrow Int64Array.
+  """
+  values = np.asarray(values)
+  counts = values.astype(np.int64)
+  if not np.array_equal(counts, values):
+    raise ValueError("Parquet output requires whole number transcript "
+                     "counts, use CSV output instead.")
+  return pa.array(counts)
+
+
+class SparseParquetWriter(object):
+  """Buffer columns of long format rows and write them as Parquet row groups.
+
+  Every column but the last is a dictionary-encoded string column and the last
+  column holds the integer transcript counts.
+  """
+
+  def __init__(self, output_file, column_names,
+               row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """Open the Parquet file for writing.
+
+    Args:
+      output_file: Output file path. If None, stdout will be used.
+      column_names: list of the names of the columns
+      row_group_size: the number of rows per row group
+    """
+    if pa is None:
+      raise ValueError("Parquet output requires pyarrow.")
+    string_type = pa.dictionary(pa.int32(), pa.string())
+    self.schema = pa.schema([(name, string_type)
+                             for name in column_names[:-1]] +
+                            [(column_names[-1], pa.int64())])
+    self.row_group_size = row_group_size
+    self.tables = []
+    self.num_rows = 0
+    if output_file:
+      sink = output_file
+    else:
+      sink = pa.PythonFile(getattr(sys.stdout, "buffer", sys.stdout),
+                           mode="w")
+    self.writer = pq.ParquetWriter(sink, self.schema)
+
+  def write_columns(self, columns):
+    """Buffer rows, writing a row group whenever enough rows are buffered.
+
+    Args:
+      columns: list of pyarrow arrays, one per column
+    """
+    self.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+  def write_table(self, table):
+    """Buffer a table of rows, such as one created by a worker process.
+
+    Args:
+      table: pyarrow Table with the schema of this writer
+    """
+    if not table.num_rows:
+      return
+    self.tables.append(table)
+    self.num_rows += table.num_rows
+    if self.num_rows >= self.row_group_size:
+      buffered = pa.concat_tables(self.tables)
+      num_full_rows = self.num_rows - self.num_rows % self.row_group_size
+      self.writer.write_table(buffered.slice(0, num_full_rows),
+                              row_group_size=self.row_group_size)
+      remainder = buffered.slice(num_full_rows)
+      self.tables = [remainder] if remainder.num_rows else []
+      self.num_rows = remainder.num_rows
+
+  def close(self):
+    """Write any remaining buffered rows and the Parquet file footer."""
+    if self.tables:
+      self.writer.write_table(pa.concat_tables(self.tables),
+                              row_group_size=self.row_group_size)
+    self.writer.close()
@@ -0,0 +1,65 @@
+# Copyright 2017 Verily Life Sciences Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+"""Test writing of sparse, long format data as Parquet."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyarrow.parquet as pq
+
+import parquet_output
+
+COLUMNS = ['cell', 'gene', 'trans_cnt']
+
+
+class ParquetOutputTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.output_file = os.path.join(self.path, 'output.parquet')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_sparse_parquet_writer(self):
+    writer = parquet_output.SparseParquetWriter(self.output_file, COLUMNS, 2)
+    cells = ['cell1', 'cell2']
+    genes = ['Glul', 'Rho']
+    writer.write_columns([parquet_output.dictionary_column([0, 0, 1], cells),
+                          parquet_output.dictionary_column([0, 1, 1], genes),
+                          parquet_output.count_column([1, 2, 3])])
+    writer.write_columns([parquet_output.dictionary_column([], cells),
+                          parquet_output.dictionary_column([], genes),
+                          parquet_output.count_column([])])
+    writer.write_columns([parquet_output.dictionary_column([1, 0], cells),
+                          parquet_output.dictionary_column([0, 0], genes),
+                          parquet_output.count_column([4.0, 5.0])])
+    writer.close()
+
+    parquet_file = pq.ParquetFile(self.output_file)
+    self.assertEqual(
+        [2, 2, 1], [parquet_file.metadata.row_group(i).num_rows
+                    for i in range(parquet_file.num_row_groups)])
+    table = parquet_file.read()
+    self.assertEqual(COLUMNS, table.schema.names)
+    rows = table.to_pydict()
+    self.assertEqual(['cell1', 'cell1', 'cell2', 'cell2', 'cell1'],
+                     [str(cell) for cell in rows['cell']])
+    self.assertEqual(['Glul', 'Rho', 'Rho', 'Glul', 'Glul'],
+                     [str(gene) for gene in rows['gene']])
+    self.assertEqual([1, 2, 3, 4, 5], rows['trans_cnt'])
+
+  def test_count_column(self):
+    np.testing.assert_array_equal(
+        [1, 20], parquet_output.count_column(np.array([1.0, 20.0])).to_pylist())
+    with self.assertRaises(ValueError):
+      parquet_output.count_column([1.5])
+
+
+if __name__ == '__main__':
+  unittest.main()